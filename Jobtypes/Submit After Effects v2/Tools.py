@@ -14,6 +14,7 @@ import qb
 
 sys.path.insert(0, '../../Modules')
 import sequenceTools
+import frameVerifier
 
 '''
 Setup this files logging settings
@@ -25,7 +26,10 @@ logger = logging.getLogger(__name__)
 class Tools:
     def __init__(self, agendaItem, outputs, logFilePath, startFrame, endFrame):
         self.mySequences = None
+        self.sequenceGroup = None
         self.corruptFrames = []
+        self.verifier = None
+        self.verifyingFrames = {}
         self.agendaItem = agendaItem
         self.outputs = outputs
         self.startFrame = startFrame
@@ -108,6 +112,7 @@ class Tools:
                     break
                 
 
+        self.collectVerifiedFrames(wait=True)
         self.deleteCorruptFrames()
         if self.corruptFrames:
             return False
@@ -121,17 +126,42 @@ class Tools:
         return myFrame / myDuration
 
     def verifyCurrFrame(self):
+        '''
+        Queue the current frame of each output for verification.
+        Formats with a validator are checked straight away by reading their
+        header and trailer, others are verified in the background while the
+        render continues.  Frames already verified on a previous try are skipped.
+        '''
         # logging.debug("Verifying frame " + str(frame))
         if not self.mySequences:
             self.setupSequences()
-        for sequence in self.mySequences:
-            if sequence.checkForCorruptFrame(self.currFrame):
-                self.corruptFrames.append(self.currFrame)
+        if not self.verifier:
+            # Keep the pool small, After Effects is using the rest of the node
+            self.verifier = frameVerifier.FrameVerifier(processes=2)
+        for framePath in self.sequenceGroup.getFrameFilenames(self.currFrame):
+            self.verifyingFrames[framePath] = self.currFrame
+            self.verifier.submit(framePath)
+        self.collectVerifiedFrames()
+
+    def collectVerifiedFrames(self, wait=False):
+        '''
+        Record the corrupt frames from finished verifications.
+        If wait is True, wait for all queued frames and close the verifier.
+        '''
+        if not self.verifier:
+            return
+        for framePath, ok in self.verifier.collect(wait):
+            frame = self.verifyingFrames.pop(framePath, None)
+            if not ok and frame not in self.corruptFrames:
+                logging.warning("Corrupt frame: " + os.path.basename(framePath))
+                self.corruptFrames.append(frame)
+        if wait:
+            self.verifier.close()
+            self.verifier = None
 
     def deleteCorruptFrames(self):
         for frame in self.corruptFrames:
-            for sequence in self.mySequences:
-                framePath = sequence.getFrameFilename(frame)
+            for framePath in self.sequenceGroup.getFrameFilenames(frame):
                 logging.debug("Deleting corrupt frame: " + os.path.basename(framePath))
                 try:
                     os.remove(framePath)
@@ -139,12 +169,18 @@ class Tools:
                     logging.error("Unable to delete corrupt frame: " + os.path.basename(framePath))
 
     def setupSequences(self):
-        self.mySequences = []
+        '''
+        Group the output sequences so outputs in the same
+        folder share a single listing of that folder.
+        '''
+        firstFrames = []
         for outputPath in self.outputs:
             logging.debug("Output Path: " + str(outputPath))
             firstFrame = outputPath.replace("[", "").replace("]", "")
             firstFrame = firstFrame.replace("#", "0")
-            self.mySequences.append(sequenceTools.Sequence(firstFrame))
+            firstFrames.append(firstFrame)
+        self.sequenceGroup = sequenceTools.SequenceGroup(firstFrames)
+        self.mySequences = self.sequenceGroup.sequences
 
     def checkIfSequence(self):
         result = True
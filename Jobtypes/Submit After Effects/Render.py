@@ -18,6 +18,7 @@ import time
 import hashlib
 
 import Reporter
+import sequenceTools
 
 REPORTERTHEADS = 1
 STATUSFREQUENCY = 20 # Frames
@@ -51,6 +52,7 @@ class Render():
     # Copy the specified file locally to the destination
     # If needed, make a backup if overwriting file and place it under
     # a backups folder with the time at the end of the file name.
+    # The copy is renamed into place, so After Effects never loads a partial script.
     def copyLocal(self, sourceFile, destFile, backup=True):
         try:
             self.logger.info("Updating local copy of " + os.path.basename(sourceFile))
@@ -66,7 +68,7 @@ class Render():
 
                     shutil.move(destFile, bkpPath)
 
-            shutil.copy(sourceFile, destFile)
+            sequenceTools.copyFile(sourceFile, destFile)
             return True
         except:
             self.logger.warning("Unable to update local copy of " + os.path.basename(sourceFile))
@@ -22,6 +22,8 @@ import logging
 sys.path.append('/Applications/pfx/qube/api/python/')
 import qb
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))) + "/Modules")
+
 # Gotta be a better way to do this.  Suggestions?
 sys.path.insert(0, os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))
 print 'PATH: ' + str(sys.path)
@@ -0,0 +1,150 @@
+'''
+Submit Transcoder - Blender Worker
+Author: Brennan Chapman
+
+Keeps one blender running for every segment a worker transcodes,
+so the blender project is only loaded once instead of once per segment.
+
+Blender is started with the Blender_Worker.py control script,
+which connects back to a socket on this host and renders each
+segment on command.  Any failure of the worker raises a
+BlenderWorkerError so the caller can fall back to running
+blender once for the segment.
+'''
+
+import os
+import json
+import time
+import shlex
+import socket
+import logging
+import binascii
+import subprocess
+
+WORKERSTARTTIMEOUT = 300 # Seconds for blender to start and load the scene
+WORKERFRAMETIMEOUT = 900 # Seconds to wait for each frame
+WORKERQUITTIMEOUT = 30
+
+''' Setup the logger. '''
+logger = logging.getLogger(__name__)
+
+
+class BlenderWorkerError(Exception):
+    pass
+
+
+class BlenderWorker(object):
+    '''
+    A blender process that renders segments on command.
+    '''
+
+    def __init__(self, control):
+        self.control = control
+        self.proc = None
+        self.conn = None
+        self.reader = None
+        self.segmentCount = 0
+
+    def start(self):
+        '''
+        Start blender and wait for it to load the scene and connect.
+        Raises BlenderWorkerError if it doesn't.
+        '''
+
+        startTime = time.time()
+        token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            listener.settimeout(WORKERSTARTTIMEOUT)
+            port = listener.getsockname()[1]
+
+            cmd = self.control.getWorkerCMD(port, token)
+            logger.debug("Worker Command: " + cmd)
+            self.proc = subprocess.Popen(shlex.split(cmd), bufsize=-1)
+
+            try:
+                self.conn, address = listener.accept()
+            except socket.timeout:
+                raise BlenderWorkerError("Blender worker didn't connect within %ss" % WORKERSTARTTIMEOUT)
+        except:
+            self.close()
+            raise
+        finally:
+            listener.close()
+
+        self.conn.settimeout(WORKERFRAMETIMEOUT)
+        self.reader = self.conn.makefile('rb')
+        message = self.receive()
+        if message.get('event') != 'ready' or message.get('token') != token:
+            self.close()
+            raise BlenderWorkerError("Unexpected connection to the blender worker socket.")
+        logger.info("Blender worker started in %.1fs" % (time.time() - startTime))
+
+    def isRunning(self):
+        return self.conn is not None and self.proc is not None and self.proc.poll() is None
+
+    def send(self, message):
+        try:
+            self.conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        except socket.error as e:
+            raise BlenderWorkerError("Lost connection to the blender worker: %s" % e)
+
+    def receive(self):
+        try:
+            line = self.reader.readline()
+        except socket.timeout:
+            raise BlenderWorkerError("Blender worker didn't respond within %ss" % WORKERFRAMETIMEOUT)
+        except socket.error as e:
+            raise BlenderWorkerError("Lost connection to the blender worker: %s" % e)
+        if not line:
+            raise BlenderWorkerError("Blender worker exited.")
+        return json.loads(line.decode('utf-8'))
+
+    def render(self, startFrame, endFrame, outputFile, progress=None):
+        '''
+        Render a segment and return blender's return code.
+        progress is called with each frame number as it's rendered.
+        '''
+
+        if not self.isRunning():
+            raise BlenderWorkerError("Blender worker isn't running.")
+
+        startTime = time.time()
+        self.send({'command': 'render', 'start': int(startFrame), 'end': int(endFrame), 'output': outputFile})
+        while True:
+            message = self.receive()
+            event = message.get('event')
+            if event == 'frame':
+                if progress:
+                    progress(message['frame'])
+            elif event == 'done':
+                self.segmentCount += 1
+                if message.get('message'):
+                    logger.error("Blender worker error:\n" + message['message'])
+                logger.info("Blender worker rendered frames %s-%s in %.1fs" % (startFrame, endFrame, time.time() - startTime))
+                return message.get('returnCode', 1)
+
+    def close(self):
+        '''
+        Ask blender to quit, killing it if it doesn't.
+        '''
+
+        if self.conn is not None:
+            try:
+                self.conn.sendall((json.dumps({'command': 'quit'}) + '\n').encode('utf-8'))
+            except socket.error:
+                pass
+            self.conn.close()
+            self.conn = None
+
+        if self.proc is not None:
+            deadline = time.time() + WORKERQUITTIMEOUT
+            while self.proc.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.proc.poll() is None:
+                logger.warning("Blender worker didn't quit, killing it.")
+                self.proc.kill()
+                self.proc.wait()
+            self.proc = None
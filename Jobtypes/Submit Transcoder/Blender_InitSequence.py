@@ -50,14 +50,16 @@ def main():
         '''
         Create an array containing dictionaries for each frame.
         {'name':frameFileName}
+        Missing frames are filled from frame 0, so the blender
+        frame numbers line up with the sequence frame numbers.
         '''
-        myFiles = []
-        frameNumbers = mySequence.getFrames(fillMissing=fillMissingFrames)
-        for pathToFrame in mySequence.getFrameFilenames(frameNumbers):
-            myFrame = {'name':os.path.basename(pathToFrame)}
-            myFiles.append(myFrame)
+        if fillMissingFrames:
+            frameNumbers = (sourceFrame for frame, sourceFrame in mySequence.iterFilled(start=0))
+        else:
+            frameNumbers = mySequence.iterFrames()
+        myFiles = [{'name':frameName} for frameName in mySequence.iterFrameFilenames(frameNumbers, includeFolder=False)]
 
-        logger.debug('Image Sequence File List: ' + str(myFiles))
+        logger.debug('Image Sequence File Count: ' + str(len(myFiles)))
 
         if (len(myFiles) < 1):
             logger.error('No sequence files in folder.')
@@ -102,6 +104,13 @@ def main():
                 # Save the scene for rendering the segments
                 bpy.ops.wm.save_mainfile(filepath=sceneFile,compress=True)
                 logger.info('Blender Scene Saved to ' + sceneFile)
+
+                ''' Record the frame rate, the controller needs it to splice segments. '''
+                frameRate = float(myscene.render.fps) / myscene.render.fps_base
+                f = open(sceneFile + '.fps', 'w')
+                f.write(repr(frameRate))
+                f.close()
+                logger.info('Scene Frame Rate: ' + str(frameRate))
     
                 logger.info('Blender Scene Complete!')
                 exitCode = 0
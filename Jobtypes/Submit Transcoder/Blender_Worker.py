@@ -0,0 +1,109 @@
+# Blender Worker
+# Author: Brennan Chapman
+'''
+Keep blender running with the transcoder scene loaded and
+render segments on command from the Submit Transcoder jobtype.
+
+Connects back to the jobtype on a local socket and reads one JSON
+command per line:
+  {"command": "render", "start": 1, "end": 100, "output": "/path/segment"}
+  {"command": "quit"}
+Each rendered frame is reported with {"event": "frame", "frame": 1}
+and every render finishes with {"event": "done", "returnCode": 0}.
+
+Settings:
+  1-(int) Port the jobtype is listening on
+  2-(string) Token to identify this worker to the jobtype
+'''
+import sys
+import json
+import socket
+import logging
+import traceback
+
+import bpy
+
+''' Setup the logger. '''
+logging.basicConfig()
+logger = logging.getLogger('Worker Script')
+logger.setLevel(logging.INFO)
+
+def send(conn, message):
+    conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+def getFrameHandlers():
+    '''
+    Return the list of handlers called after each frame is
+    written, or None on versions of blender without handlers.
+    '''
+
+    handlers = getattr(bpy.app, 'handlers', None)
+    if handlers is None:
+        return None
+    return getattr(handlers, 'render_write', getattr(handlers, 'render_post', None))
+
+def render(conn, command):
+    '''
+    Render a segment the same way as:
+    blender -b blendfile -x 1 -s start -e end -o output -a
+    '''
+
+    scene = bpy.data.scenes[0]
+    scene.frame_start = int(command['start'])
+    scene.frame_end = int(command['end'])
+    scene.render.filepath = command['output']
+    scene.render.use_file_extension = True
+
+    def frameWritten(*args):
+        send(conn, {'event': 'frame', 'frame': scene.frame_current})
+
+    handlers = getFrameHandlers()
+    if handlers is not None:
+        handlers.append(frameWritten)
+    try:
+        bpy.ops.render.render(animation=True)
+    finally:
+        if handlers is not None:
+            handlers.remove(frameWritten)
+
+def main():
+    ''' Get the arguments after the '--' separator. '''
+    args = sys.argv[(sys.argv.index('--')+1):]
+    try:
+        port = int(args[0])
+        token = str(args[1])
+    except:
+        logger.error('Invalid Input Parameters.')
+        return 1
+
+    conn = socket.create_connection(('127.0.0.1', port))
+    reader = conn.makefile('rb')
+    send(conn, {'event': 'ready', 'token': token})
+    logger.info('Blender worker ready.')
+
+    while True:
+        line = reader.readline()
+        if not line:
+            logger.info('Jobtype disconnected.')
+            break
+        command = json.loads(line.decode('utf-8'))
+
+        if command.get('command') == 'render':
+            logger.info('Rendering frames %s-%s' % (command['start'], command['end']))
+            try:
+                render(conn, command)
+                send(conn, {'event': 'done', 'returnCode': 0})
+            except Exception:
+                message = traceback.format_exc()
+                logger.error(message)
+                send(conn, {'event': 'done', 'returnCode': 1, 'message': message})
+
+        elif command.get('command') == 'quit':
+            break
+
+    conn.close()
+    return 0
+
+if __name__ == '__main__':
+    exitCode = main()
+    sys.exit(exitCode)
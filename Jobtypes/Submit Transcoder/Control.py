@@ -9,22 +9,43 @@ Controls the transcoding job process.
 '''
 
 import os
+import re
+import errno
 import sys
+import json
+import time
+import shutil
 import inspect
 import logging
+import tempfile
 
 sys.path.append('/Volumes/theGrill/.qube/Modules/')
 import sequenceTools
 import inputValidation
 import Job
+import BlenderWorker
+import segmentPlanner
 import qb
 
 ''' Constants '''
 BLENDERLOCATION = '/Applications/blender.app/Contents/MacOS/blender'
 BLENDERINITSCRIPT = 'Blender_InitSequence.py'
+BLENDERWORKERSCRIPT = 'Blender_Worker.py'
 CATMOVIELOCATION = '/usr/local/bin/catmovie'
 MUXMOVIELOCATION = '/usr/local/bin/muxmovie'
 MODTIMEDBFILEPREFIX = '.DATA.'
+SEGMENTLAYOUTEXTENSION = '.layout'
+FRAMERATEEXTENSION = '.fps' # Written next to the blender file by Blender_InitSequence
+SUBSEGMENTMERGEGAP = 24 # Changes closer than this many frames are transcoded together
+SUBSEGMENTMAXRATIO = 0.5 # Transcode the whole segment once this much of it changed
+SUBSEGMENTMAXPARTS = 8 # Transcode the whole segment rather than splice more parts
+SCRATCHFOLDER = os.path.join(tempfile.gettempdir(), 'Transcoder')
+SCRATCHMINFREEBYTES = 5 * 1024 * 1024 * 1024 # Free space to leave on the scratch disk
+SCRATCHSTALEAGE = 2 * 24 * 60 * 60 # Seconds before another job's scratch is removed
+PUBLISHMBPS = 100 # Copy speed limit from scratch to the share
+DEPENDENCYFOLDER = 'Dependencies'
+dependencyMarkerPattern = re.compile(r'^(Segment|Merge)_[0-9-]+$')
+DEPENDENCYSWEEPINTERVAL = 300 # Seconds between agenda sweeps for missed dependants
 
 '''
 Setup this files logging settings
@@ -44,6 +65,17 @@ class Control:
         self.job = Job.Job()
         self.errors = []
         self.job.qubejob = qubeJobObject
+        self.blenderWorker = None
+        self.prefetcher = None
+        self.frameScan = None
+        self.scratchFolder = None
+        self.renderFiles = {}
+        self.agenda = None
+        self.agendaIndex = None
+        self.agendaQueries = 0
+        self.agendaQuerySeconds = 0.0
+        self.dependencyErrors = False
+        self.frameRate = None
         self.loadOptions()
 
     def checkForErrors(self):
@@ -64,7 +96,10 @@ class Control:
         job.preset = self.loadOption('preset', required=True, isFullPath=True)
         job.selfContained = self.loadOption('selfContained', isBool=True)
         job.smartUpdate = self.loadOption('smartUpdate', isBool=True)
+        job.smartUpdateHashes = self.loadOption('smartUpdateHashes', isBool=True)
         job.fillMissingFrames = self.loadOption('fillMissingFrames', isBool=True)
+        job.persistentBlender = self.loadOption('persistentBlender', isBool=True)
+        job.prefetch = self.loadOption('prefetch', isBool=True)
         job.transcoderFolder = self.loadOption('transcoderFolder', required=True)
         job.frameRange = self.loadOption('frameRange', required=True)
 
@@ -72,6 +107,10 @@ class Control:
             logger.error('Unable to load job options:\n\t' + '\n\t'.join(self.errors))
         else:
             self.job.sequence = sequenceTools.Sequence(seqFile)
+            # The modification time db is shared by every node, WAL only works on one host.
+            self.job.sequence.modTimeDBJournalMode = 'DELETE'
+            if job.smartUpdate:
+                self.migrateModTimeDB()
             logger.info('Job Options Loaded Successfully')
             
         logger.debug('Job after loading all options: \n' + str(job)) 
@@ -182,26 +221,57 @@ class Control:
     def getSequence(self):
         return self.job.sequence
 
-    def getSegments(self, segmentNameList=[]):
+    def loadAgenda(self):
         '''
-        Load the all segments from the qube job object.
+        Fetch the job's agenda from the supervisor and index the subjobs by name.
+        Query times are logged, since every fetch is a supervisor query
+        for the whole agenda.
         '''
 
+        startTime = time.time()
         agenda = qb.jobinfo(id=self.job.qubejob['id'], agenda=True)[0]['agenda']
-        if (agenda == {}):
+        elapsed = time.time() - startTime
+        self.agendaQueries += 1
+        self.agendaQuerySeconds += elapsed
+        logger.info('Loaded agenda of %s subjobs in %.3fs (%s queries, %.3fs total)' %
+                        (len(agenda), elapsed, self.agendaQueries, self.agendaQuerySeconds))
+
+        self.agenda = list(agenda)
+        self.agendaIndex = dict((subjob['name'], subjob) for subjob in self.agenda)
+
+    def isAgendaStale(self, segmentNameList):
+        '''
+        Check if any of the subjobs weren't complete when the agenda was
+        loaded.  Complete subjobs' result packages don't change, so
+        those are the only ones that need to be fetched again.
+        '''
+
+        if self.agendaIndex is None:
+            return True
+        for name in segmentNameList:
+            subjob = self.agendaIndex.get(name)
+            if subjob is None or subjob.get('status') != 'complete':
+                return True
+        return False
+
+    def getSegments(self, segmentNameList=[]):
+        '''
+        Load the segments from the qube job object, all of them if
+        no names are supplied.
+        The agenda is fetched once for each process, and only fetched
+        again if the requested segments weren't complete yet.
+        '''
+
+        if segmentNameList == [] or self.isAgendaStale(segmentNameList):
+            self.loadAgenda()
+
+        if not self.agenda:
             logger.error('Job missing agenda')
             return None
-            
-        else:
-            segments = []
-            for subjob in agenda:
-                if segmentNameList != []:
-                    if subjob['name'] in segmentNameList:
-                        segments.append(subjob)
-                else:
-                    segments.append(subjob)
 
-            return segments
+        if segmentNameList == []:
+            return list(self.agenda)
+        return [self.agendaIndex[name] for name in segmentNameList if name in self.agendaIndex]
 
     def getCurrentSegment(self, work):
         '''
@@ -213,21 +283,176 @@ class Control:
 
         return segments
 
+    def getDependencyFolder(self, name=''):
+        '''
+        Returns the folder counting the completed inputs of a dependant subjob,
+        or the job's folder holding all of them if no name is supplied.
+        '''
+
+        result = os.path.join(self.job.transcoderFolder, DEPENDENCYFOLDER, str(self.getQubeJobObject().get('id', '')))
+        if name:
+            result = os.path.join(result, self.getDependencyMarker(name))
+        return result
+
+    def getDependencyMarker(self, name):
+        return name.replace(':', '_').replace('/', '_')
+
+    def resetDependencies(self):
+        '''
+        Clear the inputs counted by a previous run of the job.
+        '''
+
+        shutil.rmtree(self.getDependencyFolder(), ignore_errors=True)
+
+    def completeDependency(self, work):
+        '''
+        Count a completed segment or merge towards the subjob that depends
+        on it, and unblock that subjob once all of its inputs are complete.
+        Each input leaves a marker in the dependant's folder after reporting
+        its work, so the input that completes the set always sees the others.
+        Only markers named like a segment or merge subjob are counted,
+        other files the share leaves in the folder are ignored.
+        Returns True if the dependant was unblocked.
+        '''
+
+        package = work.get('package', {})
+        dependant = package.get('dependantSubjob')
+        inputCount = int(package.get('dependantInputs', 0))
+        if not dependant or not inputCount:
+            return False
+
+        folder = self.getDependencyFolder(dependant)
+        try:
+            self.makeFolders(folder)
+            open(os.path.join(folder, self.getDependencyMarker(work['name'])), 'w').close()
+            completed = [name for name in os.listdir(folder) if dependencyMarkerPattern.match(name)]
+        except (IOError, OSError) as e:
+            logger.warning('Unable to count %s towards %s: %s' % (work['name'], dependant, e))
+            self.dependencyErrors = True
+            return False
+
+        logger.info('%s of %s inputs of %s complete' % (len(completed), inputCount, dependant))
+        if len(completed) < inputCount:
+            return False
+        self.unblockSubjobs([dependant])
+        return True
+
+    def isDependencySweepDue(self):
+        '''
+        Check if this process should sweep the agenda for missed dependants.
+        It's due when this process couldn't count one of its inputs.
+        Otherwise only one process of the job sweeps in each
+        DEPENDENCYSWEEPINTERVAL, the first to create that interval's stamp.
+        '''
+
+        if self.dependencyErrors:
+            return True
+
+        stamp = os.path.join(self.getDependencyFolder(), 'sweep.%d' % (time.time() // DEPENDENCYSWEEPINTERVAL))
+        try:
+            self.makeFolders(os.path.dirname(stamp))
+            os.close(os.open(stamp, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                logger.warning('Unable to stamp the dependency sweep %s: %s' % (stamp, e))
+            return False
+        return True
+
+    def unblockReadySubjobs(self):
+        '''
+        Unblock every blocked merge and output whose inputs are all complete.
+        This catches dependants missed when a worker stopped between
+        reporting its work and counting it, at the cost of one agenda query,
+        so it's only run when isDependencySweepDue.
+        Returns the number of subjobs unblocked.
+        '''
+
+        if not self.isDependencySweepDue():
+            return 0
+        self.dependencyErrors = False
+
+        self.loadAgenda()
+        ready = []
+        for subjob in self.agenda:
+            inputs = subjob.get('package', {}).get('segmentSubjobs')
+            if subjob.get('status') != 'blocked' or not inputs:
+                continue
+            if not self.isAgendaStale(inputs):
+                ready.append(subjob['name'])
+
+        if ready:
+            self.unblockSubjobs(ready)
+        return len(ready)
+
+    def unblockSubjobs(self, names):
+        jobID = self.getQubeJobObject().get('id', '')
+        for name in names:
+            logger.info('Unblocking ' + name)
+            qb.workunblock('%s:%s' % (jobID, name))
+        qb.unblock(jobID)
+
     def getModTimeDBFile(self):
         '''
-        Get the filepath to the modification database file.
+        Get the path to the modification times of the sequence.
         This contains the modification times for the latest renders of a sequence.
         Later this can be compared to find changes in the sequence.
+        It's a folder of manifest shards, one for each segment, so
+        segments saving at the same time never share a file.
         '''
 
         result = self.job.sequence.folder + '/' + MODTIMEDBFILEPREFIX
         result += os.path.splitext(os.path.basename(self.job.sequence.initFile))[0]
-        result += '.db'
+        result += sequenceTools.SHARDEXTENSION
         return result
 
+    def getLegacyModTimeDBFile(self):
+        '''
+        Get the path of the sqlite modification time database
+        shared by every segment before the shards.
+        '''
+
+        return os.path.splitext(self.getModTimeDBFile())[0] + '.db'
+
+    def migrateModTimeDB(self):
+        '''
+        Move the modification times and segment layouts
+        of a legacy database into the shards, once.
+        '''
+
+        def migrateLayouts(db):
+            tables = [row[0] for row in db.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+            if 'segmentLayouts' in tables:
+                for frameRange, segmentFile, layout in db.conn.execute('SELECT frameRange, segmentFile, layout FROM segmentLayouts'):
+                    self.writeSegmentLayout(frameRange, str(segmentFile), json.loads(layout))
+
+        try:
+            sequenceTools.migrateModTimeDB(self.getLegacyModTimeDBFile(), self.getModTimeDBFile(),
+                                            self.job.sequence.modTimeDBJournalMode, migrateLayouts)
+        except Exception as e:
+            logger.warning('Unable to migrate the modification time database: %s' % e)
+
+    def compactModTimeDB(self):
+        '''
+        Merge the shards of the modification times back into one.
+        '''
+
+        try:
+            sequenceTools.ShardedManifest(self.getModTimeDBFile()).compact()
+        except (IOError, OSError) as e:
+            logger.warning('Unable to compact the modification times: %s' % e)
+
     def getSmartUpdate(self):
         return self.job.smartUpdate
 
+    def getSmartUpdateHashes(self):
+        return self.job.smartUpdateHashes
+
+    def getPersistentBlender(self):
+        return self.job.persistentBlender
+
+    def getPrefetch(self):
+        return self.job.prefetch
+
     def getQubeJobObject(self):
         return self.job.qubejob
 
@@ -274,19 +499,14 @@ class Control:
         Template: blender -b blendfile -x 1 -s startFrame -e endFrame -o outputFile -a
         '''
 
-        workPkg = work.setdefault('package', {})
-
-        segmentFile = workPkg.get('segmentFile', '')
-        segmentFile = self.getValidOutputPath(segmentFile)
+        cmd = None
+        startFrame, endFrame, segmentFile = self.getSegmentSettings(work)
         
         if segmentFile:
             cmd = '\'' + BLENDERLOCATION + '\''
             cmd += ' -b \'' + self.getBlendFile() + '\''
             cmd += ' -x 1' # Use an extension on the end of the file
 
-            ''' Get the start and end frames from the work item name. '''
-            startFrame, endFrame = workPkg.get('frameRange', '').split('-')
-
             cmd += ' -s ' + startFrame
             cmd += ' -e ' + endFrame
             cmd += ' -o ' + segmentFile
@@ -294,6 +514,499 @@ class Control:
 
         return cmd
 
+    def getSegmentSettings(self, work):
+        '''
+        Returns the (startFrame, endFrame, segmentFile) to render a segment.
+        Segments are rendered to the scratch folder when it has room,
+        publishSegment then moves them to the share.
+        segmentFile is None if there isn't a valid output path.
+        '''
+
+        workPkg = work.setdefault('package', {})
+
+        segmentFile = self.getRenderFile(workPkg.get('segmentFile', ''))
+
+        ''' Get the start and end frames from the work item name. '''
+        startFrame, endFrame = workPkg.get('frameRange', '').split('-')
+
+        return startFrame, endFrame, segmentFile
+
+    def getScratchFolder(self):
+        '''
+        Returns this subjob's folder under SCRATCHFOLDER on the local disk,
+        or None if it can't be created.  Stale scratch of other jobs is
+        cleaned up the first time it's used.
+        '''
+
+        if self.scratchFolder is None:
+            qubeJob = self.getQubeJobObject()
+            folder = os.path.join(SCRATCHFOLDER, '%s.%s' % (qubeJob.get('id', ''), qubeJob.get('subid', '')))
+            try:
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                self.scratchFolder = folder
+                self.cleanScratch()
+            except OSError as e:
+                logger.warning('Unable to create the scratch folder %s, rendering to the share. %s' % (folder, e))
+                self.scratchFolder = ''
+
+        return self.scratchFolder or None
+
+    def cleanScratch(self):
+        '''
+        Remove scratch folders that haven't been used for SCRATCHSTALEAGE,
+        left behind by jobs that crashed or were killed.
+        '''
+
+        now = time.time()
+        for name in os.listdir(SCRATCHFOLDER):
+            path = os.path.join(SCRATCHFOLDER, name)
+            if path == self.scratchFolder:
+                continue
+            try:
+                if now - os.path.getmtime(path) < SCRATCHSTALEAGE:
+                    continue
+                logger.info('Removing stale scratch ' + path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                logger.warning('Unable to remove stale scratch %s: %s' % (path, e))
+
+    def getFreeSpace(self, folder):
+        try:
+            stats = os.statvfs(folder)
+        except (AttributeError, OSError):
+            return None
+        return stats.f_bavail * stats.f_frsize
+
+    def getScratchFile(self, outputFile):
+        '''
+        Returns the path to render an output file to in the scratch folder,
+        or None if there's no scratch folder or not enough free space for it.
+        The last version of the output is used to estimate its size.
+        '''
+
+        folder = self.getScratchFolder()
+        if folder is None:
+            return None
+
+        expectedBytes = 0
+        if os.path.exists(outputFile):
+            expectedBytes = os.path.getsize(outputFile)
+        freeBytes = self.getFreeSpace(folder)
+        if freeBytes is not None and freeBytes < SCRATCHMINFREEBYTES + expectedBytes:
+            logger.warning('Only %s free in the scratch folder, rendering to the share.' %
+                            sequenceTools.formatBytes(freeBytes))
+            return None
+
+        os.utime(folder, None)
+        result = os.path.join(folder, os.path.basename(outputFile))
+        if os.path.exists(result):
+            os.remove(result)
+        return result
+
+    def getRenderFile(self, outputFile):
+        '''
+        Returns the path to render an output file to, in the scratch folder
+        when it has room, otherwise a valid path on the share.
+        None if there isn't a valid output path.
+        '''
+
+        renderFile = self.getScratchFile(outputFile)
+        if renderFile is None:
+            renderFile = self.getValidOutputPath(outputFile)
+        self.renderFiles[outputFile] = renderFile
+        return renderFile
+
+    def publishSegment(self, work):
+        return self.publishFile(work['package']['segmentFile'])
+
+    def publishFile(self, outputFile):
+        '''
+        Copy a file rendered in the scratch folder to its path on the
+        share, limited to PUBLISHMBPS.  The copy is renamed over any
+        existing file, so it's replaced in one step and readers
+        never see a partial movie.
+        Returns the path of the file, or None if it couldn't be published.
+        '''
+
+        renderFile = self.renderFiles.pop(outputFile, outputFile)
+        if not self.scratchFolder or os.path.dirname(renderFile) != self.scratchFolder:
+            return renderFile
+
+        startTime = time.time()
+        try:
+            self.makeFolders(os.path.dirname(outputFile))
+            sequenceTools.copyFile(renderFile, outputFile, mbps=PUBLISHMBPS)
+            os.remove(renderFile)
+        except (IOError, OSError) as e:
+            logger.error('Unable to publish %s to %s: %s' % (renderFile, outputFile, e))
+            return None
+        logger.info('Published %s in %.1fs' % (os.path.basename(outputFile), time.time() - startTime))
+        return outputFile
+
+    def removeScratch(self):
+        '''
+        Remove this subjob's scratch folder.
+        '''
+
+        if self.scratchFolder:
+            shutil.rmtree(self.scratchFolder, ignore_errors=True)
+            self.scratchFolder = None
+
+    def getWorkerCMD(self, port, token):
+        '''
+        Returns the command to start a persistent blender worker
+        that connects back on the supplied port.
+
+        Template: blender -b blendfile -P Blender_Worker.py -- port token
+        '''
+
+        cmd = '\'' + BLENDERLOCATION + '\''
+        cmd += ' -b \'' + self.getBlendFile() + '\''
+        cwd = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        cmd += ' -P \'' + cwd + '/' + BLENDERWORKERSCRIPT + '\''
+        cmd += ' -- ' + str(port) + ' ' + token
+
+        return cmd
+
+    def renderSegmentWithWorker(self, work):
+        '''
+        Render a segment with the persistent blender worker,
+        starting it if needed.
+        Returns blender's return code, or None if the worker failed
+        and the segment should be rendered with getSegmentCMD instead.
+        The worker isn't used again after a failure.
+        '''
+
+        startFrame, endFrame, segmentFile = self.getSegmentSettings(work)
+        if not segmentFile:
+            return None
+
+        def progress(frame):
+            logger.info('Rendered frame %s' % frame)
+
+        try:
+            if self.blenderWorker is None:
+                self.blenderWorker = BlenderWorker.BlenderWorker(self)
+                self.blenderWorker.start()
+            return self.blenderWorker.render(startFrame, endFrame, segmentFile, progress)
+        except BlenderWorker.BlenderWorkerError as e:
+            logger.warning('Persistent blender failed, rendering segments one at a time. %s' % e)
+            self.closeBlenderWorker()
+            self.job.persistentBlender = False
+            return None
+
+    def closeBlenderWorker(self):
+        if self.blenderWorker is not None:
+            self.blenderWorker.close()
+            self.blenderWorker = None
+
+    def getNextSegmentRange(self, work):
+        '''
+        Predict the frame range of the segment this worker is most
+        likely to transcode next, the one right after this segment.
+        '''
+
+        startFrame, endFrame = work.get('package', {}).get('frameRange', '').split('-')
+        startFrame, endFrame = int(startFrame), int(endFrame)
+        return sequenceTools.FrameSet.fromRange(endFrame + 1, endFrame + (endFrame - startFrame + 1))
+
+    def startPrefetch(self, work):
+        '''
+        Read the next segment's frames into the page cache
+        in the background while this segment encodes.
+        '''
+
+        if not self.job.prefetch:
+            return
+        if self.prefetcher is None:
+            self.prefetcher = sequenceTools.Prefetcher(self.job.sequence)
+        self.prefetcher.start(self.getNextSegmentRange(work))
+
+    def logPrefetch(self, encodeStart, encodeEnd):
+        '''
+        Log how far the prefetch got and how long it ran during the encode.
+        '''
+
+        if self.prefetcher is not None:
+            overlap = self.prefetcher.getOverlap(encodeStart, encodeEnd)
+            logger.info('%s, %.1fs overlapped with encoding.' % (self.prefetcher, overlap))
+
+    def checkPrefetch(self, frameRange):
+        '''
+        Stop prefetching, since the new segment needs the bandwidth,
+        and log how many of its frames were prefetched.
+        '''
+
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+            hits = self.prefetcher.getPrefetched() & frameRange
+            logger.info('%s of %s frames were prefetched.' % (len(hits), len(frameRange)))
+
+    def stopPrefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+
+    def recordSegmentTiming(self, frameRange, seconds):
+        '''
+        Add how long a segment took to encode to the timings
+        the segmentPlanner uses to size future jobs.
+        '''
+
+        if self.frameScan is None:
+            self.frameScan = segmentPlanner.scanSequence(self.job.sequence, frameRange)
+        pixels, bytesPerFrame = self.frameScan
+        timingsFile = segmentPlanner.getTimingsFile(os.path.dirname(self.job.preset))
+        segmentPlanner.recordTiming(timingsFile, self.job.preset, len(frameRange), seconds, pixels, bytesPerFrame)
+
+    def getSegmentRange(self, work):
+        '''
+        Returns the (startFrame, endFrame) of a segment as integers.
+        '''
+
+        startFrame, endFrame = work.get('package', {}).get('frameRange', '').split('-')
+        return int(startFrame), int(endFrame)
+
+    def getSegmentLayoutFile(self, frameRange):
+        '''
+        Segment layouts are stored next to the modification time shards.
+        Ex: .DATA.shot.0001.shards/1-200.layout
+        '''
+
+        return os.path.join(self.getModTimeDBFile(), frameRange + SEGMENTLAYOUTEXTENSION)
+
+    def loadSegmentLayout(self, work):
+        '''
+        Load the layout of a segment's last transcode.
+        Returns (segmentFile, layout) where the layout is a list of
+        [startFrame, endFrame, partFile, partStartFrame] for each part
+        the segment movie was spliced from.
+        Segments without a stored layout are a single part
+        rendered to the package's segmentFile.
+        '''
+
+        layoutFile = self.getSegmentLayoutFile(work.get('package', {}).get('frameRange', ''))
+        stored = None
+        if os.path.exists(layoutFile):
+            try:
+                f = open(layoutFile, 'r')
+                try:
+                    stored = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError) as e:
+                logger.warning('Unable to load the segment layout: %s' % e)
+
+        if stored:
+            return str(stored['segmentFile']), [[start, end, str(partFile), partStart]
+                                                    for start, end, partFile, partStart in stored['layout']]
+
+        segmentFile = work.get('package', {}).get('segmentFile', '')
+        startFrame, endFrame = self.getSegmentRange(work)
+        return segmentFile, [[startFrame, endFrame, segmentFile, startFrame]]
+
+    def saveSegmentLayout(self, work, segmentFile, layout):
+        self.writeSegmentLayout(work['package']['frameRange'], segmentFile, layout)
+
+    def writeSegmentLayout(self, frameRange, segmentFile, layout):
+        '''
+        Write the layout to a temporary file and rename it into place.
+        '''
+
+        layoutFile = self.getSegmentLayoutFile(frameRange)
+        self.makeFolders(os.path.dirname(layoutFile))
+        tempFile = '%s.%s.tmp' % (layoutFile, os.getpid())
+        f = open(tempFile, 'w')
+        try:
+            json.dump({'segmentFile': segmentFile, 'layout': layout}, f)
+        finally:
+            f.close()
+        sequenceTools.replaceFile(tempFile, layoutFile)
+
+    def formatSegmentLayout(self, layout):
+        '''
+        Format a segment layout for the result package.
+        Ex: 1-20:Segment1.mov,21-40:Segment1_21-40.mov
+        '''
+
+        return ','.join('%s-%s:%s' % (startFrame, endFrame, os.path.basename(partFile))
+                            for startFrame, endFrame, partFile, partStart in layout)
+
+    def getSegmentLayoutExists(self, segmentFile, layout):
+        '''
+        Check that the segment movie and every part it was spliced from exist.
+        '''
+
+        if not os.path.exists(segmentFile):
+            return False
+        for startFrame, endFrame, partFile, partStart in layout:
+            if not os.path.exists(partFile):
+                return False
+        return True
+
+    def getChangedSpans(self, changedFrames):
+        '''
+        Group changed frames into [startFrame, endFrame] spans.
+        Changes closer than SUBSEGMENTMERGEGAP frames share a span,
+        each extra part costs a blender start and a splice point.
+        '''
+
+        spans = []
+        for startFrame, endFrame, step in changedFrames.getIntervals():
+            if spans and startFrame - spans[-1][1] <= SUBSEGMENTMERGEGAP:
+                spans[-1][1] = endFrame
+            else:
+                spans.append([startFrame, endFrame])
+        return spans
+
+    def getPartFile(self, work, startFrame, endFrame, usedFiles):
+        '''
+        Returns a path for a part of a segment that no other part uses.
+        Ex: Segment1.mov -> Segment1_21-40.mov
+        '''
+
+        inName, inExt = os.path.splitext(work['package']['segmentFile'])
+        result = inName + '_' + str(startFrame) + '-' + str(endFrame) + inExt
+        count = 0
+        while result in usedFiles:
+            count += 1
+            result = inName + '_' + str(startFrame) + '-' + str(endFrame) + '_' + str(count) + inExt
+        return result
+
+    def getSplicedSegmentFile(self, work):
+        '''
+        Returns the path for a segment movie spliced together from its
+        parts.  It's never used as a part itself, so it can be replaced
+        while the parts are still in use.
+        '''
+
+        inName, inExt = os.path.splitext(work['package']['segmentFile'])
+        return inName + '_Spliced' + inExt
+
+    def planSegmentUpdate(self, work, changedFrames, layout):
+        '''
+        Plan transcoding only the changed frames of a segment.
+        The segment is split at the changed spans, which are transcoded
+        into new parts, while the rest of the frames keep coming from
+        the existing parts.
+        Returns (layout, renderParts), or None if the whole segment
+        should be transcoded instead.
+        '''
+
+        if self.getFrameRate() is None:
+            logger.info('Frame rate of the scene is unknown, transcoding the whole segment.')
+            return None
+
+        startFrame, endFrame = self.getSegmentRange(work)
+        segmentFrames = sequenceTools.FrameSet.fromRange(startFrame, endFrame)
+
+        ''' Frames the past layout doesn't cover have to be transcoded too. '''
+        covered = sequenceTools.FrameSet()
+        for partStart, partEnd, partFile, fileStart in layout:
+            covered = covered | sequenceTools.FrameSet.fromRange(partStart, partEnd)
+        changedFrames = (changedFrames | (segmentFrames - covered)) & segmentFrames
+
+        spans = self.getChangedSpans(changedFrames)
+        renderFrames = sum(end - start + 1 for start, end in spans)
+        if not spans or renderFrames > len(segmentFrames) * SUBSEGMENTMAXRATIO:
+            return None
+
+        ''' Keep the pieces of the past parts outside of the changed spans. '''
+        changed = sequenceTools.FrameSet()
+        for start, end in spans:
+            changed = changed | sequenceTools.FrameSet.fromRange(start, end)
+        newLayout = []
+        for partStart, partEnd, partFile, fileStart in layout:
+            kept = sequenceTools.FrameSet.fromRange(partStart, partEnd) - changed
+            for start, end, step in kept.getIntervals():
+                newLayout.append([start, end, partFile, fileStart])
+
+        usedFiles = set(part[2] for part in newLayout)
+        renderParts = []
+        for start, end in spans:
+            partFile = self.getPartFile(work, start, end, usedFiles)
+            usedFiles.add(partFile)
+            part = [start, end, partFile, start]
+            newLayout.append(part)
+            renderParts.append(part)
+        newLayout.sort()
+
+        if len(newLayout) > SUBSEGMENTMAXPARTS:
+            logger.info('Segment would be spliced from %s parts, transcoding all of it.' % len(newLayout))
+            return None
+        return newLayout, renderParts
+
+    def getPartWork(self, work, part):
+        '''
+        Returns a work item to transcode one part of a segment
+        with getSegmentCMD or renderSegmentWithWorker.
+        '''
+
+        startFrame, endFrame, partFile, partStart = part
+        return {'name': work['name'],
+                'package': {'frameRange': '%s-%s' % (startFrame, endFrame), 'segmentFile': partFile}}
+
+    def getFrameRate(self):
+        '''
+        Returns the frame rate of the blender scene, recorded next to
+        the blender file when it was initialized, or None if it's unknown.
+        '''
+
+        if self.frameRate is None:
+            frameRateFile = self.getBlendFile() + FRAMERATEEXTENSION
+            try:
+                f = open(frameRateFile)
+                try:
+                    self.frameRate = float(f.read().strip())
+                finally:
+                    f.close()
+            except (IOError, ValueError) as e:
+                logger.warning('Unable to load the frame rate from %s: %s' % (frameRateFile, e))
+                return None
+        return self.frameRate
+
+    def getSpliceCMD(self, layout, outputFile, frameRate=None):
+        '''
+        Returns the command to splice a segment back together from its parts.
+        Each part is trimmed to its frames with in and out points,
+        using the frame rate of the blender scene if none is supplied.
+
+        Command Template:
+            catmovie -o outputFile - part1 -in SECONDS -out SECONDS part2 -in SECONDS -out SECONDS
+        '''
+
+        if frameRate is None:
+            frameRate = self.getFrameRate()
+
+        cmd = '\'' + CATMOVIELOCATION + '\''
+        cmd += ' -o \'' + outputFile + '\''
+        cmd += ' -'
+        for startFrame, endFrame, partFile, partStart in layout:
+            inTime = float(startFrame - partStart) / frameRate
+            outTime = float(endFrame - partStart + 1) / frameRate
+            cmd += ' \'' + partFile + '\' -in %.6f -out %.6f' % (inTime, outTime)
+
+        return cmd
+
+    def removeUnusedParts(self, pastFiles, layout, segmentFile):
+        '''
+        Delete the files of a past transcode that the new layout doesn't use.
+        '''
+
+        used = set(part[2] for part in layout)
+        used.add(segmentFile)
+        for path in set(pastFiles) - used:
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                    logger.debug('Removed unused segment part ' + path)
+                except OSError as e:
+                    logger.warning('Unable to remove unused segment part %s: %s' % (path, e))
+
     def getFinalOutputCMD(self, segmentOutputPaths, finalOutputPath, startFrame,
                         frameRate, work):
         '''
@@ -338,6 +1051,23 @@ class Control:
         
         return cmd
 
+    def getMergeCMD(self, segmentOutputPaths, mergeFile):
+        '''
+        Returns the command to concatenate segments, or the merges
+        of a lower level, into a reference movie for a merge subjob.
+        Audio and self-contained movies are left to the final output.
+
+        Command Template:
+            catmovie -o mergeFile - (Segments)
+        '''
+
+        cmd = '\'' + CATMOVIELOCATION + '\''
+        cmd += ' -o \'' + mergeFile + '\''
+        cmd += ' - '
+        cmd += ' '.join('\'' + path + '\'' for path in segmentOutputPaths)
+
+        return cmd
+
     def checkSegmentsForChanges(self, segments):
         '''
         Takes a list of segment subjobs and checks the result package of each
@@ -24,7 +24,10 @@ class Job:
 
         self.selfContained = True
         self.smartUpdate = True
+        self.smartUpdateHashes = False
         self.fillMissingFrames = False
+        self.persistentBlender = False
+        self.prefetch = True
 
         ''' Other Settings '''
         self.qubejob = {}
@@ -32,6 +32,7 @@ import inspect
 import logging
 import shlex
 import subprocess
+import time
 
 sys.path.append('/Applications/pfx/qube/api/python/')
 import qb
@@ -102,6 +103,40 @@ def runCMD(cmd):
     return proc.returncode
 
 
+def transcodeSegment(control, work, recordTiming=True):
+    '''
+    Transcode the frame range of a segment work item with blender
+    and publish it to the share.
+    Only whole segments are timed for the segmentPlanner, a part of a
+    few frames is mostly blender startup and would inflate the cost per frame.
+    Returns the exit code and the path of the segment.
+    '''
+
+    frameRange = sequenceTools.loadFrameRange(work['package']['frameRange'])
+    encodeStart = time.time()
+    returnCode = None
+    if control.getPersistentBlender():
+        returnCode = control.renderSegmentWithWorker(work)
+    if returnCode is None:
+        cmd = control.getSegmentCMD(work)
+        if cmd:
+            returnCode = runCMD(cmd)
+        else:
+            logger.error('Unable to find valid output path.')
+            returnCode = 1
+    encodeEnd = time.time()
+    control.logPrefetch(encodeStart, encodeEnd)
+
+    segmentFile = None
+    if returnCode == 0:
+        if recordTiming:
+            control.recordSegmentTiming(frameRange, encodeEnd - encodeStart)
+        segmentFile = control.publishSegment(work)
+        if not segmentFile:
+            returnCode = 1
+    return returnCode, segmentFile
+
+
 def executeJob(control):
     '''
     Execute the transcoding process.
@@ -125,6 +160,8 @@ def executeJob(control):
                 pending -- preempted, so bail out
                 blocked -- perhaps item is part of a dependency
                 '''
+                if agendaItem['status'] == 'blocked' and control.unblockReadySubjobs():
+                    continue
                 jobstate = agendaItem['status']
                 logger.info('Job %s state is now %s' % (qbJob['id'], jobstate))
                 break
@@ -135,12 +172,16 @@ def executeJob(control):
                     Setup the blender scene.
                 Segment
                     Transcode a segment of frames.
+                Merge
+                    Concatenate a few segments, or merges, together.
                 Final Output
                     Merge that output's segments together with audio.
             '''
             if agendaItem['name'] == 'Initialize':
                 logger.info('Initializing...\n')
 
+                control.resetDependencies()
+
                 if os.path.exists(control.getBlendFile()):
                     logger.info("Initialization script alread exists.")
                     returnCode = 0
@@ -167,18 +208,32 @@ def executeJob(control):
                             > Check if the Modification Times Database and the output file exists.
                                 True
                                     > Check if there have been modifications to any frames in this segment.
+                                    With smartUpdateHashes, only frames whose content hash changed count.
                                         True
-                                            > Continue with transcode
+                                            > Check if the changes are a small part of the segment.
+                                                True
+                                                    > Transcode only the changed spans into new parts
+                                                    > Splice the parts back together with catmovie
+                                                    > Remove parts that are no longer used
+                                                    > Save the part layout and modification times
+                                                False
+                                                    > Continue with transcode
                                         False
                                             > Skip transcoding
+                                            > Save new modification times for frames with unchanged contents
                     > Check if we are still transcoding.
                         True
-                            > Try to Remove output file if it already exists
-                                Success
-                                    > Transcode
-                                Failure
-                                    > Add '_' to the output file name and try again until sucess.
-                                        Max retry is 3 times, then fail the subjob.
+                            > Check if the node's scratch folder has enough free space.
+                                True
+                                    > Transcode into the scratch folder
+                                    > Copy to the share and rename over the existing output file
+                                False
+                                    > Try to Remove output file if it already exists
+                                        Success
+                                            > Transcode
+                                        Failure
+                                            > Add '_' to the output file name and try again until sucess.
+                                                Max retry is 3 times, then fail the subjob.
                     > Check if smartUpdate is turned on.
                         True
                             > Update the modification times database
@@ -202,13 +257,14 @@ def executeJob(control):
                     logging.debug("FrameRangeString: %s" % frameRangeString)
                     frameRange = sequenceTools.loadFrameRange(frameRangeString)
                     logging.debug("Loaded frameRange: %s" % frameRange)
+                    control.checkPrefetch(frameRange)
 
                     ''' Check for Missing Frames '''
                     mySequence = control.getSequence()
                     missingFrames = mySequence.getMissingFrames(frameRange)
 
                     if len(missingFrames) > 0:
-                        logger.error('Missing frames!\n' + ','.join(missingFrames))
+                        logger.error('Missing frames!\n' + mySequence.convertListToRanges(missingFrames))
                         error = True
                     else:
                         logger.info('No Missing Frames')
@@ -218,82 +274,176 @@ def executeJob(control):
                     ''' Variables used multiple times '''
                     segmentFilePath = agendaItem.setdefault('package', {}).get('segmentFile', '')
                     segmentFileExists = os.path.exists(segmentFilePath)
-                    currentModTimes = {}
+                    currentSnapshot = None
+                    pastSnapshot = None
+                    useHashes = control.getSmartUpdateHashes()
                     modTimeDBFile = control.getModTimeDBFile()
+                    pastLayout = None
+                    pastFiles = []
+                    layout = None
+                    update = None
 
                     if control.getSmartUpdate():
 
                         modTimeDBFileExists = os.path.exists(modTimeDBFile)
+                        if modTimeDBFileExists:
+                            segmentFilePath, pastLayout = control.loadSegmentLayout(agendaItem)
+                            segmentFileExists = control.getSegmentLayoutExists(segmentFilePath, pastLayout)
+                            pastFiles = [part[2] for part in pastLayout] + [segmentFilePath]
 
                         logger.debug('Segment Output: ' + str(segmentFilePath))
                         logger.debug('Segment Exists: ' + str(segmentFileExists))
+                        logger.debug('Segment Layout: ' + str(pastLayout))
                         logger.debug('ModTimeDBFile: ' + str(modTimeDBFile))
                         logger.debug('ModTimeDBFile Exists: ' + str(modTimeDBFileExists))
 
                         if segmentFileExists and modTimeDBFileExists:
                             logger.info('Smart Updating')
 
+                            logger.debug('Loading past modification times...')
+                            pastSnapshot = mySequence.loadSnapshot(modTimeDBFile, frameRange)
+
                             logger.debug('Loading current modification times...')
-                            currentModTimes = mySequence.getModTimes(frameRange)
-                            logger.debug('Current modication times loaded. %s' % currentModTimes)
+                            currentSnapshot = mySequence.getSnapshot(frameRange, useHashes, pastSnapshot)
+                            logger.debug('Current modication times loaded for %s frames.' % len(currentSnapshot))
 
                             logger.debug('Comparing modification times for frame range %s...' % frameRange)
-                            compare = mySequence.compare(modTimeDBFile, frameRange, currentModTimes=currentModTimes)
+                            compare = currentSnapshot.diff(pastSnapshot, useHashes)
                             logger.debug('Sequence Differences: %s' % str(compare))
 
                             differences = ''
-                            if len(compare['Added']) > 0:
-                                frameNumbers = mySequence.getFramesFromFilenames(compare['Added'])
-                                differences += '\n\tAdded: %s' % mySequence.convertListToRanges(frameNumbers)
-                            if len(compare['Deleted']) > 0:
-                                frameNumbers = mySequence.getFramesFromFilenames(compare['Deleted'])
-                                differences += '\n\tDeleted: %s' % mySequence.convertListToRanges(frameNumbers)
-                            if len(compare['Modified']) > 0:
-                                frameNumbers = mySequence.getFramesFromFilenames(compare['Modified'])
-                                differences += '\n\tModified: %s' % mySequence.convertListToRanges(frameNumbers)    
+                            if compare['Added']:
+                                differences += '\n\tAdded: %s' % compare['Added']
+                            if compare['Deleted']:
+                                differences += '\n\tDeleted: %s' % compare['Deleted']
+                            if compare['Modified']:
+                                differences += '\n\tModified: %s' % compare['Modified']
                             
                             if differences:
                                 logger.info('Sequence Differences: %s' % differences)
                                 render = True
 
+                                changedFrames = compare['Added'] | compare['Deleted'] | compare['Modified']
+                                update = control.planSegmentUpdate(agendaItem, changedFrames, pastLayout)
+
                         else:
                             render = True
 
                     else:
                         render = True
 
-                    if render:
-                        segmentFilePath = control.getValidOutputPath(segmentFilePath)
-                        if segmentFilePath:
-                            render = True
-                        else:
-                            error = True
+                    if render and update:
+                        ''' Transcode only the changed spans, then splice the segment back together. '''
+                        layout, renderParts = update
+                        logger.info('Transcoding frames %s of segment %s' %
+                                        (', '.join('%s-%s' % (part[0], part[1]) for part in renderParts), agendaItem['name']))
+                        control.startPrefetch(agendaItem)
+                        for part in renderParts:
+                            returnCode, part[2] = transcodeSegment(control, control.getPartWork(agendaItem, part), recordTiming=False)
+                            if returnCode != 0:
+                                break
+
+                        if returnCode == 0:
+                            splicedFile = control.getSplicedSegmentFile(agendaItem)
+                            splicedRenderPath = control.getRenderFile(splicedFile)
+                            if splicedRenderPath:
+                                returnCode = runCMD(control.getSpliceCMD(layout, splicedRenderPath))
+                                if returnCode == 0:
+                                    splicedFilePath = control.publishFile(splicedFile)
+                                    if not splicedFilePath:
+                                        returnCode = 1
+                            else:
+                                error = True
+                                returnCode = 1
+                        logger.info('Transcoding Segment Complete! (' + str(returnCode) + ')')
+
+                        if returnCode == 0:
+                            control.removeUnusedParts(pastFiles, layout, splicedFilePath)
+                            segmentFilePath = splicedFilePath
+                            control.saveSegmentLayout(agendaItem, segmentFilePath, layout)
+                            mySequence.saveSnapshot(modTimeDBFile, currentSnapshot, frameRange)
+                            logger.info("Saved Modification Times")
 
-                    if render:
+                    elif render:
                         logger.info('Transcoding Segment %s' % agendaItem['name'])
-                        cmd = control.getSegmentCMD(agendaItem)
-                        returnCode = runCMD(cmd)
+                        control.startPrefetch(agendaItem)
+                        returnCode, renderedFilePath = transcodeSegment(control, agendaItem)
+                        if returnCode == 0:
+                            segmentFilePath = renderedFilePath
                         logger.info('Transcoding Segment Complete! (' + str(returnCode) + ')')
 
                         if control.getSmartUpdate():
-                            logger.debug("Saved ModTimes: " + str(currentModTimes))
-                            control.job.sequence.saveModTimes(modTimeDBFile,
-                                modTimeDict=currentModTimes, frameRange=frameRange)
-                            logger.info("Saved Modification Times")
+                            if returnCode == 0:
+                                if currentSnapshot is None:
+                                    currentSnapshot = mySequence.getSnapshot(frameRange, useHashes)
+                                mySequence.saveSnapshot(modTimeDBFile, currentSnapshot, frameRange)
+                                logger.info("Saved Modification Times")
+
+                                startFrame, endFrame = control.getSegmentRange(agendaItem)
+                                layout = [[startFrame, endFrame, segmentFilePath, startFrame]]
+                                control.removeUnusedParts(pastFiles, layout, segmentFilePath)
+                                control.saveSegmentLayout(agendaItem, segmentFilePath, layout)
 
                     else:
                         if not error:
                             logger.info("No changes to segment " + agendaItem['name'])
                             returnCode = 0
 
+                            ''' Frames were rewritten with the same contents, store their new times. '''
+                            if useHashes and currentSnapshot.toRecords() != pastSnapshot.toRecords():
+                                mySequence.saveSnapshot(modTimeDBFile, currentSnapshot, frameRange)
+                                logger.info("Saved Modification Times")
+
                     '''
                     Check if this is the last agenda item that's complete.
                     If so, unblock the final output subjobs.
                     '''
                     agendaItem['resultpackage'] = {'Changed': render, 'segmentFile': segmentFilePath}
+                    if layout and returnCode == 0:
+                        agendaItem['resultpackage']['segmentParts'] = control.formatSegmentLayout(layout)
 
                     logger.info("Transcoder Segment Process Complete!\n")
 
+            elif agendaItem['name'].startswith('Merge'):
+                '''
+                Merge Process
+                    > Gather the output paths and changes for the segments or
+                    merges this merge depends on, stored in their resultPackages.
+                    > Check if there were changes or the merge file is missing.
+                        True
+                            > Concatenate them into the merge file.
+                        False
+                            > Skip Concatenating
+                    > Update the resultPackage with the changes and the merge file.
+                '''
+
+                logger.info("Starting Merge Process...\n")
+
+                dependantNames = agendaItem.get('package', {}).get('segmentSubjobs', '')
+                logger.debug('Dependants Names: ' + str(dependantNames))
+
+                dependantSegments = control.getSegments(dependantNames)
+                logger.debug('Dependants Segments: ' + str(dependantSegments))
+
+                mergeFilePath = agendaItem['package'].get('mergeFile', '')
+                changes = control.checkSegmentsForChanges(dependantSegments)
+                if not changes and os.path.exists(mergeFilePath):
+                    logger.info('No changes to ' + agendaItem['name'])
+                    returnCode = 0
+                else:
+                    changes = True
+                    segmentOutputPaths = control.getSegmentOutputPaths(dependantSegments)
+                    if segmentOutputPaths:
+                        mergeFilePath = control.getValidOutputPath(mergeFilePath)
+                    if segmentOutputPaths and mergeFilePath:
+                        returnCode = runCMD(control.getMergeCMD(segmentOutputPaths, mergeFilePath))
+
+                if returnCode == 0:
+                    agendaItem['resultpackage'] = {'Changed': changes, 'segmentFile': mergeFilePath}
+                    logger.info('Transcoder ' + agendaItem['name'] + ' Completed Succesfully! (' + str(returnCode) + ')\n')
+                else:
+                    logger.info('Transcoder ' + agendaItem['name'] + ' Failed! (' + str(returnCode) + ')\n')
+
             elif agendaItem['name'].startswith('Output'):
                 '''
                 Final Output Process
@@ -320,6 +470,7 @@ def executeJob(control):
                             > Concatenate segments together.
                         False
                             > Skip
+                    > Compact the modification times saved by the segments.
                     > Update the resultPackage with the outputPath.
                 '''
 
@@ -382,6 +533,9 @@ def executeJob(control):
                     logger.info('No changes to Final ' + agendaItem['name'])
 
                 if not errors:
+                    if control.getSmartUpdate():
+                        ''' Merge the segments' modification time shards now that they're all saved. '''
+                        control.compactModTimeDB()
                     agendaItem['resultpackage'] = {'outputPaths': finalOutputPath}
                     logger.info('Transcoder Final ' + agendaItem['name'] + ' Completed Succesfully! (' + str(returnCode) + ')\n')
                 else:
@@ -403,6 +557,14 @@ def executeJob(control):
             ''' Report back the results to the Supervisor '''
             qb.reportwork(agendaItem)
 
+            ''' Unblock the merge or output waiting on this subjob once its inputs are complete. '''
+            if returnCode == 0:
+                control.completeDependency(agendaItem)
+
+
+    control.closeBlenderWorker()
+    control.stopPrefetch()
+    control.removeScratch()
 
     if jobstate == 'blocked':
         jobstate = 'pending'
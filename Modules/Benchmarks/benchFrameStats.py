@@ -0,0 +1,97 @@
+#!/usr/bin/python
+'''
+Frame Stats Benchmark
+Author: Brennan Chapman
+
+Measures Sequence.getFrameStats throughput on synthetic sequences.
+Sequences are generated on tmpfs when available.  High latency
+network mounts can be simulated with --latency, which delays
+every stat call by the supplied number of seconds.
+
+Usage:
+    python benchFrameStats.py
+    python benchFrameStats.py --sizes 10000,100000 --latency 0.002
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sequenceTools
+
+''' The node cache would answer repeated runs from sqlite, time the uncached calls. '''
+sequenceTools.NODECACHE = False
+
+DEFAULTSIZES = '10000,100000,1000000'
+
+def getScratchFolder():
+    '''
+    Use tmpfs when possible so we measure the code, not the disk.
+    '''
+
+    if os.path.isdir('/dev/shm'):
+        return tempfile.mkdtemp(prefix='benchFrameStats.', dir='/dev/shm')
+    return tempfile.mkdtemp(prefix='benchFrameStats.')
+
+def makeSequence(folder, frameCount):
+    '''
+    Create an empty file for each frame and return
+    the path to the first frame.
+    '''
+
+    seqFolder = os.path.join(folder, str(frameCount))
+    os.makedirs(seqFolder)
+    for frame in range(1, frameCount + 1):
+        open(os.path.join(seqFolder, 'bench_%07d.png' % frame), 'w').close()
+    return os.path.join(seqFolder, 'bench_0000001.png')
+
+def simulateLatency(latency):
+    '''
+    Delay every stat made by sequenceTools.
+    '''
+
+    statPath = sequenceTools._statPath
+    def slowStatPath(path):
+        time.sleep(latency)
+        return statPath(path)
+    sequenceTools._statPath = slowStatPath
+
+def timeFrameStats(initFile, threads):
+    sequence = sequenceTools.Sequence(initFile)
+    sequence.getExistingFrames() # Keep the listing out of the timing
+    start = time.time()
+    stats = sequence.getFrameStats(threads=threads)
+    return len(stats), time.time() - start
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default=DEFAULTSIZES,
+                        help='Comma separated frame counts to test.')
+    parser.add_option('--threads', type='int', default=sequenceTools.STATTHREADS,
+                        help='Thread count for the pooled run.')
+    parser.add_option('--latency', type='float', default=0.0,
+                        help='Simulated seconds of latency per stat.')
+    options, args = parser.parse_args()
+
+    if options.latency:
+        simulateLatency(options.latency)
+
+    folder = getScratchFolder()
+    print('Scratch folder: %s' % folder)
+    print('%10s %8s %10s %14s' % ('Frames', 'Threads', 'Seconds', 'Frames/Sec'))
+    try:
+        for frameCount in [int(size) for size in options.sizes.split(',')]:
+            initFile = makeSequence(folder, frameCount)
+            for threads in (1, options.threads):
+                count, elapsed = timeFrameStats(initFile, threads)
+                print('%10d %8d %10.3f %14.0f' % (count, threads, elapsed, count / max(elapsed, 1e-9)))
+            shutil.rmtree(os.path.dirname(initFile))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+'''
+Sequence Tools Benchmark Suite
+Author: Brennan Chapman
+
+Times the sequenceTools calls every jobtype depends on against
+synthetic sequences generated on tmpfs.  Each size is generated
+in a few patterns:
+    full - every frame exists, with a few corrupt frames
+    gaps - blocks of frames are missing
+    nth - only every 5th frame was rendered
+
+Results are written to a JSON report, and can be compared against
+a stored baseline report.  The exit code is 1 if any timing is
+slower than the baseline by more than the tolerance.
+
+Usage:
+    python benchSequenceTools.py --report new.json
+    python benchSequenceTools.py --sizes 1000,10000 --baseline baseline.json
+'''
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import shutil
+import platform
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sequenceTools
+
+''' The node cache would answer repeated runs from sqlite, time the uncached calls. '''
+sequenceTools.NODECACHE = False
+
+DEFAULTSIZES = '1000,10000,100000,1000000'
+PATTERNS = ('full', 'gaps', 'nth')
+NTHSTEP = 5
+GAPEVERY = 1000 # Frames between each gap
+GAPLENGTH = 10
+CORRUPTEVERY = 97
+VERIFYMAXFRAMES = 10000 # Verification is limited to the first frames of the sequence
+SHARDFRAMES = 200 # Frames in each shard, like a transcoder segment
+TOLERANCE = 0.25
+NOISEFLOOR = 0.005 # Seconds, differences below this are never regressions
+
+def makePNG():
+    '''
+    Build a valid 1x1 png so verification has real images to read.
+    '''
+
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+    header = struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(b'\x00\x00')) + chunk(b'IEND', b''))
+
+IMAGEDATA = makePNG()
+CORRUPTDATA = IMAGEDATA[:20]
+
+def getScratchFolder():
+    '''
+    Use tmpfs when possible so we measure the code, not the disk.
+    '''
+
+    if os.path.isdir('/dev/shm'):
+        return tempfile.mkdtemp(prefix='benchSequenceTools.', dir='/dev/shm')
+    return tempfile.mkdtemp(prefix='benchSequenceTools.')
+
+def getPatternFrames(pattern, frameCount):
+    '''
+    Return the frame numbers to create for a pattern.
+    '''
+
+    if pattern == 'nth':
+        return range(1, frameCount * NTHSTEP + 1, NTHSTEP)
+    if pattern == 'gaps':
+        return [frame for frame in range(1, frameCount + 1)
+                    if (frame % GAPEVERY) >= GAPLENGTH or frame <= GAPLENGTH]
+    return range(1, frameCount + 1)
+
+def makeSequence(folder, pattern, frameCount):
+    '''
+    Write the frames for a pattern and return the path to the first frame.
+    '''
+
+    seqFolder = os.path.join(folder, '%s.%s' % (pattern, frameCount))
+    os.makedirs(seqFolder)
+    frames = getPatternFrames(pattern, frameCount)
+    for frame in frames:
+        data = IMAGEDATA
+        if pattern == 'full' and frame % CORRUPTEVERY == 0:
+            data = CORRUPTDATA
+        f = open(os.path.join(seqFolder, 'bench_%07d.png' % frame), 'wb')
+        f.write(data)
+        f.close()
+
+    ''' Age the folder past the index race window so cached listings are reused. '''
+    past = time.time() - 60
+    os.utime(seqFolder, (past, past))
+    return os.path.join(seqFolder, 'bench_%07d.png' % frames[0])
+
+def timeCall(func, repeat):
+    '''
+    Return the fastest of repeat runs in seconds.
+    '''
+
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchSequence(initFile, repeat):
+    '''
+    Time each sequenceTools call on a sequence.
+    Returns a dictionary of name -> seconds.
+    '''
+
+    folder = os.path.dirname(initFile)
+    dbFile = os.path.join(folder, '.DATA.bench.db')
+    shardFolder = os.path.join(folder, '.DATA.bench' + sequenceTools.SHARDEXTENSION)
+    sequence = sequenceTools.Sequence(initFile)
+    existing = sequence.getExistingFrames()
+    rangeString = existing.toString()
+    frameList = list(existing)
+    verifyRange = sequenceTools.FrameSet(frameList[:VERIFYMAXFRAMES])
+
+    def coldExistingFrames():
+        sequenceTools.folderIndexes.clear()
+        sequence.getExistingFrames()
+
+    def saveAndCompare():
+        if os.path.exists(dbFile):
+            os.remove(dbFile)
+        sequence.saveModTimes(dbFile)
+        sequence.compare(dbFile)
+
+    def saveShardsAndCompact():
+        shutil.rmtree(shardFolder, ignore_errors=True)
+        records = sequence.getSnapshot().toRecords()
+        store = sequenceTools.ShardedManifest(shardFolder)
+        for index in range(0, len(records), SHARDFRAMES):
+            shard = records[index:index+SHARDFRAMES]
+            store.save(shard, sequenceTools.FrameSet.fromRange(shard[0][0], shard[-1][0]))
+        store.load()
+        store.compact()
+
+    results = {}
+    results['loadFrameRange.string'] = timeCall(lambda: sequenceTools.loadFrameRange(rangeString), repeat)
+    results['loadFrameRange.list'] = timeCall(lambda: sequenceTools.loadFrameRange(frameList), repeat)
+    results['getExistingFrames.cold'] = timeCall(coldExistingFrames, repeat)
+    results['getExistingFrames.warm'] = timeCall(sequence.getExistingFrames, repeat)
+    results['getMissingFrames'] = timeCall(sequence.getMissingFrames, repeat)
+    results['getModTimes'] = timeCall(sequence.getModTimes, repeat)
+    results['saveModTimes+compare'] = timeCall(saveAndCompare, repeat)
+    results['saveShards+compact'] = timeCall(saveShardsAndCompact, repeat)
+    results['convertListToRanges'] = timeCall(lambda: sequence.convertListToRanges(frameList), repeat)
+
+    ''' Verification results are cached, so only the first run is meaningful. '''
+    results['checkForCorruptFrames'] = timeCall(lambda: sequence.checkForCorruptFrames(verifyRange), 1)
+    return results
+
+def runBenchmarks(sizes, patterns, repeat):
+    '''
+    Generate each sequence, benchmark it, and remove it again.
+    Returns a dictionary of 'pattern.size.name' -> seconds.
+    '''
+
+    folder = getScratchFolder()
+    print('Scratch folder: %s' % folder)
+    results = {}
+    try:
+        for frameCount in sizes:
+            for pattern in patterns:
+                start = time.time()
+                initFile = makeSequence(folder, pattern, frameCount)
+                print('Generated %s %s frames in %.1fs' % (frameCount, pattern, time.time() - start))
+                for name, seconds in benchSequence(initFile, repeat).items():
+                    results['%s.%s.%s' % (pattern, frameCount, name)] = seconds
+                shutil.rmtree(os.path.dirname(initFile))
+                sequenceTools.folderIndexes.clear()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+def compareToBaseline(results, baseline, tolerance):
+    '''
+    Print each timing next to the baseline.
+    Returns the list of keys that regressed.
+    '''
+
+    regressions = []
+    print('%-52s %10s %10s %8s' % ('Benchmark', 'Seconds', 'Baseline', 'Ratio'))
+    for key in sorted(results):
+        seconds = results[key]
+        base = baseline.get(key)
+        if base is None:
+            print('%-52s %10.4f %10s %8s' % (key, seconds, '-', '-'))
+            continue
+        ratio = seconds / max(base, 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance and seconds - base > NOISEFLOOR:
+            flag = ' SLOWER'
+            regressions.append(key)
+        print('%-52s %10.4f %10.4f %8.2f%s' % (key, seconds, base, ratio, flag))
+    return regressions
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default=DEFAULTSIZES,
+                        help='Comma separated frame counts to test.')
+    parser.add_option('--patterns', default=','.join(PATTERNS),
+                        help='Comma separated sequence patterns to test.')
+    parser.add_option('--repeat', type='int', default=3,
+                        help='Runs per timing, the fastest is kept.')
+    parser.add_option('--report', default='benchSequenceTools.json',
+                        help='File to write the JSON report to.')
+    parser.add_option('--baseline', default='',
+                        help='JSON report to compare the results against.')
+    parser.add_option('--tolerance', type='float', default=TOLERANCE,
+                        help='Allowed slowdown before a timing is a regression. Ex: 0.25')
+    options, args = parser.parse_args()
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    patterns = [pattern for pattern in options.patterns.split(',') if pattern in PATTERNS]
+    results = runBenchmarks(sizes, patterns, options.repeat)
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pil': bool(sequenceTools.PIL),
+        'results': results,
+    }
+    f = open(options.report, 'w')
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
+    print('Report saved to %s' % options.report)
+
+    baseline = {}
+    if options.baseline:
+        f = open(options.baseline)
+        baseline = json.load(f).get('results', {})
+        f.close()
+    regressions = compareToBaseline(results, baseline, options.tolerance)
+    if regressions:
+        print('%s timings are slower than the baseline.' % len(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ Can be easily imported into any other submission interface.
 '''
 
 PRESETSFOLDER = '/Volumes/theGrill/.qube/Jobtypes/Submit Transcoder/Presets'
+MERGEFANIN = 4 # Movies concatenated by each merge subjob
 
 import wx, os, sys, gettext
 import wx.lib.filebrowsebutton
@@ -20,6 +21,7 @@ import traceback
 
 sys.path.append('/Volumes/theGrill/.qube/Modules/')
 import sequenceTools
+import segmentPlanner
 
 
 class SingleLevelFilter(logging.Filter):
@@ -821,6 +823,109 @@ def chunkWithTolerance(inputList, chunkSize, tolerance):
     logger.debug('Chunk with Tolerance Results Length: ' + str(len(resultLists)))
     return resultLists
 
+def getWorkerCount():
+    '''
+    Return the number of active workers on the farm,
+    or segmentPlanner.DEFAULTWORKERS if they can't be listed.
+    '''
+
+    try:
+        hosts = qb.hostinfo()
+        count = len([host for host in hosts if host.get('state') == 'active'])
+    except:
+        logger.warning('Unable to load the worker list.')
+        count = 0
+    return count or segmentPlanner.DEFAULTWORKERS
+
+def setupMerges(inputs, mergeFolder, mergeExtension, fanIn=MERGEFANIN):
+    '''
+    Build a tree of merge subjobs that concatenate the inputs
+    fanIn at a time, so the merges of each level run in parallel
+    instead of one catmovie going through every segment.
+    Returns the merge subjobs, in the order they were created,
+    and the subjobs the output should concatenate.
+    '''
+
+    merges = []
+    level = list(inputs)
+    while fanIn > 1 and len(level) > fanIn:
+        nextLevel = []
+        for index in range(0, len(level), fanIn):
+            group = level[index:index+fanIn]
+            if len(group) == 1:
+                nextLevel.append(group[0])
+                continue
+
+            startFrame = group[0]['package']['frameRange'].split('-')[0]
+            endFrame = group[-1]['package']['frameRange'].split('-')[-1]
+            frameRange = startFrame + '-' + endFrame
+
+            merge = qb.Work()
+            merge['package'] = {}
+            merge['package']['segmentSubjobs'] = [work['name'] for work in group]
+            merge['package']['frameRange'] = frameRange
+            merge['package']['mergeFile'] = mergeFolder + 'Merge' + frameRange + mergeExtension
+            merge['status'] = 'blocked'
+            merge['name'] = 'Merge:' + frameRange
+
+            merges.append(merge)
+            nextLevel.append(merge)
+        level = nextLevel
+
+    return merges, level
+
+def getSegmentsUnblockCallback(segments, segmentDuration, duration):
+    '''
+    Returns a callback that unblocks the segments once
+    the initialize subjob is complete.
+    The segment names are rebuilt from the range inside the callback,
+    so its code stays the same size however many segments there are.
+    If the segments don't follow the range, they are listed one by one.
+    '''
+
+    callback = {}
+    callback['triggers'] = 'complete-work-self-Initialize'
+    callback['language'] = 'python'
+
+    segmentDuration = int(segmentDuration)
+    duration = int(duration)
+    names = []
+    for start in range(1, duration + 1, segmentDuration):
+        names.append('Segment:%s-%s' % (start, min(start + segmentDuration - 1, duration)))
+
+    code = 'import qb\n'
+    if names == [segment['name'] for segment in segments]:
+        code += '\nfor start in range(1, %s, %s):' % (duration + 1, segmentDuration)
+        code += '\n    qb.workunblock(\'%s:Segment:%s-%s\' % '
+        code += '(qb.jobid(), start, min(start + %s, %s)))' % (segmentDuration - 1, duration)
+    else:
+        for segment in segments:
+            code += '%s%s%s' % ('\nqb.workunblock(\'%s:', segment['name'], '\' % qb.jobid())')
+    code += '\nqb.unblock(qb.jobid())'
+    callback['code'] = code
+
+    return callback
+
+def setupDependants(inputs, dependants):
+    '''
+    Record in the package of each segment and merge the subjob
+    that depends on it, and how many inputs that subjob has.
+    The jobtype unblocks the dependant once all of its inputs
+    are complete, instead of a callback per dependant whose
+    trigger lists every input.
+    '''
+
+    dependantNames = {}
+    for dependant in dependants:
+        for name in dependant['package']['segmentSubjobs']:
+            dependantNames[name] = dependant
+
+    for work in inputs:
+        dependant = dependantNames.get(work['name'])
+        if dependant:
+            work['package']['dependantSubjob'] = dependant['name']
+            work['package']['dependantInputs'] = len(dependant['package']['segmentSubjobs'])
+
 def splitPath(inputPath):
     '''
     Split an input path into:
@@ -837,7 +942,9 @@ def splitPath(inputPath):
 def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
                         selfContained=True, frameRange='ALL', audioFile='',
                         smartUpdate=True, fillMissingFrames=True, transcoderFolder='',
-                        segmentDuration=200, maxSegmentsPerOutput=-1, maxSegmentTolerance=5):
+                        segmentDuration=200, maxSegmentsPerOutput=-1, maxSegmentTolerance=5,
+                        smartUpdateHashes=False, persistentBlender=False, prefetch=True,
+                        workers=None, framesPerOutput=None, mergeFanIn=MERGEFANIN):
     '''
     Setup a qube job dictionary based on the input.
     Required Inputs:
@@ -871,6 +978,11 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
         smartUpdate (boolean)
             Automatically update only the segments and outputs
             that have been changed since the last transcode.
+        smartUpdateHashes (boolean)
+            Compare the contents of frames that were rewritten
+            instead of only their modification times, so frames
+            re-rendered with identical pixels don't cause a
+            segment to be transcoded again.
         transcoderFolder (string)
             The folder in which to store all files related
             to the transcoding process.  This includes the
@@ -883,8 +995,24 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
             creating quicktimes from sequences rendered on
             every nth frame.
     Advanced:
-        segmentDuration (integer)
-            Frame count for each segment.
+        persistentBlender (boolean)
+            Keep one blender running on each worker for all
+            of the segments it transcodes, instead of starting
+            blender and loading the project for every segment.
+        prefetch (boolean)
+            While a segment transcodes, read the frames of the
+            next segment into the worker's cache in the background.
+        segmentDuration (integer or 'auto')
+            Frame count for each segment.  With 'auto' the
+            segmentPlanner picks it from the encode cost of the
+            preset and frames, aiming for segments that take about
+            TARGETSEGMENTSECONDS each across the available workers.
+        workers (integer)
+            Workers available to the job, used by the 'auto' segmentDuration.
+            Defaults to the number of active workers.
+        framesPerOutput (integer)
+            With the 'auto' segmentDuration, pick maxSegmentsPerOutput
+            so each output file holds about this many frames.
         maxSegmentsPerOutput (integer)
             Maximum number of segments that can be in each
             output file.  If the number of segments needed
@@ -895,6 +1023,10 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
             If the maxSegmentsPerOutput limit is reached,
             check that the input sequence exceeds this tolerance
             value as well. If not, keep the outputFile as one file.
+        mergeFanIn (integer)
+            Number of movies each merge subjob concatenates.
+            Outputs with more segments than this are put together
+            by a tree of merge subjobs.  0 disables the merges.
 
     Agenda
         The agenda is setup in 3 main sections:
@@ -919,6 +1051,11 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
                         Range of frames to render for this segment.
                     segmentFile (string)
                         Destination path for the segment file.
+                    dependantSubjob (string)
+                        Name of the merge or output that
+                        concatenates this segment.
+                    dependantInputs (integer)
+                        Number of inputs of the dependantSubjob.
                 resultPackage
                     changes (boolean)
                         Returns if any changes were made for
@@ -928,9 +1065,38 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
                         that actually rendered.  Sometimes file
                         issues occur where the output file can't
                         be overwritten, so we automatically
-                        compensate for this.
+                        compensate for this.  When smart update
+                        only transcoded the changed frames, this
+                        is the segment spliced back together.
+                    segmentParts (string)
+                        Frame ranges and files the segment was
+                        spliced from, when smartUpdate is on.
+                        Ex: 1-49:Segment1.mov,50-60:Segment1_50-60.mov
                 Naming
                     Segment: (frameRange)
+            Merges:
+                Purpose
+                    These subjobs concatenate mergeFanIn segments,
+                    or merges of the level below, into a reference
+                    movie.  Each one is unblocked as soon as its
+                    inputs are complete, so the merges run in parallel
+                    and the final output only concatenates a few movies.
+                Package
+                    segmentSubjobs (list of strings)
+                        List of the names of the dependant subjobs.
+                    frameRange (string)
+                        Range of frames covered by the merge.
+                    mergeFile (string)
+                        Destination for the merged movie.
+                    dependantSubjob, dependantInputs
+                        Same as the segments.
+                resultPackage
+                    Changed (boolean)
+                        Returns if any of the dependant subjobs changed.
+                    segmentFile (string)
+                        Path to the merged movie.
+                Naming
+                    Merge: (frameRange)
             Final Outputs:
                 Purpose
                     These subjobs render the output files.
@@ -950,23 +1116,24 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
                 Naming
                     Output: (outputFile)
 
-    Callbacks
-        Callbacks are added to unblock subjobs when they are
-        ready to be processed.
+    Dependencies
+        Segments, merges and outputs are submitted blocked,
+        and unblocked when they are ready to be processed.
             Initialization subjob completion
-                Once the initialization is complete, all
-                segment subjobs are unblocked.
-            Segment subjobs complete.
-                Once all segments that pertain to a final
-                output are complete, that output subjob
-                is unblocked.
+                Once the initialization is complete, a single
+                callback unblocks all of the segment subjobs.
+                Its code is built from the segment range, so
+                it doesn't grow with the segment count.
+            Segment and merge subjobs complete.
+                Each segment and merge carries the name of the
+                subjob that depends on it in dependantSubjob,
+                and that subjob's input count in dependantInputs.
+                Once all inputs of a merge or final output are
+                complete, the worker that finished the last one
+                unblocks it, so no trigger lists every segment.
             Job retried
-                If the job is retried
-
-
-
-
-
+                The initialize subjob clears the completed
+                inputs counted by the previous run.
     '''
 
     ''' Verify input types '''
@@ -988,6 +1155,16 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
     if not transcoderFolder:
         transcoderFolder = os.path.join(os.path.dirname(outputFile), '_Transcoder/')
 
+    if str(segmentDuration).lower() == 'auto':
+        planner = segmentPlanner.SegmentPlanner(preset, segmentPlanner.getTimingsFile(PRESETSFOLDER))
+        pixels, bytesPerFrame = segmentPlanner.scanSequence(mySequence, frameRange)
+        if workers is None:
+            workers = getWorkerCount()
+        plan = planner.plan(mySequence.getDuration(), pixels, bytesPerFrame, workers, framesPerOutput)
+        segmentDuration = plan['segmentDuration']
+        if framesPerOutput:
+            maxSegmentsPerOutput = plan['maxSegmentsPerOutput']
+
     ''' Initialize '''
     init = qb.Work()
     init['name'] = 'Initialize'
@@ -1029,16 +1206,12 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
         finalOutputSegments = chunkWithTolerance(segments, maxSegmentsPerOutput, maxSegmentTolerance)
 
     finalOutputs = []
+    merges = []
     count = 1
     for outputSegment in finalOutputSegments:
         output = qb.Work()
         output['package'] = {}
 
-        segmentSubjobs = []
-        for segment in outputSegment:
-            segmentSubjobs.append(segment['name'])
-        output['package']['segmentSubjobs'] = segmentSubjobs
-
         outputFolder, outputName, outputExtension = splitPath(outputFile)
         finalOutputFile = outputFolder + outputName
         if len(finalOutputSegments) > 1:
@@ -1046,51 +1219,36 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
         finalOutputFile += outputExtension
         output['package']['outputFile'] = finalOutputFile
 
+        ''' Merge the segments in parallel before the final output. '''
+        mergeFolder = os.path.join(transcoderFolder, 'Segments/') + outputName + '/'
+        outputMerges, outputInputs = setupMerges(outputSegment, mergeFolder, outputExtension, mergeFanIn)
+        merges.extend(outputMerges)
+
+        segmentSubjobs = []
+        for segment in outputInputs:
+            segmentSubjobs.append(segment['name'])
+        output['package']['segmentSubjobs'] = segmentSubjobs
+
         output['status'] = 'blocked'
         output['name'] = 'Output:' + os.path.basename(finalOutputFile)
 
         count += 1
 
         finalOutputs.append(output)
+    logger.debug("Merges: " + str(merges))
     logger.debug("Final Outputs: " + str(finalOutputs))
 
     '''
-    Callbacks
+    Dependencies
         1 - Unblock the segments when the initialize command is completed.
-        2 - Unblock the outputs when the dependant segments are completed.
+        2 - Each segment and merge names the subjob that depends on it,
+            the jobtype unblocks that subjob once all its inputs are complete.
     '''
 
     callbacks = []
+    callbacks.append(getSegmentsUnblockCallback(segments, segmentDuration, mySequence.getDuration()))
 
-    ''' Unblock Segments '''
-    callback = {}
-    callback['triggers'] = 'complete-work-self-Initialize'
-    callback['language'] = 'python'
-
-    code = 'import qb\n'
-    for segment in segments:
-        code += '%s%s%s' % ('\nqb.workunblock(\'%s:', segment['name'], '\' % qb.jobid())')
-    code += '\nqb.unblock(qb.jobid())'
-    callback['code'] = code
-
-    callbacks.append(callback)
-
-    ''' Unblock Outputs '''
-    for finalOutput in finalOutputs:
-        callback = {}
-        triggers = []
-
-        for segment in finalOutput['package']['segmentSubjobs']:
-            triggers.append('complete-work-self-' + segment)
-        callback['triggers'] = ' and '.join(triggers)
-        callback['language'] = 'python'
-
-        code = 'import qb\n'
-        code += '%s%s%s' % ('\nqb.workunblock(\'%s:', finalOutput['name'], '\' % qb.jobid())')
-        code += '\nqb.unblock(qb.jobid())'
-        callback['code'] = code
-
-        callbacks.append(callback)
+    setupDependants(segments + merges, merges + finalOutputs)
 
 
     ''' ---- Now put the job together ---- '''
@@ -1109,7 +1267,10 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
     job['package']['preset'] = os.path.join(PRESETSFOLDER,preset + ".blend")
     job['package']['selfContained'] = selfContained
     job['package']['smartUpdate'] = smartUpdate
+    job['package']['smartUpdateHashes'] = smartUpdateHashes
     job['package']['fillMissingFrames'] = fillMissingFrames
+    job['package']['persistentBlender'] = persistentBlender
+    job['package']['prefetch'] = prefetch
     job['package']['frameRange'] = str(frameRange)
     job['package']['transcoderFolder'] = transcoderFolder
 
@@ -1119,18 +1280,18 @@ def setupSequenceJob(qubeJobTemplate, sequenceInitFile, outputFile, preset,
     job['agenda'].extend(segments)
     logger.debug("Agenda: " + str(job['agenda']))
 
-    ''' Place the final outputs after their last segment. '''
-    for outputNum, output in enumerate(finalOutputs):
-        lastSegmentName = output['package']['segmentSubjobs'][-1]
-        lastSegmentIndex = None
-        for index, segment in enumerate(segments):
-            if segment['name'] == lastSegmentName:
-                lastSegmentIndex = index
+    ''' Place the merges and final outputs after their last dependant subjob. '''
+    for work in merges + finalOutputs:
+        lastName = work['package']['segmentSubjobs'][-1]
+        lastIndex = None
+        for index, item in enumerate(job['agenda']):
+            if item['name'] == lastName:
+                lastIndex = index
                 break
-        if lastSegmentIndex != None:
-            job['agenda'].insert(lastSegmentIndex+2+outputNum, output) # +2 for Initialization and last segment
+        if lastIndex != None:
+            job['agenda'].insert(lastIndex+1, work)
         else:
-            logger.error("ERROR: Unable to find last segment for output " + output['name'])
+            logger.error("ERROR: Unable to find last subjob for " + work['name'])
 
     ''' Callbacks '''
     if not job.get('callbacks', None):
@@ -1171,10 +1332,19 @@ def prepareJobsFromDlg(qubejob):
             logger.info("smartUpdate: " + str(smartUpdate))
             smartUpdate = tJob['smartUpdate']
             logger.info("smartUpdate: " + str(smartUpdate))
+            smartUpdateHashes = tJob.get('smartUpdateHashes', False)
+            logger.info("smartUpdateHashes: " + str(smartUpdateHashes))
             fillMissingFrames = tJob['fillMissingFrames']
             logger.info("fillMissingFrames: " + str(fillMissingFrames))
+            persistentBlender = tJob.get('persistentBlender', False)
+            logger.info("persistentBlender: " + str(persistentBlender))
+            prefetch = tJob.get('prefetch', True)
+            logger.info("prefetch: " + str(prefetch))
             transcodeJob = setupSequenceJob(qubejob, sequenceFile, outputFile, preset, audioFile=audioFile, maxSegmentsPerOutput=5, frameRange=frameRange,
-                fillMissingFrames=fillMissingFrames, maxSegmentTolerance=2, segmentDuration=100, selfContained=selfContained, smartUpdate=smartUpdate)
+                fillMissingFrames=fillMissingFrames, maxSegmentTolerance=2, segmentDuration='auto', selfContained=selfContained, smartUpdate=smartUpdate,
+                framesPerOutput=500,
+                smartUpdateHashes=smartUpdateHashes, persistentBlender=persistentBlender,
+                prefetch=prefetch)
             logger.info("Setup Sequence Job: " + str(transcodeJob))
             jobsToSubmit.append(transcodeJob)
 
@@ -0,0 +1,664 @@
+'''
+Frame Verification Module
+Author: Brennan Chapman
+
+Checks rendered frames for corruption using a pool of processes.
+Every result is stored in a cache keyed by (path, size, mtime),
+so frames that haven't changed are never verified twice.
+
+Common frame formats are checked by validators that only read the
+header and trailer of the file.  PIL is used for everything else,
+or when a validator can't decide.
+The same headers give the size of a frame with readImageSize.
+
+Frames can be submitted as they are rendered and the results
+collected later:
+
+verifier = FrameVerifier()
+verifier.submit('/path/to/frame.0001.png')
+...
+for path, ok in verifier.collect(wait=True):
+    ...
+verifier.close()
+
+'''
+
+import os
+import sys
+import time
+import zlib
+import struct
+import getpass
+import tempfile
+import logging
+import multiprocessing
+
+# Qube workaraound
+try:
+    import sqlite3
+except:
+    sys.path.append('/System/Library/Frameworks/Python.framework/Versions/2.5/lib/python2.5')
+    sys.path.append('/System/Library/Frameworks/Python.framework/Versions/2.5/lib/python2.5/lib-dynload/')
+    import sqlite3
+
+''' Setup the logger. '''
+# logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+PIL = False
+try:
+    import Image
+    PIL = True
+except:
+    try:
+        sys.path.append("/Library/Python/2.5/site-packages/PIL/")
+        import Image
+        PIL = True
+    except:
+        logger.warning("Unable to import PIL Image module.")
+
+''' Constants '''
+try:
+    VERIFYCACHEFILE = os.path.join(tempfile.gettempdir(), 'sequenceTools.%s.verified.db' % getpass.getuser())
+except Exception:
+    VERIFYCACHEFILE = os.path.join(tempfile.gettempdir(), 'sequenceTools.verified.db')
+VERIFYCACHEMAXAGE = 30 * 24 * 60 * 60 # Seconds
+VERIFYCACHEPRUNEINTERVAL = 24 * 60 * 60 # Seconds between prunes of the cache
+
+'''
+Validators
+Each validator takes an open file and its size and returns
+True if the frame looks complete, False if it's corrupt or
+None if it can't tell, in which case PIL is used.
+'''
+
+validators = {}
+
+def registerValidator(extensions, validator):
+    '''
+    Register a validator for a list of file extensions. Ex: ['.png']
+    '''
+
+    for extension in extensions:
+        validators[extension.lower()] = validator
+
+def getValidator(path):
+    '''
+    Return the validator for a frame path or a bare extension like '.png'.
+    '''
+
+    extension = os.path.splitext(path)[1] or path
+    return validators.get(extension.lower())
+
+def canVerify(path):
+    '''
+    Return True if frames like the path, or with the extension,
+    can be verified, either by a validator or by PIL.
+    '''
+
+    return PIL or getValidator(path) is not None
+
+def _readAt(f, offset, length):
+    f.seek(offset)
+    return f.read(length)
+
+PNGSIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNGIEND = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+def validatePNG(f, size):
+    '''
+    Check the signature, the IHDR chunk and its crc, and the IEND chunk.
+    '''
+
+    header = f.read(33)
+    if len(header) < 33 or header[:8] != PNGSIGNATURE:
+        return False
+    length, kind = struct.unpack('>I4s', header[8:16])
+    if kind != b'IHDR' or length != 13:
+        return False
+    crc = struct.unpack('>I', header[29:33])[0]
+    if zlib.crc32(header[12:29]) & 0xffffffff != crc:
+        return False
+    return _readAt(f, size - 12, 12) == PNGIEND
+
+def validateJPEG(f, size):
+    '''
+    Check the SOI and EOI markers, allowing for padding after the EOI.
+    '''
+
+    if f.read(3) != b'\xff\xd8\xff':
+        return False
+    tail = _readAt(f, max(0, size - 1024), 1024).rstrip(b'\x00')
+    return tail.endswith(b'\xff\xd9')
+
+TIFFSHORT = 3
+TIFFLONG = 4
+TIFFDATATAGS = ((273, 279), (324, 325)) # (Strip offsets, byte counts), (Tile offsets, byte counts)
+TIFFMAXIFDS = 64
+
+def _readTiffValues(f, endian, fieldType, count, valueOffset, size):
+    '''
+    Read a SHORT or LONG array from an IFD entry.
+    '''
+
+    itemSize = 2 if fieldType == TIFFSHORT else 4
+    code = 'H' if fieldType == TIFFSHORT else 'I'
+    if count * itemSize <= 4:
+        data = valueOffset[:count * itemSize]
+    else:
+        offset = struct.unpack(endian + 'I', valueOffset)[0]
+        if offset + count * itemSize > size:
+            return None
+        data = _readAt(f, offset, count * itemSize)
+    return struct.unpack(endian + code * count, data)
+
+def validateTIFF(f, size):
+    '''
+    Walk the IFD chain checking every IFD offset, and that the
+    image strips or tiles end inside the file.
+    '''
+
+    header = f.read(8)
+    if header[:4] == b'II*\x00':
+        endian = '<'
+    elif header[:4] == b'MM\x00*':
+        endian = '>'
+    elif header[:4] in (b'II+\x00', b'MM\x00+'):
+        return None # BigTIFF
+    else:
+        return False
+
+    offset = struct.unpack(endian + 'I', header[4:8])[0]
+    seen = set()
+    while offset:
+        if offset in seen or len(seen) >= TIFFMAXIFDS or offset < 8 or offset + 2 > size:
+            return False
+        seen.add(offset)
+        entryCount = struct.unpack(endian + 'H', _readAt(f, offset, 2))[0]
+        if offset + 2 + entryCount * 12 + 4 > size:
+            return False
+        data = f.read(entryCount * 12 + 4)
+
+        entries = {}
+        for index in range(entryCount):
+            tag, fieldType, count = struct.unpack(endian + 'HHI', data[index * 12:index * 12 + 8])
+            entries[tag] = (fieldType, count, data[index * 12 + 8:index * 12 + 12])
+        for offsetTag, countTag in TIFFDATATAGS:
+            if offsetTag in entries and countTag in entries:
+                offsets = _readTiffValues(f, endian, *(entries[offsetTag] + (size,)))
+                counts = _readTiffValues(f, endian, *(entries[countTag] + (size,)))
+                if offsets is None or counts is None:
+                    return False
+                if max(start + count for start, count in zip(offsets, counts)) > size:
+                    return False
+        offset = struct.unpack(endian + 'I', data[-4:])[0]
+    return True
+
+TGAFOOTER = b'TRUEVISION-XFILE.\x00'
+TGAUNCOMPRESSED = (1, 2, 3)
+
+def validateTGA(f, size):
+    '''
+    Check the footer if there is one and that uncompressed
+    images are big enough to hold all of their pixels.
+    '''
+
+    header = f.read(18)
+    if len(header) < 18:
+        return False
+    (idLength, colorMapType, imageType, mapStart, mapLength, mapDepth,
+        x, y, width, height, depth, descriptor) = struct.unpack('<BBBHHBHHHHBB', header)
+    expected = 18 + idLength + mapLength * ((mapDepth + 7) // 8)
+    if imageType in TGAUNCOMPRESSED:
+        expected += width * height * ((depth + 7) // 8)
+
+    footer = _readAt(f, max(0, size - 26), 26)
+    if footer[8:] == TGAFOOTER:
+        extensionOffset, developerOffset = struct.unpack('<II', footer[:8])
+        if extensionOffset > size or developerOffset > size:
+            return False
+        return size - 26 >= expected
+    if imageType in TGAUNCOMPRESSED:
+        return size >= expected
+    return None
+
+def validateDPX(f, size):
+    '''
+    Check the magic number, the image data offset and
+    the file size stored in the header.
+    '''
+
+    header = f.read(20)
+    if header[:4] == b'SDPX':
+        endian = '>'
+    elif header[:4] == b'XPDS':
+        endian = '<'
+    else:
+        return False
+    imageOffset, version, fileSize = struct.unpack(endian + 'I8sI', header[4:20])
+    if imageOffset >= size:
+        return False
+    return fileSize == 0 or fileSize <= size
+
+EXRMAGIC = 20000630
+EXRTILED = 0x200
+EXRMULTIPART = 0x1000
+EXRHEADERLIMIT = 1024 * 1024
+# Scanlines stored in each chunk for each compression type
+EXRLINESPERCHUNK = {0: 1, 1: 1, 2: 1, 3: 16, 4: 32, 5: 16, 6: 32, 7: 32, 8: 32, 9: 256}
+
+def _readNullString(f, limit=256):
+    result = b''
+    while len(result) < limit:
+        char = f.read(1)
+        if not char:
+            return None
+        if char == b'\x00':
+            return result
+        result += char
+    return None
+
+def _readEXRAttributes(f, size, names):
+    '''
+    Read the header attributes of an EXR, starting just after the version.
+    Returns a dictionary of name -> raw value for the requested names,
+    or None if the header is damaged or any of them are missing.
+    '''
+
+    attributes = {}
+    while f.tell() < EXRHEADERLIMIT:
+        name = _readNullString(f)
+        if name is None:
+            return None
+        if not name:
+            break
+        attributeType = _readNullString(f)
+        data = f.read(4)
+        if attributeType is None or len(data) < 4:
+            return None
+        length = struct.unpack('<i', data)[0]
+        if length < 0 or f.tell() + length > size:
+            return None
+        if name in names:
+            attributes[name] = f.read(length)
+        else:
+            f.seek(length, 1)
+    else:
+        return None
+
+    for name in names:
+        if name not in attributes:
+            return None
+    return attributes
+
+def validateEXR(f, size):
+    '''
+    Parse the header attributes, then check that every chunk in the
+    offset table starts inside the file and that the last chunk ends
+    inside it.  Tiled and multi-part files are left to PIL.
+    '''
+
+    header = f.read(8)
+    if len(header) < 8:
+        return False
+    magic, version = struct.unpack('<iI', header)
+    if magic != EXRMAGIC:
+        return False
+    if version & (EXRTILED | EXRMULTIPART):
+        return None
+
+    attributes = _readEXRAttributes(f, size, (b'dataWindow', b'compression'))
+    if attributes is None:
+        return False
+    xMin, yMin, xMax, yMax = struct.unpack('<iiii', attributes[b'dataWindow'][:16])
+    compression = struct.unpack('<B', attributes[b'compression'][:1])[0]
+    if compression not in EXRLINESPERCHUNK:
+        return None
+    linesPerChunk = EXRLINESPERCHUNK[compression]
+    chunkCount = (yMax - yMin + linesPerChunk) // linesPerChunk
+
+    tableStart = f.tell()
+    if chunkCount < 1 or tableStart + chunkCount * 8 > size:
+        return False
+    offsets = struct.unpack('<%dQ' % chunkCount, f.read(chunkCount * 8))
+    tableEnd = tableStart + chunkCount * 8
+    for offset in offsets:
+        if offset < tableEnd or offset + 8 > size:
+            return False
+    lastChunk = max(offsets)
+    dataSize = struct.unpack('<i', _readAt(f, lastChunk + 4, 4))[0]
+    return dataSize >= 0 and lastChunk + 8 + dataSize <= size
+
+registerValidator(['.png'], validatePNG)
+registerValidator(['.jpg', '.jpeg'], validateJPEG)
+registerValidator(['.tif', '.tiff'], validateTIFF)
+registerValidator(['.tga'], validateTGA)
+registerValidator(['.dpx'], validateDPX)
+registerValidator(['.exr'], validateEXR)
+
+'''
+Image Sizes
+Read the width and height of a frame from its header.
+Each reader takes an open file and returns (width, height).
+'''
+
+sizeReaders = {}
+
+JPEGSOFMARKERS = [0xc0 + index for index in range(16) if index not in (4, 8, 12)]
+
+def readPNGSize(f):
+    header = f.read(24)
+    if header[:8] != PNGSIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+def readJPEGSize(f):
+    '''
+    Walk the markers to the start of frame, which holds the size.
+    '''
+
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = f.read(4)
+        if len(marker) < 4 or marker[:1] != b'\xff':
+            return None
+        code, length = struct.unpack('>BH', marker[1:4])
+        if code in JPEGSOFMARKERS:
+            data = f.read(5)
+            height, width = struct.unpack('>HH', data[1:5])
+            return (width, height)
+        f.seek(length - 2, 1)
+
+def readTIFFSize(f):
+    header = f.read(8)
+    endian = {b'II*\x00': '<', b'MM\x00*': '>'}.get(header[:4])
+    if endian is None:
+        return None
+    offset = struct.unpack(endian + 'I', header[4:8])[0]
+    entryCount = struct.unpack(endian + 'H', _readAt(f, offset, 2))[0]
+    data = f.read(entryCount * 12)
+    values = {}
+    for index in range(entryCount):
+        tag, fieldType = struct.unpack(endian + 'HH', data[index * 12:index * 12 + 4])
+        if tag in (256, 257):
+            code = 'H' if fieldType == TIFFSHORT else 'I'
+            values[tag] = struct.unpack(endian + code, data[index * 12 + 8:index * 12 + 8 + struct.calcsize(code)])[0]
+    if 256 in values and 257 in values:
+        return (values[256], values[257])
+    return None
+
+def readTGASize(f):
+    header = f.read(18)
+    if len(header) < 18:
+        return None
+    return struct.unpack('<HH', header[12:16])
+
+def readDPXSize(f):
+    header = f.read(4)
+    endian = {b'SDPX': '>', b'XPDS': '<'}.get(header)
+    if endian is None:
+        return None
+    return struct.unpack(endian + 'II', _readAt(f, 772, 8))
+
+def readEXRSize(f):
+    header = f.read(8)
+    if len(header) < 8 or struct.unpack('<i', header[:4])[0] != EXRMAGIC:
+        return None
+    attributes = _readEXRAttributes(f, EXRHEADERLIMIT, (b'dataWindow',))
+    if attributes is None:
+        return None
+    xMin, yMin, xMax, yMax = struct.unpack('<iiii', attributes[b'dataWindow'][:16])
+    return (xMax - xMin + 1, yMax - yMin + 1)
+
+for extensions, reader in ((['.png'], readPNGSize), (['.jpg', '.jpeg'], readJPEGSize),
+                            (['.tif', '.tiff'], readTIFFSize), (['.tga'], readTGASize),
+                            (['.dpx'], readDPXSize), (['.exr'], readEXRSize)):
+    for extension in extensions:
+        sizeReaders[extension] = reader
+
+def readImageSize(path):
+    '''
+    Return the (width, height) of an image from its header,
+    or None if the format isn't supported or the header is damaged.
+    '''
+
+    reader = sizeReaders.get(os.path.splitext(path)[1].lower())
+    if reader is None:
+        return None
+    try:
+        f = open(path, 'rb')
+        try:
+            return reader(f)
+        finally:
+            f.close()
+    except (IOError, OSError, struct.error):
+        return None
+
+def validateFile(path):
+    '''
+    Run the registered validator for the path.
+    Returns True, False or None if there is no validator
+    or it couldn't decide.
+    '''
+
+    validator = getValidator(path)
+    if validator is None:
+        return None
+    try:
+        f = open(path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return False
+            return validator(f, size)
+        finally:
+            f.close()
+    except (IOError, OSError, struct.error):
+        return False
+
+def verifyImage(path):
+    '''
+    Check the image with its validator, falling back to
+    opening the image with PIL and verifying it.
+    Returns (path, ok)
+    '''
+
+    ok = validateFile(path)
+    if ok is not None:
+        return (path, ok)
+    if not PIL:
+        logger.warning("Unable to verify %s without PIL." % path)
+        return (path, True)
+
+    try:
+        img = Image.open(path)
+        img.verify()
+        return (path, True)
+    except:
+        return (path, False)
+
+def getProcessCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class VerificationCache(object):
+    '''
+    Sqlite cache of verification results keyed by (path, size, mtime).
+    Defaults to a node local file for each user, so it's safe for the
+    subjobs on a node to share it.
+    Errors reading or writing the cache are logged and the frames
+    are verified uncached, the cache never fails a render.
+    '''
+
+    def __init__(self, filename=VERIFYCACHEFILE):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=30)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS verified '
+                            '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, ok INTEGER, checked REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pruned (id INTEGER PRIMARY KEY, checked REAL)')
+        self.pending = []
+
+    def get(self, path, size, mtime):
+        '''
+        Return the cached result for the path, or None if the
+        path was never verified or has changed since.
+        '''
+
+        try:
+            row = self.conn.execute('SELECT size, mtime, ok FROM verified WHERE path = ?', (path,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Unable to read verification cache %s: %s' % (self.filename, e))
+            return None
+        if row and row[0] == size and row[1] == mtime:
+            return bool(row[2])
+        return None
+
+    def add(self, path, size, mtime, ok):
+        self.pending.append((path, size, mtime, int(ok), time.time()))
+
+    def commit(self):
+        if self.pending:
+            try:
+                self.conn.executemany('INSERT OR REPLACE INTO verified (path, size, mtime, ok, checked) '
+                                        'VALUES (?,?,?,?,?)', self.pending)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                logger.warning('Unable to update verification cache %s: %s' % (self.filename, e))
+                try:
+                    self.conn.rollback()
+                except sqlite3.Error:
+                    pass
+            self.pending = []
+
+    def prune(self, maxAge=VERIFYCACHEMAXAGE, interval=VERIFYCACHEPRUNEINTERVAL):
+        '''
+        Remove results older than maxAge seconds, at most once every
+        interval seconds.  The time of the last prune is kept in the
+        cache, so it's shared by every process on the node.
+        Returns True if the cache was pruned.
+        '''
+
+        now = time.time()
+        try:
+            row = self.conn.execute('SELECT checked FROM pruned WHERE id = 0').fetchone()
+            if row and now - row[0] < interval:
+                return False
+            self.conn.execute('DELETE FROM verified WHERE checked < ?', (now - maxAge,))
+            self.conn.execute('INSERT OR REPLACE INTO pruned (id, checked) VALUES (0, ?)', (now,))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.warning('Unable to prune verification cache %s: %s' % (self.filename, e))
+            return False
+        return True
+
+    def close(self):
+        self.commit()
+        try:
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+
+class FrameVerifier(object):
+    '''
+    Verifies frames in a process pool sized to the node.
+    submit() queues a frame and returns right away, collect() returns
+    the (path, ok) results that finished since the last collect.
+    processes=0 verifies in the current process, which is
+    quicker when only a frame or two are checked at a time.
+    Frames with a validator are always verified in the current
+    process, since that only reads a few KB.
+    '''
+
+    def __init__(self, processes=None, cacheFile=VERIFYCACHEFILE):
+        if processes is None:
+            processes = getProcessCount()
+        self.processes = processes
+        self.pool = None
+        self.cache = None
+        if cacheFile:
+            try:
+                self.cache = VerificationCache(cacheFile)
+            except sqlite3.Error:
+                logger.warning("Unable to open verification cache %s" % cacheFile)
+        self.results = []
+        self.running = {}
+
+    def submit(self, path, size=None, mtime=None):
+        '''
+        Queue a frame for verification.
+        size and mtime are stat'ed if they aren't supplied.
+        Returns False if the frame doesn't exist.
+        '''
+
+        if size is None or mtime is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.results.append((path, False))
+                return False
+            size, mtime = st.st_size, st.st_mtime
+
+        if self.cache:
+            cached = self.cache.get(path, size, mtime)
+            if cached is not None:
+                self.results.append((path, cached))
+                return True
+
+        if self.processes > 0 and getValidator(path) is None:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+            self.running[path] = (self.pool.apply_async(verifyImage, (path,)), size, mtime)
+        else:
+            self._addResult(verifyImage(path), size, mtime)
+        return True
+
+    def _addResult(self, result, size, mtime):
+        path, ok = result
+        if self.cache:
+            self.cache.add(path, size, mtime, ok)
+        self.results.append(result)
+
+    def collect(self, wait=False):
+        '''
+        Return a list of (path, ok) for frames that finished verifying.
+        If wait is True, block until every submitted frame is done.
+        '''
+
+        for path, (asyncResult, size, mtime) in list(self.running.items()):
+            if wait or asyncResult.ready():
+                self._addResult(asyncResult.get(), size, mtime)
+                del self.running[path]
+
+        if self.cache:
+            self.cache.commit()
+        results, self.results = self.results, []
+        return results
+
+    def getPendingCount(self):
+        return len(self.running)
+
+    def close(self):
+        '''
+        Wait for running frames, shut down the pool
+        and save the cache, pruning it once a day.
+        '''
+
+        self.collect(wait=True)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.cache:
+            self.cache.commit()
+            self.cache.prune()
+            self.cache.close()
+            self.cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
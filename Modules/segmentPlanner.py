@@ -0,0 +1,202 @@
+'''
+Segment Planner
+Author: Brennan Chapman
+
+Picks the segment size for transcoder jobs from an estimate of how
+long each frame takes to encode, so every segment subjob runs for
+about TARGETSEGMENTSECONDS and the job still spreads across the farm.
+
+Frame cost is estimated from the timings of past segments encoded
+with the same preset, scaled by the frame resolution.  Presets
+without any history fall back to a guess from the preset name and
+the size of the frames on disk.
+
+Timings are stored in a small sqlite file next to the presets,
+which the Transcoder jobtype adds to after every segment it encodes.
+'''
+
+import os
+import sys
+import math
+import time
+import logging
+
+# Qube workaraound
+try:
+    import sqlite3
+except:
+    sys.path.append('/System/Library/Frameworks/Python.framework/Versions/2.5/lib/python2.5')
+    sys.path.append('/System/Library/Frameworks/Python.framework/Versions/2.5/lib/python2.5/lib-dynload/')
+    import sqlite3
+
+import frameVerifier
+import sequenceTools
+
+TIMINGSFILENAME = '.segmentTimings.db'
+TARGETSEGMENTSECONDS = 120 # Seconds each segment subjob should take
+MINSEGMENTFRAMES = 25 # Below this blender startup outweighs the encode
+MAXSEGMENTFRAMES = 1000
+SEGMENTROUNDING = 5
+DEFAULTWORKERS = 20
+HISTORYSEGMENTS = 50 # Most recent segments used for an estimate
+SCANSAMPLES = 20 # Frames stat'ed to measure the size of the frames
+
+# Seconds to encode one megapixel for presets without history, by name
+PRESETCOSTS = (('4444', 0.25), ('422', 0.12), ('preview', 0.03))
+DEFAULTMEGAPIXELCOST = 0.12
+DEFAULTMEGAPIXELS = 1920 * 1080 / 1e6
+READBYTESPERSECOND = 80 * 1024 * 1024 # Network read speed of a worker
+
+''' Setup the logger. '''
+logger = logging.getLogger(__name__)
+
+
+def getPresetName(preset):
+    '''
+    Presets are referred to by name at submission and by
+    full path on the workers. Ex: /Presets/Preview.blend -> Preview
+    '''
+
+    return os.path.splitext(os.path.basename(preset))[0]
+
+def getTimingsFile(presetsFolder):
+    return os.path.join(presetsFolder, TIMINGSFILENAME)
+
+def openTimings(filename):
+    conn = sqlite3.connect(filename, timeout=30)
+    # The timings are shared by every node, WAL only works on one host.
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.execute('CREATE TABLE IF NOT EXISTS timings '
+                    '(preset TEXT, frames INTEGER, seconds REAL, pixels INTEGER, '
+                    'bytesPerFrame REAL, recorded REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS timingsPreset ON timings (preset, recorded)')
+    return conn
+
+def recordTiming(timingsFile, preset, frames, seconds, pixels=None, bytesPerFrame=None):
+    '''
+    Store how long a segment took to encode.
+    Failures are only logged, the timings are never worth failing a segment.
+    '''
+
+    try:
+        conn = openTimings(timingsFile)
+        try:
+            conn.execute('INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?)',
+                            (getPresetName(preset), frames, seconds, pixels, bytesPerFrame, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning('Unable to record segment timing to %s: %s' % (timingsFile, e))
+
+def scanSequence(sequence, frames='ALL'):
+    '''
+    Quickly measure the frames of a sequence.
+    Returns (pixels, bytesPerFrame), reading the header of one frame
+    and the size of up to SCANSAMPLES frames spread over the range.
+    Either can be None if it couldn't be measured.
+    '''
+
+    existing = list(sequence.getExistingFrames(frames))
+    if not existing:
+        return None, None
+    step = max(1, len(existing) // SCANSAMPLES)
+    samples = existing[::step][:SCANSAMPLES]
+    paths = sequence.getFrameFilenames(samples)
+
+    pixels = None
+    imageSize = frameVerifier.readImageSize(paths[0])
+    if imageSize:
+        pixels = imageSize[0] * imageSize[1]
+
+    sizes = [stat[0] for stat in sequenceTools.collectStats(paths) if stat is not None]
+    bytesPerFrame = None
+    if sizes:
+        bytesPerFrame = float(sum(sizes)) / len(sizes)
+    return pixels, bytesPerFrame
+
+
+class SegmentPlanner(object):
+    '''
+    Estimates the encode cost of a preset and plans segments from it.
+    '''
+
+    def __init__(self, preset, timingsFile=None):
+        self.preset = getPresetName(preset)
+        self.timingsFile = timingsFile
+
+    def loadHistory(self):
+        '''
+        Return the most recent (frames, seconds, pixels) timings for the preset.
+        '''
+
+        if not self.timingsFile or not os.path.exists(self.timingsFile):
+            return []
+        try:
+            conn = openTimings(self.timingsFile)
+            try:
+                return conn.execute('SELECT frames, seconds, pixels FROM timings WHERE preset = ? '
+                                    'ORDER BY recorded DESC LIMIT ?', (self.preset, HISTORYSEGMENTS)).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning('Unable to load segment timings from %s: %s' % (self.timingsFile, e))
+            return []
+
+    def estimateSecondsPerFrame(self, pixels=None, bytesPerFrame=None):
+        '''
+        Returns (secondsPerFrame, source) where source describes
+        where the estimate came from.
+        '''
+
+        history = [row for row in self.loadHistory() if row[0] > 0]
+        if history:
+            measured = [row for row in history if row[2]]
+            if pixels and measured:
+                megapixelFrames = sum(frames * pixelCount / 1e6 for frames, seconds, pixelCount in measured)
+                secondsPerMegapixel = sum(row[1] for row in measured) / megapixelFrames
+                return secondsPerMegapixel * pixels / 1e6, 'history of %s segments' % len(measured)
+            secondsPerFrame = sum(row[1] for row in history) / sum(row[0] for row in history)
+            return secondsPerFrame, 'history of %s segments' % len(history)
+
+        megapixelCost = DEFAULTMEGAPIXELCOST
+        for keyword, cost in PRESETCOSTS:
+            if keyword in self.preset.lower():
+                megapixelCost = cost
+                break
+        secondsPerFrame = megapixelCost * ((pixels or 0) / 1e6 or DEFAULTMEGAPIXELS)
+        if bytesPerFrame:
+            secondsPerFrame += bytesPerFrame / READBYTESPERSECOND
+        return secondsPerFrame, 'preset defaults'
+
+    def plan(self, frameCount, pixels=None, bytesPerFrame=None, workers=DEFAULTWORKERS,
+                framesPerOutput=None, targetSeconds=TARGETSEGMENTSECONDS):
+        '''
+        Pick the segment size for a sequence.
+        Segments are sized to take about targetSeconds, but made
+        smaller if that would leave some of the workers idle.
+        With framesPerOutput, maxSegmentsPerOutput is picked so the
+        output files keep about that many frames.
+        Returns a dictionary with segmentDuration, maxSegmentsPerOutput,
+        secondsPerFrame and source.
+        '''
+
+        secondsPerFrame, source = self.estimateSecondsPerFrame(pixels, bytesPerFrame)
+        segmentDuration = targetSeconds / max(secondsPerFrame, 1e-6)
+
+        ''' Spread short jobs over all of the workers '''
+        if workers and frameCount / segmentDuration < workers:
+            segmentDuration = math.ceil(float(frameCount) / workers)
+
+        segmentDuration = max(MINSEGMENTFRAMES, min(MAXSEGMENTFRAMES, segmentDuration))
+        segmentDuration = int(round(float(segmentDuration) / SEGMENTROUNDING) * SEGMENTROUNDING)
+
+        maxSegmentsPerOutput = -1
+        if framesPerOutput:
+            maxSegmentsPerOutput = max(1, int(round(float(framesPerOutput) / segmentDuration)))
+
+        result = {'segmentDuration': segmentDuration, 'maxSegmentsPerOutput': maxSegmentsPerOutput,
+                    'secondsPerFrame': secondsPerFrame, 'source': source}
+        logger.info('Segment plan for %s frames with %s: %s frame segments, %.2fs per frame from %s.' %
+                        (frameCount, self.preset, segmentDuration, secondsPerFrame, source))
+        return result
@@ -8,8 +8,25 @@ Provides methods to assist in working with image sequences
 
 '''
 
-import os, sys, re, glob, hashlib, DictDifferences
+import os, sys, re, glob, hashlib
+import FileLock
 import logging
+import bisect
+import numbers
+import heapq
+import time
+import math
+import mmap
+import struct
+import binascii
+import tempfile
+import getpass
+import threading
+import shutil
+import errno
+from array import array
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 # Qube workaraound
 try:
@@ -19,47 +36,2447 @@ except:
     sys.path.append('/System/Library/Frameworks/Python.framework/Versions/2.5/lib/python2.5/lib-dynload/')
     import sqlite3
 
+# Blender runs this module under Python 3
+try:
+    xrange
+except NameError:
+    xrange = range
+
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
+
+try:
+    stringTypes = basestring
+except NameError:
+    stringTypes = str
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+'''
+Set up the logging module.
+'''
+''' Setup the logger. '''
+# logging.basicConfig()
+logger = logging.getLogger(__name__)
+# logger.setLevel(logging.DEBUG)
+
+import frameVerifier
+PIL = frameVerifier.PIL
+
+NUMPY = False
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    pass
+
+
+'''
+Frame Sets
+Frame ranges are stored as sorted (start, end, step) intervals
+so huge ranges are never expanded into lists of frame numbers.
+'''
+
+# Single range item, Ex: 10 or 1-100 or 1-100x5
+rangePattern = re.compile(r'^(-?\d+)(?:-(-?\d+))?(?:x(\d+))?$')
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+def _modInverse(value, modulus):
+    '''
+    Modular inverse of value using the extended euclidean algorithm.
+    value and modulus must be coprime.
+    '''
+
+    if modulus == 1:
+        return 0
+    r0, r1 = value % modulus, modulus
+    s0, s1 = 1, 0
+    while r1:
+        q = r0 // r1
+        r0, r1 = r1, r0 - q * r1
+        s0, s1 = s1, s0 - q * s1
+    return s0 % modulus
+
+def _intervalLength(interval):
+    start, end, step = interval
+    return (end - start) // step + 1
+
+def _intersectIntervals(a, b):
+    '''
+    Intersect two (start, end, step) intervals.
+    The result is a single interval or None.
+    '''
+
+    aStart, aEnd, aStep = a
+    bStart, bEnd, bStep = b
+    low = max(aStart, bStart)
+    high = min(aEnd, bEnd)
+    if low > high:
+        return None
+
+    # Frames must satisfy x = aStart (mod aStep) and x = bStart (mod bStep)
+    divisor = _gcd(aStep, bStep)
+    if (bStart - aStart) % divisor:
+        return None
+    step = aStep // divisor * bStep
+    modulus = bStep // divisor
+    t = ((bStart - aStart) // divisor * _modInverse(aStep // divisor, modulus)) % modulus
+    first = aStart + aStep * t
+    first += -((first - low) // step) * step
+    if first > high:
+        return None
+    last = first + ((high - first) // step) * step
+    if first == last:
+        step = 1
+    return (first, last, step)
+
+def _subtractIntervals(a, b):
+    '''
+    Remove the frames of interval b from interval a.
+    Returns a sorted list of intervals with disjoint spans.
+    '''
+
+    common = _intersectIntervals(a, b)
+    if common is None:
+        return [a]
+
+    aStart, aEnd, aStep = a
+    cStart, cEnd, cStep = common
+    result = []
+    if cStart > aStart:
+        result.append((aStart, cStart - aStep, aStep))
+
+    if cStart != cEnd:
+        stride = cStep // aStep
+        if stride == 2:
+            result.append((cStart + aStep, cEnd - aStep, cStep))
+        elif stride > 2:
+            for gapStart in xrange(cStart + aStep, cEnd, cStep):
+                result.append((gapStart, gapStart + cStep - 2 * aStep, aStep))
+
+    if cEnd < aEnd:
+        result.append((cEnd + aStep, aEnd, aStep))
+
+    return [_cleanInterval(i) for i in result]
+
+def _cleanInterval(interval):
+    '''
+    Snap the end of an interval onto its step and
+    give single frames a step of 1.
+    '''
+
+    start, end, step = interval
+    if start > end:
+        start, end = end, start
+    step = abs(step) or 1
+    end = start + ((end - start) // step) * step
+    if start == end:
+        step = 1
+    return (start, end, step)
+
+def _isSubInterval(a, b):
+    '''
+    Check if every frame of interval a is in interval b.
+    '''
+
+    aStart, aEnd, aStep = a
+    bStart, bEnd, bStep = b
+    if aStart < bStart or aEnd > bEnd or (aStart - bStart) % bStep:
+        return False
+    return aStart == aEnd or aStep % bStep == 0
+
+def _resolveOverlaps(intervals):
+    '''
+    Take intervals sorted by start that may overlap and return
+    intervals with disjoint spans.
+    Overlaps that are contained in the previous interval are trimmed
+    in constant time, interleaved stepped intervals are expanded and
+    compacted again.
+    '''
+
+    result = []
+    clusterEnd = None
+    cluster = []
+
+    def flushCluster():
+        if len(cluster) == 1:
+            result.append(cluster[0])
+            return
+        resolved = []
+        for current in cluster:
+            while current:
+                if not resolved or current[0] > resolved[-1][1]:
+                    resolved.append(current)
+                    break
+                previous = resolved[-1]
+                if current[0] < previous[0]:
+                    resolved = None
+                    break
+                start, end, step = current
+                if end <= previous[1]:
+                    inside, outside = current, None
+                else:
+                    first = start + ((previous[1] - start) // step + 1) * step
+                    inside = (start, first - step, step)
+                    outside = _cleanInterval((first, end, step))
+                if not _isSubInterval(_cleanInterval(inside), previous):
+                    resolved = None
+                    break
+                current = outside
+            if resolved is None:
+                break
+
+        if resolved is None:
+            frames = set()
+            for start, end, step in cluster:
+                frames.update(xrange(start, end + 1, step))
+            resolved = list(_compressFrames(sorted(frames)))
+        result.extend(resolved)
+
+    for interval in intervals:
+        if cluster and interval[0] > clusterEnd:
+            flushCluster()
+            cluster = []
+        if not cluster:
+            clusterEnd = interval[1]
+        else:
+            clusterEnd = max(clusterEnd, interval[1])
+        cluster.append(interval)
+    if cluster:
+        flushCluster()
+
+    return result
+
+def _compressFrames(frames):
+    '''
+    Compress sorted, unique frame numbers into intervals.
+    '''
+
+    return _compressIntervals((frame, frame, 1) for frame in frames)
+
+def _compressIntervals(intervals):
+    '''
+    Merge sorted intervals with disjoint spans into their canonical form.
+    This is a greedy run detection over the frames, done one interval
+    at a time so long intervals are never expanded.
+    Runs with a step greater than 1 need at least 3 frames,
+    Ex: 1,3,4,5 -> 1,3-5 rather than 1-3x2,4-5
+    '''
+
+    runStart = runEnd = runStep = None
+    runCount = 0
+
+    for start, end, step in intervals:
+        count = (end - start) // step + 1
+        while count:
+            if not runCount:
+                runStart = runEnd = start
+                runStep, runCount = 1, 1
+                if count > 1:
+                    runEnd, runStep, runCount = end, step, count
+                count = 0
+
+            elif runCount == 1:
+                runStep = start - runStart
+                runEnd, runCount = start, 2
+                if count > 1 and step == runStep:
+                    runEnd, runCount = end, count + 1
+                    count = 0
+                else:
+                    start += step
+                    count -= 1
+
+            elif start - runEnd == runStep:
+                runEnd, runCount = start, runCount + 1
+                if count > 1 and step == runStep:
+                    runEnd, runCount = end, runCount + count - 1
+                    count = 0
+                else:
+                    start += step
+                    count -= 1
+
+            elif runCount == 2 and runStep > 1:
+                yield (runStart, runStart, 1)
+                runStart, runCount, runStep = runEnd, 1, 1
+
+            else:
+                yield (runStart, runEnd, runStep)
+                runCount = 0
+
+    if runCount == 2 and runStep > 1:
+        yield (runStart, runStart, 1)
+        yield (runEnd, runEnd, 1)
+    elif runCount:
+        yield (runStart, runEnd, runStep)
+
+
+class FrameSet(object):
+    '''
+    A set of frame numbers stored as sorted, non-overlapping
+    (start, end, step) intervals.
+    Ex: 1-5,10,20-30x5 -> [(1, 5, 1), (10, 10, 1), (20, 30, 5)]
+
+    Set operations, membership and conversion to range strings
+    work on the intervals, so the cost depends on the number of
+    ranges rather than the number of frames.
+    FrameSets are immutable, operations return new FrameSets.
+    '''
+
+    def __init__(self, frames=None):
+        '''
+        Frames can be a range string, another FrameSet,
+        a single frame number or an iterable of frame numbers.
+        '''
+
+        if frames is None:
+            intervals = []
+        elif isinstance(frames, FrameSet):
+            intervals = frames._intervals
+        elif isinstance(frames, stringTypes):
+            intervals = _resolveOverlaps(sorted(self._parseRanges(frames)))
+        elif isinstance(frames, numbers.Number):
+            frame = int(round(frames))
+            intervals = [(frame, frame, 1)]
+        else:
+            intervals = _compressFrames(sorted(set(int(frame) for frame in frames)))
+        self._setIntervals(intervals)
+
+    @classmethod
+    def fromRange(cls, start, end, step=1):
+        '''
+        Create a FrameSet from a start and end frame(inclusive).
+        '''
+
+        return cls._fromIntervals([_cleanInterval((int(start), int(end), int(step)))])
+
+    @classmethod
+    def _fromIntervals(cls, intervals):
+        '''
+        Create a FrameSet from sorted intervals with disjoint spans.
+        '''
+
+        result = cls()
+        result._setIntervals(intervals)
+        return result
+
+    def _setIntervals(self, intervals):
+        self._intervals = list(_compressIntervals(intervals))
+        self._starts = [interval[0] for interval in self._intervals]
+        self._length = sum(_intervalLength(interval) for interval in self._intervals)
+
+    def _parseRanges(self, frameRange):
+        '''
+        Parse a range string into intervals.
+        Ex: 1,20-25,30-40x2 -> (1, 1, 1), (20, 25, 1), (30, 40, 2)
+        '''
+
+        for item in frameRange.replace(' ', '').split(','):
+            if not item:
+                continue
+            match = rangePattern.match(item)
+            if not match:
+                raise ValueError("Invalid frame range: " + str(frameRange))
+            start, end, step = match.groups()
+            if end is None:
+                end = start
+            yield _cleanInterval((int(start), int(end), int(step or 1)))
+
+    def getIntervals(self):
+        '''
+        Return a list of the (start, end, step) intervals.
+        '''
+
+        return list(self._intervals)
+
+    def getStart(self):
+        if not self._intervals:
+            raise IndexError("FrameSet is empty")
+        return self._intervals[0][0]
+
+    def getEnd(self):
+        if not self._intervals:
+            raise IndexError("FrameSet is empty")
+        return self._intervals[-1][1]
+
+    def union(self, other):
+        other = loadFrameRange(other)
+        merged = heapq.merge(self._intervals, other._intervals)
+        return FrameSet._fromIntervals(_resolveOverlaps(merged))
+
+    def intersection(self, other):
+        other = loadFrameRange(other)
+        a, b = self._intervals, other._intervals
+        result = []
+        i = j = 0
+        while i < len(a) and j < len(b):
+            common = _intersectIntervals(a[i], b[j])
+            if common:
+                result.append(common)
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return FrameSet._fromIntervals(result)
+
+    def difference(self, other):
+        other = loadFrameRange(other)
+        removals = other._intervals
+        result = []
+        j = 0
+        for interval in self._intervals:
+            while j < len(removals) and removals[j][1] < interval[0]:
+                j += 1
+
+            pending = [interval]
+            k = j
+            while k < len(removals) and removals[k][0] <= interval[1]:
+                removal = removals[k]
+                remaining = []
+                for piece in pending:
+                    if piece[1] < removal[0]:
+                        result.append(piece)
+                    elif piece[0] > removal[1]:
+                        remaining.append(piece)
+                    else:
+                        remaining.extend(_subtractIntervals(piece, removal))
+                pending = remaining
+                k += 1
+            result.extend(pending)
+
+        return FrameSet._fromIntervals(result)
+
+    def toString(self):
+        '''
+        Convert the FrameSet into a range string.
+        Ex: 1,2,3,4,5,10,20,25,30 -> 1-5,10,20-30x5
+        '''
+
+        ranges = []
+        for start, end, step in self._intervals:
+            if start == end:
+                ranges.append(str(start))
+            elif step == 1:
+                ranges.append('%s-%s' % (start, end))
+            else:
+                ranges.append('%s-%sx%s' % (start, end, step))
+        return ','.join(ranges)
+
+    def __contains__(self, frame):
+        try:
+            frame = int(frame)
+        except (TypeError, ValueError):
+            return False
+        index = bisect.bisect_right(self._starts, frame) - 1
+        if index < 0:
+            return False
+        start, end, step = self._intervals[index]
+        return frame <= end and (frame - start) % step == 0
+
+    def __iter__(self):
+        for start, end, step in self._intervals:
+            for frame in xrange(start, end + 1, step):
+                yield frame
+
+    def __len__(self):
+        return self._length
+
+    def __nonzero__(self):
+        return bool(self._intervals)
+
+    __bool__ = __nonzero__
+
+    def __eq__(self, other):
+        if not isinstance(other, FrameSet):
+            return NotImplemented
+        return self._intervals == other._intervals
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(tuple(self._intervals))
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __str__(self):
+        return self.toString()
+
+    def __repr__(self):
+        return 'FrameSet(%r)' % self.toString()
+
+
+def loadFrameRange(frameRange):
+    '''
+    Parse an input frame range into a FrameSet
+    Ex: 1,20-25,22,100 -> 1,20-25,100
+    Input can also be a FrameSet or a list of frames.
+    '''
+
+    if isinstance(frameRange, FrameSet):
+        return frameRange
+    return FrameSet(frameRange)
+
+'''
+Folder Indexes
+A folder is listed once and every file that looks like part of an
+image sequence is indexed by prefix and extension.  Queries revalidate
+against the folder's modification time instead of touching every frame.
+'''
+
+# Sequence file name, Ex: shot_00001.png -> shot_, 00001, .png
+sequencePattern = re.compile(r'(.+?)(\d\d+?)(\.\w+)')
+frameFilePattern = re.compile(r'(.+?)(\d\d+?)(\.\w+)$')
+
+# Folders modified this recently(seconds) are rescanned on every query,
+# since an addition in the same mtime tick wouldn't change the mtime.
+INDEXRACEWINDOW = 2.0
+
+folderIndexes = {}
+
+def listFolder(folder):
+    '''
+    Return (name, entry) for each file in the folder using a single listing.
+    entry is None when scandir isn't available or
+    the listing came from the node cache.
+    '''
+
+    return readFolder(folder)[2]
+
+def readFolder(folder):
+    '''
+    List a folder, sharing the listing with other processes on the node.
+    Returns (mtime, scanTime, entries) where scanTime is when the listing
+    was taken and entries is a list of (name, entry) like listFolder.
+    Raises OSError if the folder doesn't exist.
+    '''
+
+    now = time.time()
+    cache = getNodeCache()
+    cached = None
+    if cache is not None:
+        cached = cache.getListing(folder)
+        if cached is not None and now - cached[2] < NODECACHELISTINGTTL:
+            return cached[0], cached[1], [(name, None) for name in cached[3]]
+
+    mtime = os.stat(folder).st_mtime
+    if cached is not None and mtime == cached[0] and mtime < cached[1] - INDEXRACEWINDOW:
+        cache.touchListing(folder, now)
+        return cached[0], cached[1], [(name, None) for name in cached[3]]
+
+    if scandir is not None:
+        entries = [(entry.name, entry) for entry in scandir(folder)]
+    else:
+        entries = [(name, None) for name in os.listdir(folder)]
+    if cache is not None:
+        cache.setListing(folder, mtime, now, [name for name, entry in entries])
+    return mtime, now, entries
+
+def getFolderIndex(folder, withStats=False):
+    '''
+    Get the shared FolderIndex for a folder, creating it if needed.
+    withStats keeps the size and mtime of every indexed file.
+    '''
+
+    folder = os.path.abspath(folder or '.')
+    index = folderIndexes.get(folder)
+    if index is None:
+        index = FolderIndex(folder, withStats)
+        folderIndexes[folder] = index
+    else:
+        index.refresh()
+        if withStats and not index.withStats:
+            index.withStats = True
+            index.loadStats()
+    return index
+
+class FolderIndex(object):
+    '''
+    Index of the sequence files in a folder built from one directory listing.
+    Stores for each (prefix, extension) a dictionary of frame -> file name.
+    Stat data is taken from the listing entries when withStats is on,
+    otherwise it's loaded on request.  Both are kept until the folder changes.
+    '''
+
+    def __init__(self, folder, withStats=False):
+        self.folder = folder
+        self.withStats = withStats
+        self.mtime = None
+        self.scanTime = None
+        self.sequences = {}
+        self.stats = {}
+        self._frameSets = {}
+        self.scan()
+
+    def scan(self):
+        '''
+        List the folder and parse every file name into the index.
+        '''
+
+        self.sequences = {}
+        self.stats = {}
+        self._frameSets = {}
+        try:
+            self.mtime, self.scanTime, entries = readFolder(self.folder)
+        except OSError:
+            self.mtime = None
+            self.scanTime = time.time()
+            logger.debug("Unable to index missing folder %s" % self.folder)
+            return
+
+        match = frameFilePattern.match
+        for name, entry in entries:
+            parts = match(name)
+            if parts:
+                prefix, digits, extension = parts.groups()
+                self.sequences.setdefault((prefix, extension), {})[int(digits)] = name
+                if self.withStats and entry is not None:
+                    st = entry.stat()
+                    self.stats[name] = (st.st_size, st.st_mtime)
+
+        if self.withStats:
+            self.loadStats()
+
+        logger.debug("Indexed %s sequences in %s" % (len(self.sequences), self.folder))
+
+    def refresh(self):
+        '''
+        Rescan the folder if it changed since the last scan.
+        Returns True if the index was rebuilt.
+        '''
+
+        cache = getNodeCache()
+        if cache is not None:
+            stamp = cache.getListingStamp(self.folder)
+            if stamp is not None and time.time() - stamp[2] < NODECACHELISTINGTTL:
+                if (stamp[0], stamp[1]) != (self.mtime, self.scanTime):
+                    self.scan()
+                    return True
+                return False
+
+        try:
+            mtime = os.stat(self.folder).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.mtime or (mtime is not None and mtime >= self.scanTime - INDEXRACEWINDOW):
+            self.scan()
+            return True
+        return False
+
+    def getFrameNames(self, prefix, extension):
+        '''
+        Return the dictionary of frame -> file name for a sequence.
+        '''
+
+        return self.sequences.get((prefix, extension), {})
+
+    def getFrameSet(self, prefix, extension, padding=None):
+        '''
+        Return a FrameSet of the frames that exist for a sequence.
+        If padding is supplied, only file names that match
+        the padding are included.  Ex: 00001 for a padding of 5
+        '''
+
+        key = (prefix, extension, padding)
+        result = self._frameSets.get(key)
+        if result is None:
+            frames = self.getFrameNames(prefix, extension)
+            if padding:
+                start = len(prefix)
+                frames = [frame for frame, name in frames.items()
+                            if self._matchesPadding(name[start:len(name) - len(extension)], padding)]
+            result = FrameSet(frames)
+            self._frameSets[key] = result
+        return result
+
+    def _matchesPadding(self, digits, padding):
+        return len(digits) == padding or (len(digits) > padding and digits[0] != '0')
+
+    def getStat(self, name):
+        '''
+        Return the (size, mtime) of an indexed file.
+        '''
+
+        result = self.stats.get(name)
+        if result is None:
+            st = os.stat(os.path.join(self.folder, name))
+            result = (st.st_size, st.st_mtime)
+            self.stats[name] = result
+        return result
+
+    def loadStats(self):
+        '''
+        Load the stat data for every indexed file that doesn't have it yet.
+        '''
+
+        names = [name for frames in self.sequences.values()
+                    for name in frames.values() if name not in self.stats]
+        paths = [os.path.join(self.folder, name) for name in names]
+        for name, stat in izip(names, collectStats(paths)):
+            if stat is not None:
+                self.stats[name] = stat
+
+'''
+Frame Stats
+Size and modification time collection for large sequences.
+Where the directory listing carries stat data it's used directly,
+otherwise frames are stat'ed serially and switch over to a bounded
+thread pool when the mount shows high latency.
+'''
+
+# Directory listings only include stat data on Windows
+LISTINGSTATS = os.name == 'nt'
+
+STATTHREADS = 16
+STATPROBECOUNT = 32
+STATLATENCYTHRESHOLD = 0.001 # Seconds per stat before switching to threads
+STATCHUNKSIZE = 256
+
+try:
+    array('q')
+    sizeTypecode = 'q'
+except ValueError:
+    sizeTypecode = 'l'
+
+def _statPath(path):
+    try:
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime)
+    except OSError:
+        return None
+
+def collectStats(paths, threads=STATTHREADS):
+    '''
+    Stat a list of paths and return a list of (size, mtime)
+    in the same order, None for paths that don't exist.
+    Recent results from other processes on the node are reused
+    from the node cache.  Results are only shared from slow mounts,
+    local disks are quicker to stat again.
+    '''
+
+    paths = list(paths)
+    cache = getNodeCache()
+    if cache is None:
+        return _collectStats(paths, threads)[0]
+
+    cached = cache.getStats(paths)
+    toStat = [path for path in paths if path not in cached]
+    if toStat:
+        stats, latency = _collectStats(toStat, threads)
+        if latency > STATLATENCYTHRESHOLD:
+            cache.setStats([(path, stat) for path, stat in izip(toStat, stats) if stat is not None])
+        cached.update(izip(toStat, stats))
+    return [cached[path] for path in paths]
+
+def _collectStats(paths, threads):
+    '''
+    The first few paths are stat'ed serially to measure latency,
+    if it's high the rest are spread over a pool of threads.
+    Returns (stats, latency) where latency is seconds per stat.
+    '''
+
+    if not paths:
+        return [], 0
+    probe = paths[:STATPROBECOUNT]
+    probeStart = time.time()
+    result = [_statPath(path) for path in probe]
+    latency = (time.time() - probeStart) / len(probe)
+    remaining = paths[len(probe):]
+    if not remaining:
+        return result, latency
+
+    if threads > 1 and latency > STATLATENCYTHRESHOLD:
+        logger.debug("Stat latency %.2fms, using %s threads" % (latency * 1000, threads))
+        pool = ThreadPool(threads)
+        try:
+            result.extend(pool.imap(_statPath, remaining, STATCHUNKSIZE))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        result.extend(_statPath(path) for path in remaining)
+    return result, latency
+
+class FrameStats(object):
+    '''
+    Size and modification time for a set of frames
+    stored as parallel arrays sorted by frame number.
+    '''
+
+    def __init__(self, frames=(), sizes=(), mtimes=()):
+        self.frames = array('l', frames)
+        self.sizes = array(sizeTypecode, sizes)
+        self.mtimes = array('d', mtimes)
+
+    def get(self, frame, default=None):
+        '''
+        Return the (size, mtime) of a frame.
+        '''
+
+        index = bisect.bisect_left(self.frames, frame)
+        if index < len(self.frames) and self.frames[index] == frame:
+            return (self.sizes[index], self.mtimes[index])
+        return default
+
+    def getFrameSet(self):
+        return FrameSet._fromIntervals((frame, frame, 1) for frame in self.frames)
+
+    def __contains__(self, frame):
+        return self.get(frame) is not None
+
+    def __iter__(self):
+        '''
+        Iterate over (frame, size, mtime)
+        '''
+
+        return izip(self.frames, self.sizes, self.mtimes)
+
+    def __len__(self):
+        return len(self.frames)
+
+'''
+Node Cache
+Several subjobs on a node often list and stat the same network
+folders at once.  Listings and stat results are shared between the
+processes through a small sqlite file in the temp folder.  A listing is
+used as is for a few seconds, then revalidated against the folder's
+modification time.  Stat results are only kept for a couple of seconds,
+since frames can be rewritten without changing the folder.
+Frames written by other processes or nodes in the last
+NODECACHELISTINGTTL seconds can be missing from a cached listing.
+Turn NODECACHE off where a listing has to be current.
+'''
+
+NODECACHE = True
+try:
+    NODECACHEFILE = os.path.join(tempfile.gettempdir(), 'sequenceTools.%s.cache.db' % getpass.getuser())
+except Exception:
+    NODECACHEFILE = os.path.join(tempfile.gettempdir(), 'sequenceTools.cache.db')
+NODECACHELISTINGTTL = 5.0 # Seconds a listing is used without checking the folder, newer frames can be missed
+NODECACHESTATTTL = 2.0 # Seconds a stat result is reused
+NODECACHETIMEOUT = 5.0
+NODECACHEPURGEAGE = 3600.0 # Entries unused for this long are removed
+NODECACHEPURGEINTERVAL = 300.0
+
+nodeCache = None
+
+def getNodeCache():
+    '''
+    Get the node cache for this process, opening it if needed.
+    Returns None if the node cache is off or can't be opened.
+    '''
+
+    global nodeCache, NODECACHE
+    if not NODECACHE:
+        return None
+    if nodeCache is not None and nodeCache.pid == os.getpid() and nodeCache.filename == NODECACHEFILE:
+        return nodeCache
+    try:
+        nodeCache = NodeCache(NODECACHEFILE)
+    except sqlite3.Error as e:
+        logger.warning("Unable to open the node cache %s, %s" % (NODECACHEFILE, e))
+        nodeCache = None
+        NODECACHE = False
+    return nodeCache
+
+def invalidateNodeCache(folder):
+    '''
+    Forget the listing and stat results for a folder after changing it.
+    '''
+
+    folder = os.path.abspath(folder or '.')
+    cache = getNodeCache()
+    if cache is not None:
+        cache.invalidate(folder)
+    index = folderIndexes.get(folder)
+    if index is not None:
+        index.scan()
+
+class NodeCache(object):
+    '''
+    Listings and stat results shared by every process on the node.
+    Any error reading or writing the cache is treated as a miss,
+    so the cache can never stop a job.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.purgeTime = 0
+        self.conn = sqlite3.connect(filename, timeout=NODECACHETIMEOUT,
+                                    isolation_level=None, check_same_thread=False)
+        if sys.version_info[0] < 3:
+            self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS listings '
+                            '(folder TEXT PRIMARY KEY, mtime REAL, scanTime REAL, checked REAL, names TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats '
+                            '(folder TEXT, name TEXT, size INTEGER, mtime REAL, checked REAL, '
+                            'PRIMARY KEY (folder, name))')
+
+    def _execute(self, sql, args=(), many=False):
+        '''
+        Run a statement and return all of the rows, or None on error.
+        '''
+
+        with self.lock:
+            try:
+                if many:
+                    self.conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        self.conn.executemany(sql, args)
+                        self.conn.execute('COMMIT')
+                    except:
+                        self.conn.execute('ROLLBACK')
+                        raise
+                    return []
+                return self.conn.execute(sql, args).fetchall()
+            except (sqlite3.Error, ValueError) as e:
+                logger.debug("Node cache error: %s" % e)
+                return None
+
+    def _split(self, path):
+        '''
+        Quicker os.path.split for the paths we build with os.path.join
+        '''
+
+        if os.altsep:
+            return os.path.split(path)
+        folder, sep, name = path.rpartition(os.sep)
+        return (folder or sep, name)
+
+    def getListingStamp(self, folder):
+        '''
+        Return (mtime, scanTime, checked) of a folder's listing.
+        '''
+
+        rows = self._execute('SELECT mtime, scanTime, checked FROM listings WHERE folder = ?', (folder,))
+        if rows:
+            return rows[0]
+        return None
+
+    def getListing(self, folder):
+        '''
+        Return (mtime, scanTime, checked, names) of a folder's listing.
+        '''
+
+        rows = self._execute('SELECT mtime, scanTime, checked, names FROM listings WHERE folder = ?', (folder,))
+        if rows:
+            mtime, scanTime, checked, names = rows[0]
+            return mtime, scanTime, checked, names.split('/') if names else []
+        return None
+
+    def setListing(self, folder, mtime, scanTime, names):
+        # File names can't contain a slash, so it separates them
+        self._execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+                        [(folder, mtime, scanTime, scanTime, '/'.join(names))], many=True)
+        self.purge()
+
+    def touchListing(self, folder, checked):
+        self._execute('UPDATE listings SET checked = ? WHERE folder = ?', [(checked, folder)], many=True)
+
+    def getStats(self, paths):
+        '''
+        Return a dictionary of path -> (size, mtime) for the
+        paths with a recent stat result.
+        '''
+
+        byFolder = {}
+        for path in paths:
+            folder, name = self._split(path)
+            byFolder.setdefault(folder, {})[name] = path
+
+        oldest = time.time() - NODECACHESTATTTL
+        result = {}
+        for folder, names in byFolder.items():
+            rows = self._execute('SELECT name, size, mtime FROM stats WHERE folder = ? AND checked >= ?',
+                                    (folder, oldest))
+            for name, size, mtime in rows or ():
+                path = names.get(name)
+                if path is not None:
+                    result[path] = (size, mtime)
+        return result
+
+    def setStats(self, stats):
+        '''
+        Store a list of (path, (size, mtime))
+        '''
+
+        now = time.time()
+        rows = [self._split(path) + stat + (now,) for path, stat in stats]
+        if rows:
+            self._execute('INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?)', rows, many=True)
+
+    def invalidate(self, folder):
+        self._execute('DELETE FROM listings WHERE folder = ?', [(folder,)], many=True)
+        self._execute('DELETE FROM stats WHERE folder = ?', [(folder,)], many=True)
+
+    def purge(self):
+        '''
+        Remove entries that haven't been used for a while,
+        at most once every NODECACHEPURGEINTERVAL seconds.
+        '''
+
+        now = time.time()
+        if now - self.purgeTime < NODECACHEPURGEINTERVAL:
+            return
+        self.purgeTime = now
+        oldest = now - NODECACHEPURGEAGE
+        self._execute('DELETE FROM listings WHERE checked < ?', [(oldest,)], many=True)
+        self._execute('DELETE FROM stats WHERE checked < ?', [(oldest,)], many=True)
+
+    def close(self):
+        self.conn.close()
+
+'''
+Sequence Statistics
+Size distribution and render rates computed from the stat data
+of one scan.  Frames much smaller than their neighbours are
+likely truncated, so they're the first candidates for verification.
+'''
+
+STATSOUTLIERWINDOW = 5 # Neighbours on each side compared against
+STATSOUTLIERRATIO = 0.5 # Flag frames smaller than this share of the neighbours' median
+STATSHISTOGRAMBINS = 10
+
+def formatBytes(size):
+    '''
+    Format a byte count to be a little easier to read.
+    Ex: 1536 -> 1.5 KB
+    '''
+
+    for unit in ['bytes','KB','MB','GB','TB']:
+        if size < 1024.0:
+            return "%3.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%3.1f %s" % (size, 'PB')
+
+def _median(values):
+    values = sorted(values)
+    count = len(values)
+    if not count:
+        return None
+    middle = count // 2
+    if count % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class SequenceStats(object):
+    '''
+    Statistics for the frames of a FrameStats object.
+    '''
+
+    def __init__(self, frameStats):
+        self.frameStats = frameStats
+        self.count = len(frameStats)
+        self.totalBytes = sum(frameStats.sizes)
+        self.minSize = None
+        self.maxSize = None
+        self.medianSize = None
+        if self.count:
+            self.minSize = min(frameStats.sizes)
+            self.maxSize = max(frameStats.sizes)
+            self.medianSize = _median(frameStats.sizes)
+
+    def getHistogram(self, bins=STATSHISTOGRAMBINS):
+        '''
+        Return a list of (low, high, count) for evenly sized bins
+        between the smallest and largest frame.
+        '''
+
+        if not self.count:
+            return []
+        width = max(1, int(math.ceil((self.maxSize - self.minSize + 1) / float(bins))))
+        counts = [0] * bins
+        for size in self.frameStats.sizes:
+            counts[min(bins - 1, (size - self.minSize) // width)] += 1
+        return [(self.minSize + index * width, self.minSize + (index + 1) * width - 1, count)
+                    for index, count in enumerate(counts)]
+
+    def getOutliers(self, window=STATSOUTLIERWINDOW, ratio=STATSOUTLIERRATIO):
+        '''
+        Return a FrameSet of frames much smaller than their neighbours.
+        Each frame is compared to the median size of the frames around it,
+        so gradual changes in frame size over a shot aren't flagged.
+        Empty frames are always flagged.
+        '''
+
+        sizes = self.frameStats.sizes
+        frames = self.frameStats.frames
+        result = []
+        for index in xrange(self.count):
+            size = sizes[index]
+            if size == 0:
+                result.append(frames[index])
+                continue
+            neighbours = sizes[max(0, index - window):index] + sizes[index + 1:index + 1 + window]
+            if neighbours:
+                median = _median(neighbours)
+                if size < median * ratio:
+                    result.append(frames[index])
+        return FrameSet(result)
+
+    def getRates(self):
+        '''
+        Return render rates based on the modification times of the frames.
+        Keys: start, end, seconds, framesPerHour, bytesPerSecond, secondsPerFrame
+        '''
+
+        result = {'start': None, 'end': None, 'seconds': 0.0, 'framesPerHour': None,
+                    'bytesPerSecond': None, 'secondsPerFrame': None}
+        if not self.count:
+            return result
+        result['start'] = min(self.frameStats.mtimes)
+        result['end'] = max(self.frameStats.mtimes)
+        seconds = result['end'] - result['start']
+        result['seconds'] = seconds
+        if seconds > 0 and self.count > 1:
+            ''' The first frame marks the start, so it isn't counted '''
+            result['framesPerHour'] = (self.count - 1) / seconds * 60 * 60
+            result['bytesPerSecond'] = self.totalBytes / seconds
+            result['secondsPerFrame'] = seconds / (self.count - 1)
+        return result
+
+    def __str__(self):
+        if not self.count:
+            return 'No frames'
+        return '%s frames, %s (min %s, median %s, max %s)' % (self.count,
+                    formatBytes(self.totalBytes), formatBytes(self.minSize),
+                    formatBytes(self.medianSize), formatBytes(self.maxSize))
+
+'''
+Sequence Discovery
+Find every sequence in a folder from a single listing
+without knowing any of the frame paths up front.
+'''
+
+DISCOVERTHREADS = 8
+
+class SequenceInfo(object):
+    '''
+    Summary of a sequence found by discoverSequences.
+    stats is a FrameStats of every frame, or None if
+    the sequence was discovered without stats.
+    '''
+
+    def __init__(self, folder, prefix, padding, extension, frames, stats=None):
+        self.folder = folder
+        self.prefix = prefix
+        self.padding = padding
+        self.extension = extension
+        self.frames = frames
+        self.stats = stats
+
+    def getTemplate(self):
+        return os.path.join(self.folder, self.prefix + '#' * self.padding + self.extension)
+
+    def getFrameFilename(self, frame):
+        frame = str(frame)
+        return os.path.join(self.folder, self.prefix + frame.zfill(self.padding) + self.extension)
+
+    def getGaps(self):
+        '''
+        Return a FrameSet of the missing frames between the first and last frame.
+        '''
+
+        if not self.frames:
+            return FrameSet()
+        return FrameSet.fromRange(self.frames.getStart(), self.frames.getEnd()) - self.frames
+
+    def getTotalBytes(self):
+        if self.stats is None:
+            return None
+        return sum(self.stats.sizes)
+
+    def getStats(self):
+        if self.stats is None:
+            return None
+        return SequenceStats(self.stats)
+
+    def getSequence(self, frameRange='ALL'):
+        '''
+        Return a Sequence object for the discovered sequence.
+        '''
+
+        return Sequence(self.getFrameFilename(self.frames.getStart()), frameRange)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return 'SequenceInfo(%r, %s)' % (self.getTemplate(), self.frames)
+
+def _groupByPadding(digitNames):
+    '''
+    Split (digits, name) pairs of one prefix and extension into
+    {padding: [(frame, name)]}.  Frames without a leading zero
+    belong to the widest padding they fit, Ex: 10000 with 0001
+    '''
+
+    padded = {}
+    unpadded = []
+    for digits, name in digitNames:
+        if digits[0] == '0':
+            padded.setdefault(len(digits), []).append((int(digits), name))
+        else:
+            unpadded.append((len(digits), int(digits), name))
+
+    paddings = sorted(padded)
+    if unpadded and not paddings:
+        paddings = [min(length for length, frame, name in unpadded)]
+    for length, frame, name in unpadded:
+        index = bisect.bisect_right(paddings, length) - 1
+        padded.setdefault(paddings[index], []).append((frame, name))
+    return padded
+
+def discoverSequences(folder, withStats=True, threads=STATTHREADS, minFrames=1):
+    '''
+    List a folder once and group every file into sequences by prefix,
+    padding and extension.  Returns a list of SequenceInfo sorted
+    by template.  Sequences with less than minFrames frames are skipped.
+    '''
+
+    startTime = time.time()
+    folder = os.path.abspath(folder)
+    match = frameFilePattern.match
+    groups = {}
+    entries = {}
+    for name, entry in listFolder(folder):
+        parts = match(name)
+        if parts:
+            prefix, digits, extension = parts.groups()
+            groups.setdefault((prefix, extension), []).append((digits, name))
+            entries[name] = entry
+
+    found = []
+    for (prefix, extension), digitNames in groups.items():
+        for padding, frames in _groupByPadding(digitNames).items():
+            if len(frames) >= minFrames:
+                frames.sort()
+                found.append((prefix, padding, extension, frames))
+
+    if withStats:
+        names = [name for sequence in found for frame, name in sequence[3]]
+        if LISTINGSTATS and scandir is not None:
+            stats = [entries[name].stat() for name in names]
+            stats = [(st.st_size, st.st_mtime) for st in stats]
+        else:
+            stats = collectStats([os.path.join(folder, name) for name in names], threads)
+        stats = iter(stats)
+
+    result = []
+    for prefix, padding, extension, frames in found:
+        frameStats = None
+        if withStats:
+            frameStats = FrameStats()
+            for (frame, name), stat in izip(frames, stats):
+                if stat is not None:
+                    frameStats.frames.append(frame)
+                    frameStats.sizes.append(stat[0])
+                    frameStats.mtimes.append(stat[1])
+            frameSet = frameStats.getFrameSet()
+        else:
+            frameSet = FrameSet(frame for frame, name in frames)
+        if frameSet:
+            result.append(SequenceInfo(folder, prefix, padding, extension, frameSet, frameStats))
+
+    result.sort(key=lambda info: info.getTemplate())
+    logger.debug("Discovered %s sequences in %s in %.3fs" % (len(result), folder, time.time() - startTime))
+    return result
+
+def discoverSequencesInFolders(folders, withStats=True, threads=DISCOVERTHREADS, minFrames=1):
+    '''
+    Discover the sequences in several folders at once using a pool of threads.
+    Returns a dictionary of folder -> list of SequenceInfo.
+    Folders that can't be listed are logged and left out.
+    '''
+
+    folders = list(folders)
+    statThreads = max(1, STATTHREADS // max(1, threads))
+
+    def discover(folder):
+        try:
+            return folder, discoverSequences(folder, withStats, statThreads, minFrames)
+        except OSError as e:
+            logger.warning("Unable to discover sequences in %s: %s" % (folder, e))
+            return folder, None
+
+    if threads > 1 and len(folders) > 1:
+        pool = ThreadPool(min(threads, len(folders)))
+        try:
+            results = pool.map(discover, folders)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [discover(folder) for folder in folders]
+    return dict((folder, sequences) for folder, sequences in results if sequences is not None)
+
+'''
+Content Hashes
+Used by smart update to ignore frames that were rewritten
+with identical contents.
+'''
+
+HASHTHREADS = 4
+HASHCHUNKSIZE = 1024 * 1024
+HASHMMAPSIZE = 16 * 1024 * 1024 # Frames at least this big are hashed through mmap
+
+def hashFile(path):
+    '''
+    Return an md5 hex digest of the file contents,
+    or None if the file can't be read.
+    '''
+
+    digest = hashlib.md5()
+    try:
+        f = open(path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size >= HASHMMAPSIZE:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    digest.update(mapped)
+                finally:
+                    mapped.close()
+            else:
+                chunk = f.read(HASHCHUNKSIZE)
+                while chunk:
+                    digest.update(chunk)
+                    chunk = f.read(HASHCHUNKSIZE)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return None
+    return digest.hexdigest()
+
+def collectHashes(paths, threads=HASHTHREADS):
+    '''
+    Hash a list of paths and return a list of digests in the same order.
+    hashlib releases the GIL on large buffers so threads
+    overlap reading and hashing.
+    '''
+
+    paths = list(paths)
+    if threads < 2 or len(paths) < 2:
+        return [hashFile(path) for path in paths]
+
+    pool = ThreadPool(min(threads, len(paths)))
+    try:
+        return pool.map(hashFile, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+'''
+Sequence Snapshots
+Columnar state of a sequence used by smart update to find
+the frames that changed between two transcodes.
+'''
+
+class SequenceSnapshot(FrameStats):
+    '''
+    Frame numbers, sizes and modification times stored as parallel
+    typed arrays sorted by frame, with an optional list of content hashes.
+    Sizes that aren't known are stored as MANIFESTUNKNOWN.
+    '''
+
+    def __init__(self, frames=(), sizes=(), mtimes=(), hashes=None):
+        FrameStats.__init__(self, frames, sizes, mtimes)
+        self.hashes = hashes
+
+    @classmethod
+    def fromRecords(cls, records):
+        '''
+        Create a snapshot from (frame, mtime, size, hash) records sorted by frame.
+        '''
+
+        result = cls(hashes=[])
+        for frame, mtime, size, digest in records:
+            result.frames.append(frame)
+            result.mtimes.append(mtime or 0.0)
+            if size is None:
+                size = MANIFESTUNKNOWN
+            result.sizes.append(size)
+            result.hashes.append(digest)
+        return result
+
+    def toRecords(self):
+        '''
+        Return a list of (frame, mtime, size, hash) records.
+        '''
+
+        hashes = self.hashes or [None] * len(self.frames)
+        return [(frame, mtime, size if size >= 0 else None, digest)
+                    for frame, mtime, size, digest in izip(self.frames, self.mtimes, self.sizes, hashes)]
+
+    def diff(self, past, useHashes=False):
+        '''
+        Compare this snapshot to a past snapshot.
+        Returns a dictionary of FrameSets for the Added, Deleted,
+        Modified and Constant frames.  Frames are modified when their
+        modification time differs, or their hash if useHashes is True.
+        Frames without a hash on both sides, like those of a snapshot saved
+        before hashes were used, are compared by modification time and size.
+        '''
+
+        if NUMPY and not useHashes:
+            return self._diffArrays(past)
+        return self._diffMerge(past, useHashes)
+
+    def _diffArrays(self, past):
+        '''
+        Vectorized diff of the frame and modification time arrays.
+        '''
+
+        current = numpy.array(self.frames, dtype=self.frames.typecode)
+        previous = numpy.array(past.frames, dtype=past.frames.typecode)
+        common, currentIndex, pastIndex = numpy.intersect1d(current, previous,
+                                            assume_unique=True, return_indices=True)
+        currentMtimes = numpy.array(self.mtimes, dtype='d')[currentIndex]
+        pastMtimes = numpy.array(past.mtimes, dtype='d')[pastIndex]
+        changed = currentMtimes != pastMtimes
+
+        result = {}
+        result['Added'] = FrameSet(numpy.setdiff1d(current, previous, assume_unique=True).tolist())
+        result['Deleted'] = FrameSet(numpy.setdiff1d(previous, current, assume_unique=True).tolist())
+        result['Modified'] = FrameSet(common[changed].tolist())
+        result['Constant'] = FrameSet(common[~changed].tolist())
+        return result
+
+    def _diffMerge(self, past, useHashes):
+        '''
+        Diff the snapshots with a single merge over the sorted frames.
+        '''
+
+        added, deleted, modified, constant = [], [], [], []
+        currentFrames, pastFrames = self.frames, past.frames
+        currentCount, pastCount = len(currentFrames), len(pastFrames)
+        currentHashes = (useHashes and self.hashes) or [None] * currentCount
+        pastHashes = (useHashes and past.hashes) or [None] * pastCount
+
+        i = j = 0
+        while i < currentCount and j < pastCount:
+            currentFrame, pastFrame = currentFrames[i], pastFrames[j]
+            if currentFrame == pastFrame:
+                if currentHashes[i] and pastHashes[j]:
+                    changed = currentHashes[i] != pastHashes[j]
+                else:
+                    changed = self.mtimes[i] != past.mtimes[j]
+                    if useHashes and not changed:
+                        currentSize, pastSize = self.sizes[i], past.sizes[j]
+                        changed = currentSize >= 0 and pastSize >= 0 and currentSize != pastSize
+                if not changed:
+                    constant.append(currentFrame)
+                else:
+                    modified.append(currentFrame)
+                i += 1
+                j += 1
+            elif currentFrame < pastFrame:
+                added.append(currentFrame)
+                i += 1
+            else:
+                deleted.append(pastFrame)
+                j += 1
+        added.extend(currentFrames[i:])
+        deleted.extend(pastFrames[j:])
+
+        result = {}
+        result['Added'] = FrameSet(added)
+        result['Deleted'] = FrameSet(deleted)
+        result['Modified'] = FrameSet(modified)
+        result['Constant'] = FrameSet(constant)
+        return result
+
+'''
+Modification Time Database
+Sqlite storage of each frame's modification time, size and
+an optional content hash, keyed by frame number.
+'''
+
+MODTIMEDBVERSION = 2
+MODTIMEDBJOURNALMODE = 'WAL'
+
+class ModTimeDB(object):
+    '''
+    Versioned modification time database.
+    Writes are done in bulk inside a single transaction and reads
+    are range queries on the frame number.
+    Version 1 databases (frames (name, modtime)) are migrated
+    automatically when they are opened.
+
+    WAL journaling needs every connection to be on the same host,
+    databases that are shared by several nodes over the network
+    should use a journalMode of DELETE.
+    '''
+
+    def __init__(self, filename, journalMode=MODTIMEDBJOURNALMODE):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=30)
+        self.conn.isolation_level = None
+        if journalMode:
+            self.conn.execute('PRAGMA journal_mode=%s' % journalMode)
+        self.setupSchema()
+
+    def getVersion(self):
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def setupSchema(self):
+        '''
+        Create the frames table or migrate an existing version 1 table.
+        '''
+
+        if self.getVersion() == MODTIMEDBVERSION:
+            return
+
+        curs = self.conn.cursor()
+        curs.execute('BEGIN IMMEDIATE')
+        try:
+            ''' Check again now that we hold the lock, another node may have migrated it. '''
+            if self.getVersion() != MODTIMEDBVERSION:
+                columns = [row[1] for row in curs.execute('PRAGMA table_info(frames)')]
+                if 'name' in columns:
+                    logger.info('Migrating modification time database %s' % self.filename)
+                    curs.execute('ALTER TABLE frames RENAME TO frames_v1')
+                self.createTables(curs)
+                if 'name' in columns:
+                    records = []
+                    for name, modTime in curs.execute('SELECT name, modtime FROM frames_v1'):
+                        match = frameFilePattern.match(os.path.basename(str(name)))
+                        if match:
+                            records.append((int(match.group(2)), modTime))
+                    curs.executemany('INSERT OR REPLACE INTO frames (frame, mtime) VALUES (?,?)', records)
+                    curs.execute('DROP TABLE frames_v1')
+                curs.execute('PRAGMA user_version = %d' % MODTIMEDBVERSION)
+            curs.execute('COMMIT')
+        except:
+            curs.execute('ROLLBACK')
+            raise
+
+    def createTables(self, curs):
+        curs.execute('CREATE TABLE IF NOT EXISTS frames '
+                        '(frame INTEGER PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT)')
+
+    def _rangeClauses(self, frames):
+        '''
+        Yield a (where clause, parameters) for each interval in the frames.
+        '''
+
+        for start, end, step in frames.getIntervals():
+            if step == 1:
+                yield 'frame BETWEEN ? AND ?', (start, end)
+            else:
+                yield 'frame BETWEEN ? AND ? AND (frame - ?) % ? = 0', (start, end, start, step)
+
+    def save(self, records, frames=None):
+        '''
+        Save (frame, mtime, size, hash) records in a single transaction.
+        If a FrameSet is supplied, existing records in those frames
+        are replaced, so deleted frames don't linger.
+        '''
+
+        curs = self.conn.cursor()
+        curs.execute('BEGIN IMMEDIATE')
+        try:
+            if frames is not None:
+                for clause, params in self._rangeClauses(frames):
+                    curs.execute('DELETE FROM frames WHERE ' + clause, params)
+            curs.executemany('INSERT OR REPLACE INTO frames (frame, mtime, size, hash) VALUES (?,?,?,?)', records)
+            curs.execute('COMMIT')
+        except:
+            curs.execute('ROLLBACK')
+            raise
+
+    def load(self, frames=None):
+        '''
+        Return a list of (frame, mtime, size, hash) sorted by frame,
+        limited to the supplied FrameSet.
+        '''
+
+        if frames is None:
+            return self.conn.execute('SELECT frame, mtime, size, hash FROM frames ORDER BY frame').fetchall()
+
+        result = []
+        for clause, params in self._rangeClauses(frames):
+            result.extend(self.conn.execute('SELECT frame, mtime, size, hash FROM frames WHERE '
+                                                + clause + ' ORDER BY frame', params))
+        return result
+
+    def close(self):
+        self.conn.close()
+
+'''
+Sequence Manifests
+Binary sidecar of each frame's modification time, size and content
+hash.  Records are fixed width and sorted by frame, so readers mmap
+the file and binary search the frames they need.  Writers append
+records to the end and compact() merges them back in.
+'''
+
+MANIFESTEXTENSION = '.manifest'
+MANIFESTMAGIC = b'QSEQMAN1'
+MANIFESTVERSION = 1
+MANIFESTLOCKTIMEOUT = 120 # Seconds
+MANIFESTCOMPACTRATIO = 0.25 # Compact once the appended records reach this share of the sorted ones
+MANIFESTCOMPACTMIN = 1024 # Records appended before compaction is considered
+MANIFESTUNKNOWN = -1 # Size stored for records without stat data
+MANIFESTDELETED = -2 # Size stored for frames that were removed
+
+# Magic, version, record size, reserved, sorted record count
+manifestHeader = struct.Struct('<8sHHIQ')
+# Frame, size, mtime, md5 digest
+manifestRecord = struct.Struct('<qqd16s')
+NODIGEST = b'\0' * 16
+
+def _packRecord(frame, mtime, size, digest):
+    if size is None:
+        size = MANIFESTUNKNOWN
+    if digest:
+        digest = binascii.unhexlify(digest)
+    else:
+        digest = NODIGEST
+    return manifestRecord.pack(frame, size, mtime or 0.0, digest)
+
+def _unpackRecord(record):
+    '''
+    Convert a raw manifest record into (frame, mtime, size, hash).
+    '''
+
+    frame, size, mtime, digest = record
+    if size < 0:
+        size = None
+    if digest == NODIGEST:
+        digest = None
+    else:
+        digest = str(binascii.hexlify(digest).decode('ascii'))
+    return (frame, mtime, size, digest)
+
+class SequenceManifest(object):
+    '''
+    Reader and writer for sequence manifest files.
+    Shares the save/load interface of ModTimeDB, records are
+    (frame, mtime, size, hash).
+
+    Layout:
+        header - magic, version, record size, sorted record count
+        sorted records - ordered by frame, one per frame
+        appended records - unordered, later records replace earlier ones
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _readHeader(self, f):
+        data = f.read(manifestHeader.size)
+        if len(data) < manifestHeader.size:
+            raise ValueError('Truncated sequence manifest %s' % self.filename)
+        magic, version, recordSize, reserved, sortedCount = manifestHeader.unpack(data)
+        if magic != MANIFESTMAGIC or recordSize != manifestRecord.size:
+            raise ValueError('%s is not a sequence manifest' % self.filename)
+        if version > MANIFESTVERSION:
+            raise ValueError('Unsupported sequence manifest version %s' % version)
+        return sortedCount
+
+    def _recordOffset(self, index):
+        return manifestHeader.size + index * manifestRecord.size
+
+    def _findFrame(self, mapped, count, frame):
+        '''
+        Binary search the sorted records for the first record >= frame.
+        '''
+
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if struct.unpack_from('<q', mapped, self._recordOffset(mid))[0] < frame:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _readRecords(self, mapped, start, end):
+        '''
+        Unpack the raw records from index start up to end.
+        '''
+
+        data = mapped[self._recordOffset(start):self._recordOffset(end)]
+        if hasattr(manifestRecord, 'iter_unpack'):
+            return list(manifestRecord.iter_unpack(data))
+        return [manifestRecord.unpack_from(data, offset)
+                    for offset in xrange(0, len(data), manifestRecord.size)]
+
+    def _readSortedRecords(self, mapped, sortedCount, frames):
+        if frames is None:
+            return self._readRecords(mapped, 0, sortedCount)
+
+        result = []
+        for start, end, step in frames.getIntervals():
+            first = self._findFrame(mapped, sortedCount, start)
+            last = self._findFrame(mapped, sortedCount, end + 1)
+            records = self._readRecords(mapped, first, last)
+            if step > 1:
+                records = [record for record in records if (record[0] - start) % step == 0]
+            result.extend(records)
+        return result
+
+    def loadRaw(self, frames=None):
+        '''
+        Return the raw records limited to the supplied FrameSet,
+        merged with the appended records and sorted by frame.
+        '''
+
+        if not os.path.exists(self.filename):
+            return []
+
+        f = open(self.filename, 'rb')
+        try:
+            sortedCount = self._readHeader(f)
+            totalCount = (os.fstat(f.fileno()).st_size - manifestHeader.size) // manifestRecord.size
+            if totalCount < 1:
+                return []
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                result = self._readSortedRecords(mapped, sortedCount, frames)
+                ''' A partial record at the end is an append in progress and is ignored. '''
+                appended = self._readRecords(mapped, sortedCount, totalCount)
+            finally:
+                mapped.close()
+        finally:
+            f.close()
+
+        if frames is not None:
+            appended = [record for record in appended if record[0] in frames]
+        if appended:
+            merged = dict((record[0], record) for record in result)
+            for record in appended:
+                merged[record[0]] = record
+            result = [merged[frame] for frame in sorted(merged)]
+        return [record for record in result if record[1] != MANIFESTDELETED]
+
+    def load(self, frames=None):
+        '''
+        Return a list of (frame, mtime, size, hash) sorted by frame,
+        limited to the supplied FrameSet.
+        '''
+
+        return [_unpackRecord(record) for record in self.loadRaw(frames)]
+
+    def getLock(self):
+        return FileLock.FileLock(self.filename, timeout=MANIFESTLOCKTIMEOUT)
+
+    def save(self, records, frames=None):
+        '''
+        Append (frame, mtime, size, hash) records to the manifest.
+        If a FrameSet is supplied, frames in it that aren't in the
+        records are marked deleted.  Compacts the manifest once
+        enough records have been appended.
+        '''
+
+        records = list(records)
+        packed = [_packRecord(*record) for record in records]
+        lock = self.getLock()
+        lock.acquire()
+        try:
+            if frames is not None:
+                saved = set(record[0] for record in records)
+                for record in self.loadRaw(frames):
+                    if record[0] not in saved:
+                        packed.append(manifestRecord.pack(record[0], MANIFESTDELETED, 0.0, NODIGEST))
+
+            if not os.path.exists(self.filename):
+                self._write([], self.filename)
+
+            f = open(self.filename, 'ab')
+            try:
+                f.write(b''.join(packed))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+            f = open(self.filename, 'rb')
+            try:
+                sortedCount = self._readHeader(f)
+                totalCount = (os.fstat(f.fileno()).st_size - manifestHeader.size) // manifestRecord.size
+            finally:
+                f.close()
+            appendedCount = totalCount - sortedCount
+            if appendedCount >= MANIFESTCOMPACTMIN and appendedCount >= sortedCount * MANIFESTCOMPACTRATIO:
+                self._compact()
+        finally:
+            lock.release()
+
+    def compact(self):
+        '''
+        Merge the appended records into the sorted records.
+        '''
+
+        lock = self.getLock()
+        lock.acquire()
+        try:
+            self._compact()
+        finally:
+            lock.release()
+
+    def _compact(self):
+        '''
+        Rewrite the manifest to a temporary file and rename it
+        over the original, so readers never see a partial file.
+        '''
+
+        startTime = time.time()
+        records = self.loadRaw()
+        tempFile = '%s.%s.tmp' % (self.filename, os.getpid())
+        self._write([manifestRecord.pack(*record) for record in records], tempFile)
+        replaceFile(tempFile, self.filename)
+        logger.debug("Compacted %s records in %.3fs" % (len(records), time.time() - startTime))
+
+    def _write(self, packed, filename):
+        f = open(filename, 'wb')
+        try:
+            f.write(manifestHeader.pack(MANIFESTMAGIC, MANIFESTVERSION, manifestRecord.size, 0, len(packed)))
+            f.write(b''.join(packed))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def close(self):
+        pass
+
+'''
+Sharded Manifests
+A folder of small manifests, one for each frame range saved, so
+nodes saving different segments of a sequence never write to the
+same file or wait on a lock.  Shards are named
+<generation>_<frames>.manifest, the generation is the time the shard
+was written and the frames are the range it replaces.  Readers merge
+the shards newest first, taking each frame from the newest shard
+whose range covers it.  compact() merges the shards back into one.
+'''
+
+SHARDEXTENSION = '.shards'
+SHARDMAXRANGELENGTH = 120 # Longer ranges are saved as one span
+SHARDLOADRETRIES = 5
+shardPattern = re.compile(r'^(\d+)_([-\d,x]+)' + re.escape(MANIFESTEXTENSION) + '$')
+
+class ShardedManifest(object):
+    '''
+    Reader and writer for a folder of manifest shards.
+    Shares the save/load interface of ModTimeDB and SequenceManifest.
+    '''
+
+    def __init__(self, folder):
+        self.filename = folder
+
+    def getShards(self):
+        '''
+        Return a (generation, frames, path) for each shard, newest first.
+        '''
+
+        try:
+            names = os.listdir(self.filename)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+
+        shards = []
+        for name in names:
+            match = shardPattern.match(name)
+            if match:
+                shards.append((int(match.group(1)), FrameSet(match.group(2)), os.path.join(self.filename, name)))
+        shards.sort(key=lambda shard: shard[0], reverse=True)
+        return shards
+
+    def _merge(self, shards, frames=None):
+        '''
+        Merge the records of the shards, newest first.
+        Raises an IOError or OSError if a shard disappeared.
+        '''
+
+        result = []
+        covered = FrameSet()
+        for generation, shardFrames, path in shards:
+            wanted = shardFrames - covered
+            if frames is not None:
+                wanted = wanted & frames
+            covered = covered | shardFrames
+            if not wanted:
+                continue
+            if not os.path.exists(path):
+                raise IOError(errno.ENOENT, 'Shard was removed', path)
+            result.extend(SequenceManifest(path).load(wanted))
+        result.sort()
+        return result
+
+    def load(self, frames=None):
+        '''
+        Return a list of (frame, mtime, size, hash) sorted by frame,
+        limited to the supplied FrameSet.
+        Shards removed by a compaction while reading are
+        reloaded from the compacted shard.
+        '''
+
+        for attempt in range(SHARDLOADRETRIES):
+            try:
+                return self._merge(self.getShards(), frames)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                logger.debug('Shard removed while loading %s, retrying.' % self.filename)
+        return self._merge(self.getShards(), frames)
+
+    def save(self, records, frames=None):
+        '''
+        Write (frame, mtime, size, hash) records to a new shard.
+        Frames in the supplied FrameSet that aren't in the records
+        are deleted.  Without a FrameSet the shard covers the frames
+        of the records.
+        '''
+
+        records = sorted(records)
+        if frames is None:
+            frames = FrameSet(record[0] for record in records)
+        frames = loadFrameRange(frames)
+        if not frames:
+            return
+
+        if len(frames.toString()) > SHARDMAXRANGELENGTH:
+            ''' Keep the records between the frames, the shard replaces the whole span. '''
+            span = FrameSet.fromRange(frames.getStart(), frames.getEnd())
+            records = sorted(records + self.load(span - frames))
+            frames = span
+        self._writeShard(records, frames, int(time.time() * 1000))
+
+    def _writeShard(self, records, frames, generation):
+        if not os.path.isdir(self.filename):
+            try:
+                os.makedirs(self.filename)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        path = os.path.join(self.filename, '%d_%s%s' % (generation, frames.toString(), MANIFESTEXTENSION))
+        tempFile = os.path.join(self.filename, '.%s.%s.tmp' % (os.path.basename(path), os.getpid()))
+        try:
+            SequenceManifest(tempFile)._write([_packRecord(*record) for record in records], tempFile)
+            replaceFile(tempFile, path)
+        except:
+            if os.path.exists(tempFile):
+                os.remove(tempFile)
+            raise
+        return path
+
+    def compact(self, timeout=MANIFESTLOCKTIMEOUT):
+        '''
+        Merge every shard into one shard.  The merged shard keeps the
+        generation of the oldest shard it merged, so shards saved while
+        compacting still win, even from a node whose clock is behind.
+        The merged shards are removed afterwards.
+        Returns False if another process was already compacting.
+        '''
+
+        lock = FileLock.FileLock(os.path.join(self.filename, 'compact'), timeout=timeout)
+        try:
+            lock.acquire()
+        except FileLock.FileLockException:
+            logger.debug('Another process is compacting %s' % self.filename)
+            return False
+
+        try:
+            startTime = time.time()
+            shards = self.getShards()
+            if len(shards) < 2:
+                return True
+            records = self._merge(shards)
+            starts = [shardFrames.getStart() for generation, shardFrames, path in shards if shardFrames]
+            ends = [shardFrames.getEnd() for generation, shardFrames, path in shards if shardFrames]
+            merged = self._writeShard(records, FrameSet.fromRange(min(starts), max(ends)), shards[-1][0])
+            for generation, shardFrames, path in shards:
+                if path != merged:
+                    os.remove(path)
+            logger.debug("Compacted %s shards with %s records in %.3fs" %
+                            (len(shards), len(records), time.time() - startTime))
+            return True
+        finally:
+            lock.release()
+
+    def close(self):
+        pass
+
+def migrateModTimeDB(filename, shardFolder, journalMode=MODTIMEDBJOURNALMODE, callback=None):
+    '''
+    Move the records of a ModTimeDB into a ShardedManifest, once.
+    The records go into a shard older than any other, so shards that
+    were already saved win.  callback is called with the open ModTimeDB
+    to migrate anything else stored in it.  The database is renamed
+    with a .migrated suffix afterwards.
+    Returns True if this process migrated it.
+    '''
+
+    if not os.path.exists(filename):
+        return False
+
+    lock = FileLock.FileLock(filename, timeout=MANIFESTLOCKTIMEOUT)
+    lock.acquire()
+    try:
+        ''' Check again now that we hold the lock, another node may have migrated it. '''
+        if not os.path.exists(filename):
+            return False
+
+        startTime = time.time()
+        db = ModTimeDB(filename, journalMode)
+        try:
+            records = db.load()
+            if callback is not None:
+                callback(db)
+        finally:
+            db.close()
+        if records:
+            ShardedManifest(shardFolder)._writeShard(records,
+                FrameSet.fromRange(records[0][0], records[-1][0]), 0)
+        replaceFile(filename, filename + '.migrated')
+        logger.info('Migrated %s records from %s in %.3fs' % (len(records), filename, time.time() - startTime))
+        return True
+    finally:
+        lock.release()
 
 '''
-Set up the logging module.
+File Operations
+Delete, copy, move and verify many frames at once on a bounded
+pool of threads.  Network file servers handle many small requests
+in parallel much better than one after another.  Operations can be
+throttled to a number of files or MB per second so a big cleanup
+doesn't starve the renders reading from the same server.
 '''
-''' Setup the logger. '''
-# logging.basicConfig()
-logger = logging.getLogger(__name__)
-# logger.setLevel(logging.DEBUG)
 
-PIL = False
-try:
-    import Image
-    PIL = True
-except:
+FILEOPTHREADS = 8
+FILEOPERATIONS = ('delete', 'copy', 'move', 'verify')
+MEGABYTE = 1024 * 1024
+COPYCHUNKSIZE = 4 * MEGABYTE
+
+def replaceFile(source, destination):
+    '''
+    Rename source over destination, replacing it if it exists.
+    '''
+
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+def copyFile(source, destination, mbps=None):
+    '''
+    Copy a file with its modification time to a temporary file
+    next to the destination and rename it into place, so readers
+    never see a partial file.
+    With mbps, the copy is limited to that many MB per second.
+    '''
+
+    tempFile = os.path.join(os.path.dirname(destination),
+                            '.%s.%s.tmp' % (os.path.basename(destination), os.getpid()))
     try:
-        sys.path.append("/Library/Python/2.5/site-packages/PIL/")
-        import Image
-        PIL = True
+        if mbps:
+            _copyThrottled(source, tempFile, Throttle(mbps=mbps))
+            shutil.copystat(source, tempFile)
+        else:
+            shutil.copy2(source, tempFile)
+        replaceFile(tempFile, destination)
     except:
-        logger.warning("Unable to import PIL Image module.")
+        if os.path.exists(tempFile):
+            os.remove(tempFile)
+        raise
 
-def loadFrameRange(frameRange):
+def _copyThrottled(source, destination, throttle):
+    src = open(source, 'rb')
+    try:
+        dst = open(destination, 'wb')
+        try:
+            while True:
+                chunk = src.read(COPYCHUNKSIZE)
+                if not chunk:
+                    break
+                throttle.wait(len(chunk))
+                dst.write(chunk)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+class Throttle(object):
     '''
-    Parse an input frame range into individual frame numbers
-    Ex: 1,20-25,22,100 -> [1, 20, 21, 22, 23, 24, 25, 100]
-    Input can also be a list of frames, to save time.
-    Updated to be much faster!
+    Limit operations to a number of files and/or MB per second.
+    Shared by every worker thread, each call to wait() reserves
+    the next free slot and sleeps until it arrives.
     '''
-    
-    result = []
-    if type(frameRange) is str:
-        result = list(set(sum(((list(range(*[int(j) + k for k,j in enumerate(i.split('-'))]))
-            if '-' in i else [int(i)]) for i in frameRange.replace(' ','').split(',')), [])))
-        result = sorted(result)
-        logging.debug("loadFrameRange:result1: %s" % result)
-        return result
-    else:
-        result = sorted(frameRange)
-        logging.debug("loadFrameRange:result2: %s" % result)
+
+    def __init__(self, iops=None, mbps=None):
+        self.iops = iops
+        self.mbps = mbps
+        self.nextTime = 0
+        self.lock = threading.Lock()
+
+    def wait(self, size=0):
+        cost = 0
+        if self.iops:
+            cost = 1.0 / self.iops
+        if self.mbps:
+            cost = max(cost, float(size) / (self.mbps * MEGABYTE))
+        if not cost:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.nextTime)
+            self.nextTime = start + cost
+        if start > now:
+            time.sleep(start - now)
+
+class FileOperationReport(object):
+    '''
+    Result of a FileOperation.
+    done - frames the operation succeeded on
+    missing - frames whose source file didn't exist
+    errors - dictionary of frame -> error message
+    '''
+
+    def __init__(self, operation, dryRun=False):
+        self.operation = operation
+        self.dryRun = dryRun
+        self.done = []
+        self.missing = []
+        self.errors = {}
+        self.bytes = 0
+        self.elapsed = 0
+
+    def getDone(self):
+        return FrameSet(self.done)
+
+    def getMissing(self):
+        return FrameSet(self.missing)
+
+    def getFailed(self):
+        return FrameSet(sorted(self.errors))
+
+    def __str__(self):
+        result = '%s%s %s frames, %s in %.1fs' % ('Dry run ' if self.dryRun else '',
+                    self.operation, len(self.done), formatBytes(self.bytes), self.elapsed)
+        if self.missing:
+            result += ', %s missing' % len(self.missing)
+        if self.errors:
+            result += ', %s failed' % len(self.errors)
         return result
 
+class FileOperation(object):
+    '''
+    Run one of FILEOPERATIONS on a list of frames.
+    delete - remove each frame
+    copy, move - copy or move each frame to the same name in the destination folder
+    verify - compare each frame to the copy in the destination folder,
+             or check it with frameVerifier if there's no destination
+    progress is called with (done, total, frame) from the calling thread.
+    With dryRun, frames are only checked for existence.
+    '''
+
+    def __init__(self, operation, destination=None, threads=FILEOPTHREADS,
+                    iops=None, mbps=None, dryRun=False, progress=None):
+        if operation not in FILEOPERATIONS:
+            raise ValueError("Unknown file operation %s, expected one of %s" % (operation, ', '.join(FILEOPERATIONS)))
+        if operation in ('copy', 'move') and not destination:
+            raise ValueError("The %s operation needs a destination folder." % operation)
+        self.operation = operation
+        self.destination = destination
+        self.threads = max(1, threads)
+        self.throttle = Throttle(iops, mbps)
+        self.dryRun = dryRun
+        self.progress = progress
+
+    def run(self, items):
+        '''
+        Run the operation on a list of (frame, path) and
+        return a FileOperationReport.
+        '''
+
+        startTime = time.time()
+        items = list(items)
+        report = FileOperationReport(self.operation, self.dryRun)
+        if self.destination and not self.dryRun and self.operation in ('copy', 'move'):
+            if not os.path.isdir(self.destination):
+                os.makedirs(self.destination)
+
+        if self.threads > 1 and len(items) > 1:
+            pool = ThreadPool(min(self.threads, len(items)))
+            try:
+                results = pool.imap_unordered(self._runItem, items)
+                self._collect(results, report, len(items))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self._collect((self._runItem(item) for item in items), report, len(items))
+
+        if not self.dryRun:
+            folders = set(os.path.dirname(path) for frame, path in items)
+            if self.destination and self.operation in ('copy', 'move'):
+                folders.add(self.destination)
+            for folder in folders:
+                invalidateNodeCache(folder)
+
+        report.done.sort()
+        report.missing.sort()
+        report.elapsed = time.time() - startTime
+        logger.debug(str(report))
+        return report
+
+    def _collect(self, results, report, total):
+        count = 0
+        for frame, status, size, message in results:
+            count += 1
+            if status == 'done':
+                report.done.append(frame)
+                report.bytes += size
+            elif status == 'missing':
+                report.missing.append(frame)
+            else:
+                report.errors[frame] = message
+            if self.progress:
+                self.progress(count, total, frame)
+
+    def _runItem(self, item):
+        '''
+        Returns (frame, status, size, message)
+        '''
+
+        frame, path = item
+        size = 0
+        if self.dryRun or self.operation != 'delete':
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                return (frame, 'missing', 0, None)
+        if self.dryRun:
+            return (frame, 'done', size, None)
+
+        try:
+            self.throttle.wait(size)
+            message = getattr(self, '_' + self.operation)(path)
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT and self.operation == 'delete':
+                return (frame, 'missing', 0, None)
+            message = str(e)
+        if message:
+            return (frame, 'error', 0, message)
+        return (frame, 'done', size, None)
+
+    def _getDestination(self, path):
+        return os.path.join(self.destination, os.path.basename(path))
+
+    def _delete(self, path):
+        os.remove(path)
+
+    def _copy(self, path):
+        copyFile(path, self._getDestination(path))
+
+    def _move(self, path):
+        try:
+            replaceFile(path, self._getDestination(path))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            copyFile(path, self._getDestination(path))
+            os.remove(path)
+
+    def _verify(self, path):
+        if not self.destination:
+            if not frameVerifier.verifyImage(path)[1]:
+                return "Corrupt frame"
+            return None
+        other = self._getDestination(path)
+        if not os.path.exists(other):
+            return "Missing from %s" % self.destination
+        if os.path.getsize(other) != os.path.getsize(path):
+            return "Size differs from %s" % other
+        if hashFile(other) != hashFile(path):
+            return "Contents differ from %s" % other
+        return None
+
+PREFETCHMAXFRAMES = 500
+PREFETCHMAXBYTES = 2 * 1024 * MEGABYTE
+PREFETCHMBPS = 200 # Leave the rest of the network for the encode itself
+PREFETCHCHUNKSIZE = MEGABYTE
+
+def prefetchFile(path):
+    '''
+    Ask the OS to read a file into the page cache.
+    Uses posix_fadvise where available, otherwise reads the file through.
+    Returns the size of the file.
+    '''
+
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+        else:
+            while f.read(PREFETCHCHUNKSIZE):
+                pass
+    finally:
+        f.close()
+    return size
+
+class Prefetcher(object):
+    '''
+    Warm the page cache with frames of a sequence in a background
+    thread, so they're read from memory when they're needed.
+    Depth is limited to maxFrames and maxBytes, and reads are
+    throttled to mbps.  Starting a new prefetch cancels the last one.
+    '''
+
+    def __init__(self, sequence, maxFrames=PREFETCHMAXFRAMES, maxBytes=PREFETCHMAXBYTES, mbps=PREFETCHMBPS):
+        self.sequence = sequence
+        self.maxFrames = maxFrames
+        self.maxBytes = maxBytes
+        self.throttle = Throttle(mbps=mbps)
+        self.thread = None
+        self.cancelled = threading.Event()
+        self._reset(FrameSet())
+
+    def _reset(self, frames):
+        self.frames = frames
+        self.done = []
+        self.bytes = 0
+        self.startTime = time.time()
+        self.endTime = None
+
+    def start(self, frames):
+        '''
+        Start prefetching the existing frames in the frame range.
+        '''
+
+        self.cancel()
+        existing = self.sequence.getExistingFrames(frames)
+        if len(existing) > self.maxFrames:
+            existing = FrameSet(list(islice(existing, self.maxFrames)))
+        self._reset(existing)
+        items = list(izip(existing, self.sequence.iterFrameFilenames(existing)))
+        self.thread = threading.Thread(target=self._run, args=(items,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, items):
+        for frame, path in items:
+            if self.cancelled.is_set() or self.bytes >= self.maxBytes:
+                break
+            try:
+                self.throttle.wait(os.path.getsize(path))
+                self.bytes += prefetchFile(path)
+                self.done.append(frame)
+            except EnvironmentError as e:
+                logger.debug("Unable to prefetch %s, %s" % (path, e))
+        self.endTime = time.time()
+        logger.debug(str(self))
+
+    def cancel(self):
+        '''
+        Stop the running prefetch, keeping its results.
+        '''
+
+        if self.thread is not None:
+            self.cancelled.set()
+            self.thread.join()
+            self.thread = None
+            self.cancelled.clear()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def getPrefetched(self):
+        return FrameSet(self.done)
+
+    def getOverlap(self, start, end):
+        '''
+        Return the seconds the prefetch ran between start and end.
+        '''
+
+        prefetchEnd = self.endTime or time.time()
+        return max(0, min(prefetchEnd, end) - max(self.startTime, start))
+
+    def __str__(self):
+        elapsed = (self.endTime or time.time()) - self.startTime
+        return 'Prefetched %s of %s frames, %s in %.1fs' % (len(self.done), len(self.frames),
+                    formatBytes(self.bytes), elapsed)
+
+def verifyFrames(sequences, frames, suspectsOnly=False):
+    '''
+    Verify the frames of several sequences in a single batch.
+    Returns a sorted list of the frame numbers that are missing
+    or corrupt in any of the sequences.
+    If suspectsOnly is True, only frames that are size outliers
+    are verified.
+    '''
+
+    corruptFrames = set()
+    toVerify = []
+    for sequence in sequences:
+        if not frameVerifier.canVerify(sequence.extension):
+            logger.warning("Python Imaging Library(PIL) not installed, unable to verify %s." % sequence)
+            continue
+        stats = sequence.getFrameStats(frames)
+        corruptFrames.update(frames - stats.getFrameSet())
+        suspects = None
+        if suspectsOnly:
+            suspects = SequenceStats(stats).getOutliers()
+            logger.debug("Verifying %s suspect frames of %s" % (len(suspects), len(stats)))
+        for frame, size, mtime in stats:
+            if suspects is None or frame in suspects:
+                toVerify.append((sequence.getFrameFilename(frame), frame, size, mtime))
+
+    ''' Single frames are quicker to verify without starting a pool '''
+    processes = min(frameVerifier.getProcessCount(), len(toVerify))
+    if not processes:
+        return sorted(corruptFrames)
+    if processes < 2:
+        processes = 0
+
+    verifier = frameVerifier.FrameVerifier(processes)
+    pathFrames = {}
+    try:
+        for filePath, frame, size, mtime in toVerify:
+            pathFrames[filePath] = frame
+            verifier.submit(filePath, size, mtime)
+        for filePath, ok in verifier.collect(wait=True):
+            if not ok:
+                logger.debug("Corrupt image path: %s." % (filePath))
+                corruptFrames.add(pathFrames[filePath])
+    finally:
+        verifier.close()
+
+    corruptFrames = sorted(corruptFrames)
+    if corruptFrames:
+        logger.warning("Corrupt Frame Numbers: " + loadFrameRange(corruptFrames).toString())
+    return corruptFrames
+
 def padFrame(self, frame, pad=5):
     '''
     Pad the input value
@@ -88,6 +2505,7 @@ class Sequence:
         self.extension = seqData.get('Extension', '')
         self.currentFrame = seqData.get('currentFrame', '')
         self.frameRange = frameRange
+        self.modTimeDBJournalMode = MODTIMEDBJOURNALMODE
 
     def getName(self):
         '''
@@ -101,39 +2519,68 @@ class Sequence:
 
     def loadFrameRange(self, frameRange):
         '''
-        Load a frame range with the option of
-        all existing frames from the current
+        Load a frame range as a FrameSet with the option
+        of all existing frames from the current
         sequence object.
         '''
-        if type(frameRange) is list:
+        if isinstance(frameRange, FrameSet):
             return frameRange
+        if not isinstance(frameRange, (stringTypes, numbers.Number)):
+            return FrameSet(frameRange)
         frameRange = str(frameRange)
         if frameRange.upper() == 'ALL':
             bounds = self.getBounds()
-            frameRange = str(bounds['start']) + '-' + str(bounds['end'])
+            return FrameSet.fromRange(bounds['start'], bounds['end'])
         return loadFrameRange(frameRange)
 
-    def deleteFrames(self, frames):
+    def deleteFrames(self, frames, **options):
         '''
         Delete the supplied frame range from the sequence.
         You can also supply the value "ALL" to delete all frames
+        options are passed to FileOperation, Ex: threads, iops, dryRun
+        Returns the number of frames deleted.
         '''
         
-        framesToDelete = []
-        
+        report = self.runFileOperation('delete', frames, **options)
+        for frame, message in sorted(report.errors.items()):
+            logger.warning("Unable to delete frame %s, %s" % (frame, message))
+        return len(report.done)
+
+    def copyFrames(self, destination, frames='ALL', **options):
+        '''
+        Copy frames to the same names in the destination folder.
+        Returns a FileOperationReport.
+        '''
+
+        return self.runFileOperation('copy', frames, destination, **options)
+
+    def moveFrames(self, destination, frames='ALL', **options):
+        '''
+        Move frames to the same names in the destination folder.
+        Returns a FileOperationReport.
+        '''
+
+        return self.runFileOperation('move', frames, destination, **options)
+
+    def runFileOperation(self, operation, frames='ALL', destination=None, **options):
+        '''
+        Run a FileOperation on the frames in the frame range.
+        Frames missing from the folder index are reported as
+        missing without touching the file server.
+        options are passed to FileOperation, Ex: threads, iops, mbps, dryRun, progress
+        Returns a FileOperationReport.
+        '''
+
         if str(frames).upper() == 'ALL':
-            framesToDelete = self.getFrames()
+            requested = self.getExistingFrames()
         else:
-            for frameNumber in self.loadFrameRange(frames):
-                framesToDelete.append(self.getFrame(frameNumber))
-        
-        deleteCount = 0
-        for frame in framesToDelete:
-            if os.path.exists(frame):
-                os.remove(frame)
-                deleteCount += 1
-        
-        return deleteCount
+            requested = self.loadFrameRange(frames)
+        existing = self.getExistingFrames(requested)
+
+        fileOperation = FileOperation(operation, destination, **options)
+        report = fileOperation.run(izip(existing, self.iterFrameFilenames(existing)))
+        report.missing = sorted(set(report.missing).union(requested - existing))
+        return report
 
     def checkForCorruptFrame(self, frame):
         result = self.checkForCorruptFrames(str(frame) + '-' + str(frame))
@@ -142,33 +2589,23 @@ class Sequence:
         else:
             return False
 
-    def checkForCorruptFrames(self, frames='All'):
-        framesToVerify = []
-        
+    def checkForCorruptFrames(self, frames='All', suspectsOnly=False):
+        '''
+        Verify frames and return a list of the corrupt frame numbers.
+        Common formats are checked by reading their header and trailer,
+        others are checked with PIL in a process pool.  Every result is cached by
+        (path, size, mtime), so unchanged frames are only verified once.
+        Missing frames are reported as corrupt.
+        If suspectsOnly is True, only frames much smaller than
+        their neighbours are verified.
+        '''
+
         if str(frames).upper() == 'ALL':
             framesToVerify = self.getFrames()
         else:
-            for frameNumber in self.loadFrameRange(frames):
-                framesToVerify.extend(self.getFrames(frameNumber))
+            framesToVerify = self.loadFrameRange(frames)
         
-        corruptFrames = []
-        if PIL:
-            for frame in framesToVerify:
-                filePath = self.getFrameFilename(frame)
-                logger.debug("Opening image: " + str(filePath))
-                try:
-                    img = Image.open(filePath)
-                    img.verify()
-                    logger.debug("Image verified: " + filePath)
-                except:
-                    logger.debug("Corrupt image path: %s." % (filePath))
-                    corruptFrames.append(frame)
-            if corruptFrames:
-                logger.warning("Corrupt Frame Numbers: " + self.convertListToRanges(corruptFrames))
-        else:
-            logger.warning("Python Imaging Library(PIL) not installed.")
-
-        return corruptFrames
+        return verifyFrames([self], framesToVerify, suspectsOnly)
         
     def getDuration(self, frameRate=29.97, timecode=False):
         '''
@@ -190,36 +2627,33 @@ class Sequence:
 
     def getExistingFrames(self, frameRange='ALL'):
         '''
-        Get a list of all frame numbers that currently exist.
+        Get a FrameSet of all frame numbers that currently exist.
+        Uses the folder index, so this costs one listing of the folder
+        rather than a check for every frame.
         '''
         
+        index = self.getFolderIndex()
+        result = index.getFrameSet(self.prefix, self.extension, self.padding)
         if str(frameRange).upper() == 'ALL':
-            '''
-            Generate a sequence path with wildcards to use with glob
-            Ex /path/to/sequence.*.png
-            '''
-            
-            globPath = self.folder + '/' + self.prefix + '*' + self.extension
-            fileList = glob.glob(globPath)
-            fileList.sort()
-            
-            result = []
-            for item in fileList:
-                result.append(int(self.splitPath(item)['currentFrame']))
             return result
-        
         else:
-            result = []
-            for frameNum in self.loadFrameRange(frameRange):
-                if os.path.exists(self.getFrameFilename(frameNum)):
-                    result.append(frameNum)
-            return result
+            return result & self.loadFrameRange(frameRange)
+
+    def getFolderIndex(self, withStats=False):
+        '''
+        Get the shared index of the sequence folder.
+        It's rescanned automatically when the folder changes.
+        '''
+
+        return getFolderIndex(self.folder, withStats)
 
     def getFrames(self, frameRange='ALL', excludeMissing=False, onlyMissing=False, fillMissing=False):
         '''
-        Get a list of frames for the sequence returned in a list.
+        Get the frames for the sequence returned as a FrameSet.
         If a frame range is supplied, only frames in that range are returned.
-        Fill missing frames will repeat the latest frame if a frame is missing.
+        Fill missing frames will repeat the latest frame if a frame is missing,
+        so it is returned as a list starting at frame 0.
+        Use iterFilled to stream the filled frames instead.
         '''
         
         logging.debug("getFrames:frameRange: %s" % frameRange)
@@ -231,51 +2665,58 @@ class Sequence:
         else:
             existingFrames = self.getExistingFrames(frameRange)
             if excludeMissing or fillMissing:
-                result = list(set(result).intersection(set(existingFrames)))
+                result = result & existingFrames
                 if excludeMissing:
                     return result
                 else:
-                    newList = []
-                    bounds = self.getBounds()
-                    count = 0
-                    for index, frameNum in enumerate(result):
-                        while index+1 < len(result) and count != result[index+1]:
-                            newList.append(frameNum)
-                            count += 1
-                    newList.append(result[-1])
-                    return newList
+                    return [sourceFrame for frame, sourceFrame in self.iterFilled(frameRange, start=0)]
             elif onlyMissing:
-                result = list(set(result) - set(existingFrames))
-                return result
+                return result - existingFrames
+
+    def iterFrames(self, frameRange='ALL', excludeMissing=False, onlyMissing=False):
+        '''
+        Generator version of getFrames.
+        Frame numbers are produced one at a time from the frame
+        intervals, so memory use doesn't grow with the range.
+        '''
+
+        for frame in self.getFrames(frameRange, excludeMissing, onlyMissing):
+            yield frame
+
+    def iterFilled(self, frameRange='ALL', start=None):
+        '''
+        Generate (frame, sourceFrame) for every frame from start to the
+        last existing frame, where sourceFrame is the latest existing frame
+        at or before it.  Frames before the first existing frame use the
+        first existing frame.  start defaults to the first existing frame.
+        Runs in a single pass over the existing frames.
+        '''
+
+        existing = self.getExistingFrames(frameRange)
+        if not existing:
+            return
+
+        first = existing.getStart()
+        if start is None or start > first:
+            start = first
+
+        existingFrames = iter(existing)
+        nextExisting = next(existingFrames, None)
+        sourceFrame = first
+        for frame in xrange(start, existing.getEnd() + 1):
+            if frame == nextExisting:
+                sourceFrame = frame
+                nextExisting = next(existingFrames, None)
+            yield frame, sourceFrame
 
     def convertListToRanges(self, frames):
         '''
-        Convert an array of frame numbers into a string of frame ranges.
+        Convert a FrameSet or list of frame numbers into a string of frame ranges.
         Ex: 1,2,3,4,5,10 -> 1-5,10
+        Ex: 0,5,10,15,20 -> 0-20x5
         '''
         
-        i = 0
-        frameRanges = []
-        frames.sort()
-        if (len(frames) > 0):
-            while(i+1 <= len(frames)):
-                rangeStart = frames[i]
-
-                while(i+2 <= len(frames)):
-                    if (int(frames[i]) + 1 != int(frames[i+1])):
-                        break
-                    else:
-                        i = i+1
-
-                if (rangeStart != frames[i]):
-                    rng = str(rangeStart) + "-" + str(frames[i])
-                    frameRanges.append(rng)
-                else:
-                    rng = str(rangeStart)
-                    frameRanges.append(rng)
-                i = i+1
-
-        return ','.join(frameRanges)
+        return loadFrameRange(frames).toString()
 
     def getFrameFilename(self, frame, includeFolder=True):
         '''
@@ -293,10 +2734,23 @@ class Sequence:
         Generate the filename associated with the supplied frames.
         '''
         
-        result = []
+        return list(self.iterFrameFilenames(frames, includeFolder))
+
+    def iterFrameFilenames(self, frames, includeFolder=True):
+        '''
+        Generator version of getFrameFilenames.
+        Whole positive frame numbers are formatted with a single
+        template instead of going through padFrame.
+        '''
+
+        template = self.prefix.replace('%', '%%') + '%0' + str(self.padding) + 'd' + self.extension.replace('%', '%%')
+        if includeFolder:
+            template = self.folder.replace('%', '%%') + '/' + template
         for frame in frames:
-            result.append(self.getFrameFilename(frame, includeFolder))
-        return result
+            if isinstance(frame, numbers.Integral) and frame >= 0:
+                yield template % frame
+            else:
+                yield self.getFrameFilename(frame, includeFolder)
 
     def getBounds(self, update=False, frameRange=''):
         '''
@@ -305,8 +2759,10 @@ class Sequence:
         unless Update is true.
         '''
 
-        if frameRange == '':
-            if self.frameRange.upper() == 'ALL':
+        if isinstance(frameRange, FrameSet):
+            frames = frameRange
+        elif frameRange == '':
+            if str(self.frameRange).upper() == 'ALL':
                 frames = self.getExistingFrames()
             else:
                 frames = loadFrameRange(self.frameRange)
@@ -314,16 +2770,16 @@ class Sequence:
             frames = loadFrameRange(frameRange)
     
         result = {}
-        result['start'] = str(frames[0])
-        result['end'] = str(frames[-1])
+        result['start'] = str(frames.getStart())
+        result['end'] = str(frames.getEnd())
             
         return result
 
     def getMissingFrames(self, frameRange='ALL'):
         '''
-        Get a list of missing frames for the entire sequence
+        Get the missing frames for the entire sequence
         or just a frameRange.
-        Returned as a list.
+        Returned as a FrameSet.
         * Uses getFrames, this is just for convience
         '''
 
@@ -344,20 +2800,20 @@ class Sequence:
         Returns a string.
         '''
         
-        result = 0
-        allExistingFrames = self.getFrames()
-        for frame in allExistingFrames:
-            result += os.path.getsize(frame)
+        result = sum(self.getFrameStats().sizes)
         
         if humanReadable:
-            # Now make it a little easier to read
-            for x in ['bytes','KB','MB','GB','TB']:
-                    if result < 1024.0:
-                        return "%3.1f %s" % (result, x)
-                    result /= 1024.0
+            return formatBytes(result)
         else:
             return result
 
+    def getStats(self, frameRange='ALL'):
+        '''
+        Get a SequenceStats of the existing frames in the frame range.
+        '''
+
+        return SequenceStats(self.getFrameStats(frameRange))
+
     def padFrame(self, frame, pad=''):
         '''
         Pad the input value
@@ -389,9 +2845,7 @@ class Sequence:
 
         result = {}
 
-        # Sequence matching regex
-        pattern = re.compile('(.+?)(\d\d+?)(\.\w+)')
-        match = pattern.match(path)
+        match = sequencePattern.match(path)
 
         if not match:
             raise IOError("ERROR: Invalid Sequence " + str(path))
@@ -412,126 +2866,363 @@ class Sequence:
     Used to find changes in image sequences.
     '''
 
-    def saveModTimes(self, filename, modTimeDict={}, frameRange='ALL'):
+    def openModTimeStore(self, filename, storeType=None):
+        '''
+        Open the modification time storage for a file.
+        Files ending in MANIFESTEXTENSION are opened as a
+        SequenceManifest, folders ending in SHARDEXTENSION as a
+        ShardedManifest and anything else as a ModTimeDB.
+        '''
+
+        if storeType is None:
+            if str(filename).endswith(MANIFESTEXTENSION):
+                storeType = SequenceManifest
+            elif str(filename).rstrip('/').endswith(SHARDEXTENSION):
+                storeType = ShardedManifest
+            else:
+                storeType = ModTimeDB
+        if storeType is ModTimeDB:
+            return ModTimeDB(filename, self.modTimeDBJournalMode)
+        return storeType(filename)
+
+    def saveModTimes(self, filename, modTimeDict={}, frameRange='ALL', useHashes=False, storeType=None):
         '''
         Create or update an sqlite db of each frame and
         it's current modification time supplied as a dictionary
         for comparison next time.
+        The dictionary values can also be (mtime, size, hash)
+        as returned by getModTimes with useHashes.
+        Records in the frame range are replaced, so frames that
+        no longer exist are removed from the db.
         '''
         
         if modTimeDict == {}:
-            modTimeDict = {}
             logger.debug('Loading modification times: No hash dictionary provided.\n')
-            modTimeDict = self.getModTimes(frameRange)
-
-        logger.info('Saving modification times...\n')
-        conn = sqlite3.connect(filename)
-        curs = conn.cursor()
-        test = curs.execute('CREATE TABLE IF NOT EXISTS frames (name, modtime)')
-        items = modTimeDict.items()
+            past = None
+            if useHashes and os.path.exists(filename):
+                past = self.loadSnapshot(filename, frameRange, storeType)
+            snapshot = self.getSnapshot(frameRange, useHashes, past)
+        else:
+            snapshot = self.getSnapshotFromModTimes(modTimeDict)
 
-        logger.info("Writing " + str(len(items)) + " modification times\n")
-        for item in items:
-            curs.execute('INSERT OR REPLACE INTO frames (name, modtime) VALUES (?,?)', item)
-            
-        logger.info('Committing changes to database...\n')
-        conn.commit()    
-        conn.close()
+        self.saveSnapshot(filename, snapshot, frameRange, storeType)
         logger.info('Modification times saved.')
         
-    def compare(self, databaseFile, frameRange='ALL', pastModTimes={}, currentModTimes={}):
+    def compare(self, databaseFile, frameRange='ALL', pastModTimes={}, currentModTimes={}, useHashes=False, storeType=None):
         '''
         Compare the current sequence to a information
         about a previous version stored in the supplied database.
         Lists added, deleted, modified, and constant items.
         Changes are determined by:
             1) Find added and deleted frames.
-            2) Find items with modification time differences.
+            2) Find items with modification time differences,
+            or content hash differences if useHashes is True.
         '''
 
         if pastModTimes == {}:
-            pastModTimes = self.loadModTimesFromDB(databaseFile, frameRange)
+            past = self.loadSnapshot(databaseFile, frameRange, storeType)
+        else:
+            past = self.getSnapshotFromModTimes(pastModTimes)
         if currentModTimes == {}:
-            currentModTimes = self.getModTimes(frameRange)
+            current = self.getSnapshot(frameRange, useHashes, past)
+        else:
+            current = self.getSnapshotFromModTimes(currentModTimes)
 
-        diff = DictDifferences.DictDifferences(currentModTimes, pastModTimes)
         result = {}
-        result['Added'] = list(sorted(diff.added()))
-        result['Modified'] = list(sorted(diff.changed()))
-        result['Deleted'] = list(sorted(diff.removed()))
-        result['Constant'] = list(sorted(diff.unchanged()))
+        for key, frames in current.diff(past, useHashes).items():
+            result[key] = self.getFrameFilenames(frames, includeFolder=False)
         
         return result
+
+    def getSnapshot(self, frameRange='ALL', useHashes=False, past=None):
+        '''
+        Get a SequenceSnapshot of the existing frames in the frame range.
+        If useHashes is True, frames are hashed, reusing the hashes in
+        the past snapshot for frames whose size and modification
+        time haven't changed.
+        '''
+
+        stats = self.getFrameStats(frameRange)
+        result = SequenceSnapshot(stats.frames, stats.sizes, stats.mtimes)
+        if not useHashes:
+            return result
+
+        pastIndex = {}
+        if past is not None and past.hashes:
+            pastIndex = dict((frame, index) for index, frame in enumerate(past.frames))
+
+        result.hashes = []
+        toHash = []
+        for index, (frame, size, mtime) in enumerate(stats):
+            pastFrame = pastIndex.get(frame)
+            if (pastFrame is not None and past.hashes[pastFrame]
+                    and past.mtimes[pastFrame] == mtime and past.sizes[pastFrame] == size):
+                result.hashes.append(past.hashes[pastFrame])
+            else:
+                result.hashes.append(None)
+                toHash.append(index)
+
+        startTime = time.time()
+        hashes = collectHashes(self.getFrameFilenames([stats.frames[index] for index in toHash]))
+        for index, digest in izip(toHash, hashes):
+            result.hashes[index] = digest
+        logger.debug("Hashed %s of %s frames in %.3fs" % (len(toHash), len(result), time.time() - startTime))
+        return result
+
+    def getSnapshotFromModTimes(self, modTimeDict):
+        '''
+        Convert a dictionary from getModTimes or loadModTimesFromDB
+        into a SequenceSnapshot.
+        '''
+
+        records = []
+        for name, modTime in modTimeDict.items():
+            match = frameFilePattern.match(name)
+            if match:
+                if isinstance(modTime, tuple):
+                    records.append((int(match.group(2)),) + modTime)
+                else:
+                    records.append((int(match.group(2)), modTime, None, None))
+        records.sort()
+        return SequenceSnapshot.fromRecords(records)
+
+    def loadSnapshot(self, filename, frameRange='ALL', storeType=None):
+        '''
+        Load a SequenceSnapshot from a ModTimeDB or SequenceManifest.
+        '''
+
+        frames = None
+        if str(frameRange).upper() != 'ALL':
+            frames = self.loadFrameRange(frameRange)
+
+        db = self.openModTimeStore(filename, storeType)
+        try:
+            return SequenceSnapshot.fromRecords(db.load(frames))
+        finally:
+            db.close()
+
+    def saveSnapshot(self, filename, snapshot, frameRange='ALL', storeType=None):
+        '''
+        Save a SequenceSnapshot to a ModTimeDB or SequenceManifest.
+        Records in the frame range that aren't in the snapshot are removed.
+        '''
+
+        frames = None
+        if str(frameRange).upper() != 'ALL':
+            frames = self.loadFrameRange(frameRange)
+
+        logger.info("Writing " + str(len(snapshot)) + " modification times\n")
+        db = self.openModTimeStore(filename, storeType)
+        try:
+            db.save(snapshot.toRecords(), frames)
+        finally:
+            db.close()
         
-    def getModTimes(self, frameRange='ALL'):
+    def getModTimes(self, frameRange='ALL', useHashes=False, pastModTimes={}):
         '''
         Generate a dictionary of every frames modification time.
         This is used to check for changes in an image sequence.
         Optionally supply a frame range to limit the scope.
+
+        If useHashes is True the values are (mtime, size, hash).
+        Hashes are reused from pastModTimes for frames whose
+        size and modification time haven't changed, so only
+        rewritten frames are read.
         '''
 
         result = {}
-        logging.debug("getModTimes:frameRange: %s" % frameRange)
-        frames = sorted(self.getFrames(frameRange))
-        logging.debug("getModTimes:getFrames: %s" % frames)
+        if not useHashes:
+            for frame, size, mtime in self.getFrameStats(frameRange):
+                result[self.getFrameFilename(frame, includeFolder=False)] = mtime
+            return result
 
-        for frame in frames:
-            frameFilename = self.getFrameFilename(frame)
-            logging.debug("getModTimes:frameFilename: %s" % frameFilename)
-            modTime = os.stat(frameFilename).st_mtime
-            logging.debug("getModTimes:modTime: %s" % modTime)
-            frameName = os.path.basename(frameFilename)
-            logging.debug("getModTimes:frameName: %s" % frameName)
-            result[frameName] = modTime
-            logging.debug("getModTimes:result: %s" % result[frameName])
+        snapshot = self.getSnapshot(frameRange, useHashes, self.getSnapshotFromModTimes(pastModTimes))
+        for frame, mtime, size, digest in snapshot.toRecords():
+            result[self.getFrameFilename(frame, includeFolder=False)] = (mtime, size, digest)
         return result
 
-    def loadModTimesFromDB(self, filename, frameRange='ALL'):
+    def getFrameStats(self, frameRange='ALL', threads=STATTHREADS):
         '''
-        Read the sqlite db of each frames hash codes to check
-        for frames that have changed since last time.
+        Collect the size and modification time of every existing
+        frame in the frame range.  Returns a FrameStats object.
+        Stat data is read fresh unless another process on the node
+        read it in the last NODECACHESTATTTL seconds, since frames
+        can be rewritten in place without changing the folder.
         '''
 
-        logger.debug('Retrieving hash codes from database...')
-        conn = sqlite3.connect(filename)
-        curs = conn.cursor()
-        test = curs.execute('CREATE TABLE IF NOT EXISTS frames (name, modtime)')
+        startTime = time.time()
+        frames = self.getExistingFrames(frameRange)
 
-        if str(frameRange).upper() == 'ALL':
-            curs.execute('SELECT * from frames order by name')
+        if LISTINGSTATS:
+            index = self.getFolderIndex()
+            index.withStats = True
+            index.scan()
+            names = index.getFrameNames(self.prefix, self.extension)
+            stats = [index.stats.get(names.get(frame)) for frame in frames]
         else:
-            dbRange = []
-            frameRange = self.loadFrameRange(frameRange)
-            for frame in frameRange:
-                dbRange.append('"' + self.getFrameFilename(frame, includeFolder=False) + '"')
-            cmd = 'SELECT name,modtime FROM frames WHERE name IN(' + ','.join(dbRange) + ') order by name'
-            curs.execute(cmd)
+            stats = collectStats(self.getFrameFilenames(frames), threads)
+
+        result = FrameStats()
+        for frame, stat in izip(frames, stats):
+            if stat is None:
+                logger.debug("Frame %s disappeared while collecting stats." % frame)
+                continue
+            result.frames.append(frame)
+            result.sizes.append(stat[0])
+            result.mtimes.append(stat[1])
+
+        logger.debug("Collected stats for %s frames in %.3fs" % (len(result), time.time() - startTime))
+        return result
 
+    def loadModTimesFromDB(self, filename, frameRange='ALL', useHashes=False, storeType=None):
         '''
-        Load the input into a dictionary.
-        If a frame range was supplied, limit the dictionary to that range.
+        Read the sqlite db of each frames modification times to check
+        for frames that have changed since last time.
+        Returns a dictionary of frame filename -> modification time,
+        or frame filename -> (mtime, size, hash) if useHashes is True.
         '''
-        result = {}
-        for item in curs:
-            frameName, modTime = item
-            currentFrameNumber = int(self.splitPath(frameName)['currentFrame'])
 
-            addToDict = False
-            if str(frameRange).upper() == 'ALL':
-                addToDict = True
-            elif currentFrameNumber in frameRange:
-                    addToDict = True
+        logger.debug('Retrieving modification times from database...')
+        frames = None
+        if str(frameRange).upper() != 'ALL':
+            frames = self.loadFrameRange(frameRange)
 
-            if addToDict:
-                result[frameName] = modTime
+        db = self.openModTimeStore(filename, storeType)
+        try:
+            records = db.load(frames)
+        finally:
+            db.close()
 
-        conn.close()
+        result = {}
+        for frame, modTime, size, digest in records:
+            if useHashes:
+                result[self.getFrameFilename(frame, includeFolder=False)] = (modTime, size, digest)
+            else:
+                result[self.getFrameFilename(frame, includeFolder=False)] = modTime
 
         return result
 
+    def saveManifest(self, filename, modTimeDict={}, frameRange='ALL', useHashes=False):
+        '''
+        Save the modification times to a binary SequenceManifest.
+        Works the same as saveModTimes.
+        '''
+
+        self.saveModTimes(filename, modTimeDict, frameRange, useHashes, storeType=SequenceManifest)
+
+    def loadManifest(self, filename, frameRange='ALL', useHashes=False):
+        '''
+        Load the modification times from a binary SequenceManifest.
+        Works the same as loadModTimesFromDB.
+        '''
+
+        return self.loadModTimesFromDB(filename, frameRange, useHashes, storeType=SequenceManifest)
+
+    def compareManifest(self, filename, frameRange='ALL', pastModTimes={}, currentModTimes={}, useHashes=False):
+        '''
+        Compare the current sequence to a binary SequenceManifest.
+        Works the same as compare.
+        '''
+
+        return self.compare(filename, frameRange, pastModTimes, currentModTimes, useHashes, storeType=SequenceManifest)
+
     def __str__(self):
         return self.getTemplate()
 
+class SequenceGroup(object):
+    '''
+    Several sequences that share a frame range, Ex: the output modules
+    of a multi-pass or stereo render.  Sequences in the same folder share
+    one folder index, so each folder is listed once for the whole group,
+    and frames are verified for every output in a single batch.
+    '''
+
+    def __init__(self, sequences, frameRange='ALL'):
+        self.frameRange = frameRange
+        self.sequences = []
+        for sequence in sequences:
+            if not isinstance(sequence, Sequence):
+                sequence = Sequence(sequence, frameRange)
+            self.sequences.append(sequence)
+
+    def getFolders(self):
+        '''
+        Return the distinct folders of the group in order.
+        '''
+
+        result = []
+        for sequence in self.sequences:
+            if sequence.folder not in result:
+                result.append(sequence.folder)
+        return result
+
+    def loadFrameRange(self, frameRange='ALL'):
+        '''
+        Load a frame range for the group.
+        ALL is the group frame range, or the combined bounds of
+        every sequence if the group was created without one.
+        '''
+
+        if str(frameRange).upper() != 'ALL':
+            return loadFrameRange(frameRange)
+        if str(self.frameRange).upper() != 'ALL':
+            return loadFrameRange(self.frameRange)
+        result = FrameSet()
+        for sequence in self.sequences:
+            if sequence.getExistingFrames():
+                result = result | sequence.loadFrameRange('ALL')
+        return result
+
+    def getCompleteFrames(self, frameRange='ALL'):
+        '''
+        Return a FrameSet of the frames that exist for every sequence.
+        '''
+
+        frames = self.loadFrameRange(frameRange)
+        for sequence in self.sequences:
+            frames = frames & sequence.getExistingFrames()
+        return frames
+
+    def getIncompleteFrames(self, frameRange='ALL'):
+        '''
+        Return a FrameSet of the frames missing from any sequence.
+        '''
+
+        return self.loadFrameRange(frameRange) - self.getCompleteFrames(frameRange)
+
+    def getFrameFilenames(self, frame, includeFolder=True):
+        '''
+        Return the filename of a frame for every sequence.
+        '''
+
+        return [sequence.getFrameFilename(frame, includeFolder) for sequence in self.sequences]
+
+    def checkForCorruptFrames(self, frames='ALL', suspectsOnly=False):
+        '''
+        Verify every sequence's frames in one batch and return a sorted
+        list of frame numbers that are missing or corrupt in any sequence.
+        '''
+
+        return verifyFrames(self.sequences, self.loadFrameRange(frames), suspectsOnly)
+
+    def deleteFrames(self, frames, **options):
+        '''
+        Delete the frames from every sequence.
+        options are passed to FileOperation, Ex: threads, iops, dryRun
+        Returns the number of files deleted.
+        '''
+
+        deleteCount = 0
+        for sequence in self.sequences:
+            deleteCount += sequence.deleteFrames(frames, **options)
+        return deleteCount
+
+    def __iter__(self):
+        return iter(self.sequences)
+
+    def __len__(self):
+        return len(self.sequences)
+
 
 # mySequence = Sequence('/Users/bchapman/Projects/Scripts+Apps/Qube/_testingGrounds/Image_Sequence_nth/blindness_00000.png')
 # print "Final: " + str(mySequence.getFrames(fillMissing=True))
@@ -358,40 +358,40 @@ def postDialog(cmdjob, values):
             rqiPkg['frameCount'] = int(rqItem['stopTime']) - int(rqItem['startTime']) - 1
 
             '''
-            If it's a sequence, mark all existing frames as complete.
+            If it's a sequence, mark all frames that exist
+            for every output as complete.
             '''
             if sequence:
                 
+                pValue += pIncrement
+                pDlg.Update(pValue, "Finding missing frames for %s..." % rqItem['comp'])
+
+                initPaths = []
                 for path in outPaths:
-                    pValue += pIncrement
-                    pDlg.Update(pValue, "Finding missing frames for %s..." % os.path.basename(path))
-                
                     seqPad = len(seqPattern.findall(path)[-1]) - 2
                     initFrame = sequenceTools.padFrame(rqItem['startTime'], seqPad)
                     initPath = seqPattern.sub(initFrame, path)
                     logging.debug("initPath: %s" % initPath)
-                    seq = sequenceTools.Sequence(initPath, frameRange=agendaRange)
-                    missingFrames = seq.getMissingFrames()
-                    logging.debug("Missing Frames: %s" % missingFrames)
-
-                    for task in rqiValues['agenda']:
-                        logging.debug("Name: %s" % task['name'])
-                        if "-" in task['name']:
-                            tStart, tEnd = task['name'].split("-")
+                    initPaths.append(initPath)
+                seqGroup = sequenceTools.SequenceGroup(initPaths, frameRange=agendaRange)
+                missingFrames = seqGroup.getIncompleteFrames()
+                logging.debug("Missing Frames: %s" % missingFrames)
+
+                for task in rqiValues['agenda']:
+                    logging.debug("Name: %s" % task['name'])
+                    if "-" in task['name']:
+                        tStart, tEnd = task['name'].split("-")
+                    else:
+                        tStart = tEnd = task['name']
+                    tRange = sequenceTools.FrameSet.fromRange(tStart, tEnd)
+                    found = bool(tRange & missingFrames)
+                    if not found:
+                        task['status'] = 'complete'
+                        if task.has_key("resultPackage"):
+                            task['resultpackage']['progress'] = '1' # 100% chunk progress
                         else:
-                            tStart = tEnd = task['name']
-                        tRange = range(int(tStart), int(tEnd) + 1)
-                        found = False
-                        for frame in tRange:
-                            if frame in missingFrames:
-                                found = True
-                        if not found:
-                            task['status'] = 'complete'
-                            if task.has_key("resultPackage"):
-                                task['resultpackage']['progress'] = '1' # 100% chunk progress
-                            else:
-                                task['resultpackage'] = {'progress':'1'}
-                            logging.debug("Marking task as complete: %s" % task)
+                            task['resultpackage'] = {'progress':'1'}
+                        logging.debug("Marking task as complete: %s" % task)
 
             '''
             Delete any unecessary attributes